@@ -0,0 +1,36 @@
+import asyncio
+from types import SimpleNamespace
+from typing import AsyncIterator, Optional
+
+
+class FakeChatClient:
+    """
+    Offline stand-in for `AsyncOpenAI` (`sayory_backend = "fake"`), for tests and benchmarks.
+
+    `chat.completions.create(stream=True)` yields chunks shaped like OpenAI's
+    `ChatCompletionChunk`, one word at a time with `delay` seconds between them. The reply
+    echoes the last user message unless a fixed `reply` is given.
+    """
+
+    def __init__(self, reply: Optional[str] = None, delay: float = 0.0):
+        self.reply = reply
+        self.delay = delay
+        self.requests = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, messages: list, stream: bool = False, **kwargs):
+        self.requests.append(dict(kwargs, messages=messages, stream=stream))
+        reply = self.reply if self.reply is not None else f"Echo: {messages[-1]['content']}"
+        if not stream:
+            message = SimpleNamespace(content=reply)
+            return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+        return self._stream(reply)
+
+    async def _stream(self, reply: str) -> AsyncIterator[SimpleNamespace]:
+        words = reply.split(" ")
+        for index, word in enumerate(words):
+            if self.delay:
+                await asyncio.sleep(self.delay)
+            content = word if index == len(words) - 1 else word + " "
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content))])
+        yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=None))])
@@ -0,0 +1,165 @@
+import asyncio
+import contextvars
+import logging
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Deque, Hashable, Optional, Set
+from app.config import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class AiQueueFull(Exception):
+    pass
+
+
+class AiJob:
+    def __init__(self, user_id: int, owner: Hashable, run: Callable[[], Awaitable],
+                 on_error: Optional[Callable[[Exception], Awaitable]] = None):
+        self.user_id = user_id
+        self.owner = owner
+        self.run = run
+        self.on_error = on_error
+        self.task: Optional[asyncio.Task] = None
+
+
+class AiJobQueue:
+    """
+    Bounded queue of Sayory requests, run off the websocket receive loops by a fixed
+    number of workers (the cap on concurrent upstream calls).
+
+    Users are served round-robin, so one user sending many messages cannot starve the
+    others. A job that runs longer than `timeout` seconds is cancelled, and `cancel`
+    drops every queued or running job of an owner (its socket) when it disconnects.
+    """
+
+    def __init__(self, concurrency: Optional[int] = None, max_pending: Optional[int] = None,
+                 max_per_user: Optional[int] = None, timeout: Optional[float] = None):
+        self.concurrency = concurrency or settings.ai_concurrency
+        self.max_pending = max_pending or settings.ai_queue_size
+        self.max_per_user = max_per_user or settings.ai_queue_per_user
+        self.timeout = timeout or settings.ai_timeout
+        self.pending: "OrderedDict[int, Deque[AiJob]]" = OrderedDict()
+        self.size = 0
+        self.running: Set[AiJob] = set()
+        self.available: Optional[asyncio.Event] = None
+        self.workers: Set[asyncio.Task] = set()
+        self.completed = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.rejected = 0
+
+    def start(self):
+        self.available = self.available or asyncio.Event()
+        while len(self.workers) < self.concurrency:
+            # Outlive the command that happened to start them (and its profile)
+            self.workers.add(asyncio.create_task(self._work(), context=contextvars.Context()))
+
+    async def close(self):
+        for job in list(self.running):
+            job.task.cancel()
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers.clear()
+        self.pending.clear()
+        self.size = 0
+
+    def submit(self, user_id: int, owner: Hashable, run: Callable[[], Awaitable],
+               on_error: Optional[Callable[[Exception], Awaitable]] = None):
+        """
+        Queue `run()` for `user_id`. Returns at once; results are delivered by the job itself.
+
+        Raises:
+            AiQueueFull: The queue, or the user's share of it, is full.
+        """
+        jobs = self.pending.get(user_id)
+        queued = len(jobs) if jobs else 0
+        running = sum(1 for job in self.running if job.user_id == user_id)
+        if self.size >= self.max_pending or queued + running >= self.max_per_user:
+            self.rejected += 1
+            raise AiQueueFull("Too many pending Sayory requests, try again later.")
+
+        self.start()
+        self.pending.setdefault(user_id, deque()).append(AiJob(user_id, owner, run, on_error))
+        self.size += 1
+        self.available.set()
+
+    def cancel(self, owner: Hashable):
+        """
+        Drop the queued jobs of `owner` and cancel the running ones.
+        """
+        for user_id, jobs in list(self.pending.items()):
+            kept = deque(job for job in jobs if job.owner is not owner)
+            self.size -= len(jobs) - len(kept)
+            if kept:
+                self.pending[user_id] = kept
+            else:
+                del self.pending[user_id]
+        for job in list(self.running):
+            if job.owner is owner:
+                job.task.cancel()
+
+    async def _next(self) -> AiJob:
+        while not self.pending:
+            self.available.clear()
+            await self.available.wait()
+        # The user at the front gets one job, then goes to the back of the line
+        user_id, jobs = next(iter(self.pending.items()))
+        job = jobs.popleft()
+        self.size -= 1
+        if jobs:
+            self.pending.move_to_end(user_id)
+        else:
+            del self.pending[user_id]
+        return job
+
+    async def _work(self):
+        while True:
+            job = await self._next()
+            job.task = asyncio.create_task(job.run())
+            self.running.add(job)
+            try:
+                # asyncio.wait, unlike wait_for, never swallows a cancellation of the worker
+                done, _ = await asyncio.wait({job.task}, timeout=self.timeout)
+            except asyncio.CancelledError:
+                job.task.cancel()
+                raise
+            finally:
+                self.running.discard(job)
+
+            if not done:
+                job.task.cancel()
+                self.timed_out += 1
+                await self._fail(job, TimeoutError(f"Sayory did not answer within {self.timeout}s"))
+            elif job.task.cancelled():
+                continue
+            elif job.task.exception() is not None:
+                self.failed += 1
+                await self._fail(job, job.task.exception())
+            else:
+                self.completed += 1
+
+    @staticmethod
+    async def _fail(job: AiJob, error: Exception):
+        logger.error(f"Sayory job of user {job.user_id} failed: {error}")
+        if job.on_error is None:
+            return
+        try:
+            await job.on_error(error)
+        except Exception as e:
+            logger.error(f"Error reporting a failed Sayory job: {e}", exc_info=True)
+
+    def stats(self) -> dict:
+        return {
+            "pending": self.size,
+            "running": len(self.running),
+            "users_waiting": len(self.pending),
+            "completed": self.completed,
+            "failed": self.failed,
+            "timed_out": self.timed_out,
+            "rejected": self.rejected,
+        }
+
+
+ai_jobs = AiJobQueue()
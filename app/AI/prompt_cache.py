@@ -0,0 +1,160 @@
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+from app.config import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_prompt(prompt: str) -> str:
+    return " ".join(prompt.casefold().split())
+
+
+class SharedStream:
+    """
+    One upstream completion followed by any number of identical requests: every follower
+    gets all chunks, from the first one, as they arrive.
+    """
+
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[Exception] = None
+        self.duration = 0.0
+        self.followers = 0
+        self.changed = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def append(self, chunk: str):
+        self.chunks.append(chunk)
+        self.changed.set()
+
+    def finish(self, error: Optional[Exception] = None):
+        self.done = True
+        self.error = error
+        self.changed.set()
+
+    async def follow(self) -> AsyncIterator[str]:
+        index = 0
+        while True:
+            while index < len(self.chunks):
+                yield self.chunks[index]
+                index += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            self.changed.clear()
+            await self.changed.wait()
+
+
+class PromptCache:
+    """
+    Exact-match LRU/TTL cache of Sayory answers, keyed on the normalized prompt (case and
+    whitespace folded) and the model parameters.
+
+    Concurrent identical requests are coalesced: the first one starts the upstream call,
+    the others follow its stream. The upstream call runs in its own task, so it completes
+    (and is cached) even if the socket that started it goes away.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: "OrderedDict[str, Tuple[float, str, float]]" = OrderedDict()
+        self.in_flight: Dict[str, SharedStream] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.saved_seconds = 0.0
+
+    @staticmethod
+    def key(prompt: str, params: dict) -> str:
+        raw = json.dumps({"prompt": normalize_prompt(prompt), **params}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[str, float]]:
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self.entries.pop(key, None)
+            return None
+        self.entries.move_to_end(key)
+        return entry[1], entry[2]
+
+    def put(self, key: str, text: str, duration: float):
+        self.entries[key] = (time.monotonic() + self.ttl, text, duration)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    async def stream(self, prompt: str, params: dict,
+                     produce: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        """
+        Stream the answer to `prompt`: from the cache, from an identical request already in
+        flight, or from a new upstream call made with `produce()`.
+        """
+        key = self.key(prompt, params)
+        cached = self.get(key)
+        if cached is not None:
+            self.hits += 1
+            self.saved_seconds += cached[1]
+            yield cached[0]
+            return
+
+        shared = self.in_flight.get(key)
+        if shared is not None:
+            self.coalesced += 1
+            shared.followers += 1
+        else:
+            self.misses += 1
+            shared = self.in_flight[key] = SharedStream()
+            shared.task = asyncio.create_task(self._produce(key, shared, produce))
+
+        async for chunk in shared.follow():
+            yield chunk
+
+    async def _produce(self, key: str, shared: SharedStream, produce: Callable[[], AsyncIterator[str]]):
+        started = time.monotonic()
+        try:
+            async for chunk in produce():
+                shared.append(chunk)
+        except Exception as e:
+            # Failures are not cached; every follower gets the error
+            logger.error(f"Error in upstream Sayory call: {e}", exc_info=True)
+            shared.finish(e)
+        else:
+            shared.duration = time.monotonic() - started
+            self.put(key, "".join(shared.chunks), shared.duration)
+            # Each follower beyond the first saved one upstream call of this length
+            self.saved_seconds += shared.duration * shared.followers
+            shared.finish()
+        finally:
+            if not shared.done:
+                # Cancelled (shutdown): release the followers instead of leaving them waiting
+                shared.finish(RuntimeError("Upstream Sayory call was cancelled"))
+            if self.in_flight.get(key) is shared:
+                del self.in_flight[key]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "enabled": settings.sayory_cache_enabled,
+            "size": len(self.entries),
+            "in_flight": len(self.in_flight),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_rate": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+            "saved_seconds": round(self.saved_seconds, 3),
+        }
+
+
+prompt_cache = PromptCache(settings.sayory_cache_size, settings.sayory_cache_ttl)
@@ -1,40 +1,93 @@
 
 
+from typing import AsyncIterator
 from openai import AsyncOpenAI
 from app.config import settings
+from app.AI.fake import FakeChatClient
+from app.AI.prompt_cache import prompt_cache
+from app.metrics import SAYORY_CALLS
 
 sayori_key=settings.openai_api_key
 
-client = AsyncOpenAI(
-    api_key=sayori_key
-)
+client = None
+
+
+def get_client():
+    """
+    The chat client selected by `settings.sayory_backend`: "openai" (optionally pointed
+    at a compatible local server with `openai_base_url`) or the offline "fake".
+    """
+    global client
+    if client is None:
+        if settings.sayory_backend == "fake":
+            client = FakeChatClient()
+        else:
+            client = AsyncOpenAI(api_key=sayori_key, base_url=settings.openai_base_url)
+    return client
+
 
 instruction = "Ти асистент в менеджері і твоє ім'я saory далі буде повідомлення від користувача:  "
 instruction_2 = " Твоя відповідь не повинна перевищувати 600 символів."
-async def ask_to_gpt(ask_to_chat: str) -> str:
+fallback_reply = "Sorry, I couldn't process your request."
+
+
+def completion_params() -> dict:
+    return dict(
+        model=settings.sayory_model,
+        temperature=1,
+        max_tokens=256,
+        top_p=1,
+        frequency_penalty=0.0,
+        presence_penalty=0.0,
+    )
+
+
+async def stream_upstream(ask_to_chat: str) -> AsyncIterator[str]:
+    """
+    Stream one completion for a user message from the chat client.
+    """
     try:
-        chat_completion = await client.chat.completions.create(
+        stream = await get_client().chat.completions.create(
             messages=[
                 {
                     "role": "user",
                     "content": instruction + ask_to_chat + instruction_2,
                 }
             ],
-            model="gpt-4o-mini",
-            temperature=1,
-            max_tokens=256,
-            top_p=1,
-            frequency_penalty=0.0,
-            presence_penalty=0.0,
-            n=2
+            stream=True,
+            **completion_params()
         )
-        response_1 = chat_completion.choices[0].model_dump()
-        response_1 = response_1["message"]["content"]
-        response_2 = chat_completion.choices[1].model_dump()
-        response_2 = response_2["message"]["content"]
-    
-        response = [response_1, response_2]
-        return response
-    
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            content = chunk.choices[0].delta.content
+            if content:
+                yield content
+    except Exception:
+        SAYORY_CALLS.inc("error")
+        raise
+    SAYORY_CALLS.inc("ok")
+
+
+async def stream_reply(ask_to_chat: str) -> AsyncIterator[str]:
+    """
+    Stream the answer to a user message, yielding the text chunks as they arrive.
+
+    Short prompts go through `prompt_cache` (unless `sayory_cache_enabled` is off): a
+    repeated prompt is answered from the cache and identical concurrent prompts share
+    one upstream call.
+    """
+    if not settings.sayory_cache_enabled or len(ask_to_chat) > settings.sayory_cache_max_prompt:
+        async for part in stream_upstream(ask_to_chat):
+            yield part
+        return
+
+    async for part in prompt_cache.stream(ask_to_chat, completion_params(), lambda: stream_upstream(ask_to_chat)):
+        yield part
+
+
+async def ask_to_gpt(ask_to_chat: str) -> str:
+    try:
+        return "".join([part async for part in stream_reply(ask_to_chat)])
     except Exception as e:
-        return "Sorry, I couldn't process your request."
+        return fallback_reply
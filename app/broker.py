@@ -0,0 +1,266 @@
+import asyncio
+import contextvars
+import logging
+from typing import Awaitable, Callable, Dict, Optional, Set
+
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[str], Awaitable[None]]
+
+
+def conversation_channel(user_id: int, peer_id: int) -> str:
+    """
+    Broker channel of the conversation between two users, the same for both directions.
+    """
+    low, high = sorted((user_id, peer_id))
+    return f"pm_{low}_{high}"
+
+
+def inbox_channel(user_id: int) -> str:
+    """
+    Broker channel of the inbox updates of one user, subscribed while the user has sockets.
+    """
+    return f"pm_inbox_{user_id}"
+
+
+class Broker:
+    """
+    Publish/subscribe transport used by ConnectionManagerPrivate to fan messages out
+    to every worker that holds a socket of the conversation.
+
+    Each worker subscribes to the channels of the conversations it has sockets for;
+    `publish` delivers the payload to the handlers of all subscribed workers, including
+    the publishing one.
+    """
+
+    # Payloads leave the process, so they must not carry message plaintext
+    external = True
+
+    def __init__(self):
+        self.handlers: Dict[str, Handler] = {}
+        self.channel_queues: Dict[str, asyncio.Queue] = {}
+        self.channel_tasks: Dict[str, asyncio.Task] = {}
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        for channel in list(self.channel_tasks):
+            self._stop_channel(channel)
+
+    async def publish(self, channel: str, payload: str):
+        raise NotImplementedError
+
+    async def subscribe(self, channel: str, handler: Handler):
+        self.handlers[channel] = handler
+
+    async def unsubscribe(self, channel: str):
+        self.handlers.pop(channel, None)
+
+    async def dispatch(self, channel: str, payload: str):
+        handler = self.handlers.get(channel)
+        if handler is None:
+            return
+        try:
+            await handler(payload)
+        except Exception as e:
+            logger.error(f"Error delivering broker message on {channel}: {e}", exc_info=True)
+
+    def enqueue(self, channel: str, payload: str):
+        """
+        Hand a received payload to the dispatch task of its channel. Channels are
+        dispatched independently, so one slow conversation does not hold up the others.
+        """
+        queue = self.channel_queues.get(channel)
+        if queue is not None:
+            queue.put_nowait(payload)
+
+    def _start_channel(self, channel: str):
+        if channel not in self.channel_tasks:
+            queue = self.channel_queues[channel] = asyncio.Queue()
+            # Outlive the command that happened to start them (and its profile)
+            self.channel_tasks[channel] = asyncio.create_task(self._channel_loop(channel, queue),
+                                                              context=contextvars.Context())
+
+    def _stop_channel(self, channel: str):
+        self.channel_queues.pop(channel, None)
+        task = self.channel_tasks.pop(channel, None)
+        if task is not None:
+            task.cancel()
+
+    async def _channel_loop(self, channel: str, queue: asyncio.Queue):
+        while True:
+            payload = await queue.get()
+            await self.dispatch(channel, payload)
+
+
+class InMemoryHub:
+    """
+    Stands in for the external server: brokers sharing one hub behave like workers
+    connected to the same Postgres/Redis, which makes the multi-worker path testable.
+    """
+
+    def __init__(self):
+        self.channels: Dict[str, Set["InMemoryBroker"]] = {}
+
+
+class InMemoryBroker(Broker):
+    """
+    Single-process backend, handlers are awaited inline by `publish`.
+    """
+
+    external = False
+
+    def __init__(self, hub: Optional[InMemoryHub] = None):
+        super().__init__()
+        self.hub = hub or InMemoryHub()
+
+    async def publish(self, channel: str, payload: str):
+        for broker in list(self.hub.channels.get(channel, ())):
+            await broker.dispatch(channel, payload)
+
+    async def subscribe(self, channel: str, handler: Handler):
+        await super().subscribe(channel, handler)
+        self.hub.channels.setdefault(channel, set()).add(self)
+
+    async def unsubscribe(self, channel: str):
+        await super().unsubscribe(channel)
+        subscribers = self.hub.channels.get(channel)
+        if subscribers is not None:
+            subscribers.discard(self)
+            if not subscribers:
+                del self.hub.channels[channel]
+
+    async def close(self):
+        for channel in list(self.handlers):
+            await self.unsubscribe(channel)
+
+
+class PostgresBroker(Broker):
+    """
+    LISTEN/NOTIFY backend. One connection listens on the conversation channels, a small
+    pool publishes.
+    """
+
+    # Postgres rejects NOTIFY payloads of 8000 bytes or more
+    max_payload = 7999
+
+    def __init__(self, dsn: str):
+        super().__init__()
+        self.dsn = dsn
+        self.listener = None
+        self.pool = None
+        self.lock = asyncio.Lock()
+
+    async def start(self):
+        import asyncpg
+
+        async with self.lock:
+            if self.listener is not None:
+                return
+            self.listener = await asyncpg.connect(self.dsn)
+            self.pool = await asyncpg.create_pool(self.dsn, min_size=1, max_size=4)
+
+    async def close(self):
+        await super().close()
+        if self.listener is not None:
+            await self.listener.close()
+            self.listener = None
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    async def publish(self, channel: str, payload: str):
+        if len(payload.encode()) > self.max_payload:
+            raise ValueError(f"Payload of {len(payload.encode())} bytes is too large for NOTIFY on {channel}")
+        await self.start()
+        await self.pool.execute("SELECT pg_notify($1, $2)", channel, payload)
+
+    async def subscribe(self, channel: str, handler: Handler):
+        await self.start()
+        await super().subscribe(channel, handler)
+        self._start_channel(channel)
+        async with self.lock:
+            await self.listener.add_listener(channel, self._on_notify)
+
+    async def unsubscribe(self, channel: str):
+        await super().unsubscribe(channel)
+        self._stop_channel(channel)
+        if self.listener is not None:
+            async with self.lock:
+                await self.listener.remove_listener(channel, self._on_notify)
+
+    def _on_notify(self, connection, pid, channel, payload):
+        self.enqueue(channel, payload)
+
+
+class RedisBroker(Broker):
+    """
+    Redis pub/sub backend, requires the optional `redis` package.
+    """
+
+    def __init__(self, url: str):
+        super().__init__()
+        try:
+            import redis.asyncio as aioredis
+        except ImportError:
+            raise RuntimeError("The redis broker backend requires the 'redis' package")
+        self.redis = aioredis.from_url(url)
+        self.pubsub = self.redis.pubsub()
+        self.reader: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self.reader is None:
+            self.reader = asyncio.create_task(self._read_loop(), context=contextvars.Context())
+
+    async def close(self):
+        await super().close()
+        if self.reader is not None:
+            self.reader.cancel()
+            self.reader = None
+        await self.pubsub.close()
+        await self.redis.close()
+
+    async def publish(self, channel: str, payload: str):
+        await self.redis.publish(channel, payload)
+
+    async def subscribe(self, channel: str, handler: Handler):
+        await super().subscribe(channel, handler)
+        self._start_channel(channel)
+        await self.pubsub.subscribe(channel)
+        await self.start()
+
+    async def unsubscribe(self, channel: str):
+        await super().unsubscribe(channel)
+        self._stop_channel(channel)
+        await self.pubsub.unsubscribe(channel)
+
+    async def _read_loop(self):
+        while True:
+            if not self.pubsub.subscribed:
+                await asyncio.sleep(0.1)
+                continue
+            message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            if message is None:
+                continue
+            self.enqueue(message["channel"].decode(), message["data"].decode())
+
+
+def create_broker() -> Broker:
+    """
+    Build the broker selected by `settings.broker_backend` ("memory", "postgres" or "redis").
+    """
+    from app.config import settings
+
+    backend = settings.broker_backend
+    if backend == "memory":
+        return InMemoryBroker()
+    if backend == "postgres":
+        from app.database import ASINC_SQLALCHEMY_DATABASE_URL
+        dsn = settings.broker_url or ASINC_SQLALCHEMY_DATABASE_URL.replace("postgresql+asyncpg://", "postgresql://", 1)
+        return PostgresBroker(dsn)
+    if backend == "redis":
+        return RedisBroker(settings.broker_url or "redis://localhost:6379/0")
+    raise ValueError(f"Unknown broker backend: {backend}")
+
@@ -0,0 +1,129 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Hashable, Optional, Set
+from pydantic import TypeAdapter, ValidationError
+from app import schemas
+
+
+logger = logging.getLogger(__name__)
+
+PROTOCOL_VERSION = 1
+
+# Command types, as the keys of the legacy (unversioned) command objects
+COMMAND_TYPES = ("vote", "delete_message", "change_message", "read", "load_more", "send",
+                 "subscribe", "unsubscribe", "inbox")
+
+command_adapter = TypeAdapter(schemas.Command)
+
+
+class CommandError(ValueError):
+    pass
+
+
+def parse_command(data) -> schemas.CommandBase:
+    """
+    Parse one websocket frame into its command model, once.
+
+    Versioned frames name the command in `type` and carry its fields at the top level:
+    `{"v": 1, "type": "vote", "request_id": "r1", "message_id": 7, "dir": 1}`. Legacy frames
+    (`{"vote": {"message_id": 7, "dir": 1}}`) are read as version 1; they may carry a
+    `request_id` next to `peer_id`.
+
+    Raises:
+        CommandError: The frame is not a valid command (see `request_id_of` for the reply).
+    """
+    if not isinstance(data, dict):
+        raise CommandError("Command must be an object.")
+    if "type" not in data:
+        name = next((name for name in COMMAND_TYPES if name in data), None)
+        if name is None:
+            raise CommandError("Unknown command.")
+        payload = data[name] or {}
+        if not isinstance(payload, dict):
+            raise CommandError(f"Invalid {name} command.")
+        data = {**payload, "type": name, "peer_id": data.get("peer_id"), "request_id": data.get("request_id")}
+    elif data.get("v", PROTOCOL_VERSION) != PROTOCOL_VERSION:
+        raise CommandError(f"Unsupported protocol version, expected {PROTOCOL_VERSION}.")
+
+    try:
+        return command_adapter.validate_python(data)
+    except ValidationError as e:
+        error = e.errors()[0]
+        if error["type"] == "union_tag_invalid":
+            raise CommandError("Unknown command.")
+        location = ".".join(str(part) for part in error["loc"][1:])
+        raise CommandError(f"Invalid {data.get('type')} command: {location} {error['msg']}")
+
+
+def request_id_of(data) -> Optional[object]:
+    request_id = data.get("request_id") if isinstance(data, dict) else None
+    return request_id if isinstance(request_id, (str, int)) else None
+
+
+# Ordering key of the commands without a request id
+UNTAGGED = ("untagged",)
+
+
+def ordering_key(command: schemas.CommandBase, peer_id: int) -> Hashable:
+    """
+    Commands with the same key run in the order they were received; the others may run
+    concurrently. Within a conversation, messages are stored in the order they were sent
+    and the operations on one message apply in order, but a slow edit or history page
+    does not hold back the next send.
+
+    Commands without a request id (every legacy client) run one at a time, in order: their
+    replies cannot be told apart, so they must arrive in the order of the commands.
+    """
+    if command.request_id is None:
+        return UNTAGGED
+    if isinstance(command, schemas.VoteCommand):
+        return peer_id, "message", command.message_id
+    if isinstance(command, (schemas.DeleteMessageCommand, schemas.ChangeMessageCommand)):
+        return peer_id, "message", command.id
+    return peer_id, command.type
+
+
+class CommandDispatcher:
+    """
+    Runs the commands of one socket as tasks, at most `limit` at a time, so a client can
+    pipeline commands without waiting for each reply (replies carry its `request_id`).
+
+    Commands with the same ordering key are chained: each starts when the previous one is
+    done. When `limit` commands are in flight, `submit` waits, so the receive loop stops
+    reading and a client cannot queue unbounded work.
+    """
+
+    def __init__(self, limit: int):
+        self.slots = asyncio.Semaphore(limit)
+        self.tails: Dict[Hashable, asyncio.Task] = {}
+        self.tasks: Set[asyncio.Task] = set()
+
+    async def submit(self, key: Hashable, run: Callable[[], Awaitable[None]]):
+        await self.slots.acquire()
+        task = asyncio.create_task(self._run(self.tails.get(key), run))
+        self.tails[key] = task
+        self.tasks.add(task)
+        task.add_done_callback(lambda done: self._done(key, done))
+
+    @staticmethod
+    async def _run(previous: Optional[asyncio.Task], run: Callable[[], Awaitable[None]]):
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await run()
+        except Exception as e:
+            # Command handlers report their own errors; this is a socket that went away mid-reply
+            logger.warning(f"Websocket command failed: {e}")
+
+    def _done(self, key: Hashable, task: asyncio.Task):
+        self.tasks.discard(task)
+        if self.tails.get(key) is task:
+            del self.tails[key]
+        self.slots.release()
+
+    async def close(self):
+        """
+        Let the commands already received finish (a `send` the client made is stored).
+        """
+        if self.tasks:
+            await asyncio.wait(list(self.tasks))
@@ -1,3 +1,4 @@
+from typing import Optional
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -12,6 +13,84 @@ class Settings(BaseSettings):
     access_token_expire_minutes: int
     key_crypto: str
     openai_api_key: str
+    # Full async SQLAlchemy URL, overrides the DATABASE_* settings (the benchmarks use it
+    # for their aiosqlite stand-in)
+    database_url: Optional[str] = None
+
+    history_page_size: int = 50
+    history_page_max: int = 200
+    inbox_page_size: int = 50
+    inbox_page_max: int = 200
+    inbox_preview_length: int = 100
+
+    broker_backend: str = "memory"
+    broker_url: Optional[str] = None
+
+    write_batch_size: int = 100
+    write_flush_interval_ms: float = 2.0
+
+    user_cache_size: int = 10000
+    user_cache_ttl: float = 300.0
+
+    decrypt_cache_size: int = 50000
+    decrypt_offload_threshold: int = 64
+    decrypt_workers: int = 2
+
+    key_crypto_version: int = 1
+    key_crypto_previous: str = ""
+
+    db_pool_size: int = 10
+    db_max_overflow: int = 10
+    db_pool_timeout: float = 10.0
+    db_pool_recycle: int = 1800
+    db_pool_pre_ping: bool = True
+    db_pool_warm: int = 2
+
+    outbound_queue_size: int = 256
+    outbound_overflow_policy: str = "drop_oldest"
+    outbound_send_timeout: float = 10.0
+    # Commands of one socket running at once (see app.commands.CommandDispatcher)
+    ws_command_concurrency: int = 4
+
+    hot_cache_per_conversation: int = 200
+    hot_cache_budget_bytes: int = 64 * 1024 * 1024
+
+    sayory_user_id: int = 2
+    sayory_user_name: str = "SayOry"
+    sayory_avatar: str = "https://tygjaceleczftbswxxei.supabase.co/storage/v1/object/public/image_bucket/inne/image/girl_5.webp"
+    sayory_backend: str = "openai"
+    openai_base_url: Optional[str] = None
+    sayory_model: str = "gpt-4o-mini"
+    sayory_delta_interval_ms: float = 50.0
+    sayory_cache_enabled: bool = True
+    sayory_cache_size: int = 1000
+    sayory_cache_ttl: float = 3600.0
+    sayory_cache_max_prompt: int = 200
+
+    ai_concurrency: int = 4
+    ai_queue_size: int = 100
+    ai_queue_per_user: int = 3
+    ai_timeout: float = 60.0
+
+    metrics_enabled: bool = True
+
+    profiler_enabled: bool = False
+    profiler_threshold_ms: float = 500.0
+    profiler_sample_rate: float = 0.0
+    profiler_interval_ms: float = 5.0
+    profiler_file: str = "_log/profiles.log"
+    profiler_max_bytes: int = 10 * 1024 * 1024
+    profiler_backups: int = 5
+
+    log_level: str = "INFO"
+    log_file: str = "_log/app.log"
+    log_max_bytes: int = 50 * 1024 * 1024
+    log_backups: int = 5
+    log_queue_size: int = 10000
+    # "logger:sample_rate:max_per_second" items separated by commas (see app.logging_setup)
+    log_limits: str = "app.routers.private_messages:0.1:50,app.connection_manager:1:50,app.outbound:1:20"
+    # Write message plaintext (user messages, Sayory replies) into the logs; never in production
+    log_message_bodies: bool = False
 
     model_config = SettingsConfigDict(env_file = ".env")
 
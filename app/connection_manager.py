@@ -1,3 +1,5 @@
+import asyncio
+import contextvars
 from datetime import datetime
 import json
 import pytz
@@ -5,29 +7,181 @@ import logging
 from fastapi import WebSocket
 from app.database import async_session_maker
 from app import models, schemas
-from sqlalchemy import insert
-from typing import Dict, Optional, Tuple
-from app.routers.func_private import async_encrypt
+from typing import Dict, List, Optional, Set, Tuple
+from pydantic import BaseModel
+from app.routers.func_private import fetch_private_message, mark_messages_as_read
+from app.crypto import async_encrypt
+from app.broker import Broker, conversation_channel, create_broker, inbox_channel
+from app.config import settings
+from app.hot_cache import create_hot_conversations
+from app.metrics import DB_OPERATION_SECONDS, MESSAGES_SENT
+from app.inbox import InboxUpdate, refresh_unread
+from app.profiler import profiler
+from app.outbound import SLOW_CONSUMER_CLOSE_CODE, OutboundQueue
+from app.write_pipeline import message_writer
+from app.user_cache import user_cache
 
 
-# Налаштування логування
-logging.basicConfig(filename='_log/connect_manager.log', format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 
 
 
+# Broker channel carrying ids of users whose cached profile must be dropped
+USER_CHANNEL = "pm_users"
+# Broker channel carrying profiler settings (JSON), applied by every worker
+PROFILER_CHANNEL = "pm_profiler"
+
+
+class Connection:
+    """
+    One device socket of a user. A `/private/{receiver_id}` socket follows one conversation;
+    a multiplexed `/ws` socket follows any number of them (`peers`) and gets every frame
+    wrapped as `{"peer_id": ..., "frame": ...}`.
+    """
+
+    def __init__(self, websocket: WebSocket, user_id: int, multiplexed: bool, outbound: OutboundQueue):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.multiplexed = multiplexed
+        # Broadcasts are queued per socket and written by its own task, never inline
+        self.outbound = outbound
+        self.peers: Set[int] = set()
+
+    def wrap(self, text: str, peer_id: int) -> str:
+        if not self.multiplexed:
+            return text
+        return f'{{"peer_id":{peer_id},"frame":{text}}}'
+
+    def push(self, text: str, peer_id: int, key: Optional[Tuple[str, int]] = None):
+        # Coalescing keys are only unique within one conversation
+        self.outbound.put(self.wrap(text, peer_id), (peer_id, *key) if key else None)
+
+    def push_raw(self, text: str):
+        """
+        Queue a frame that is not about one conversation (inbox pages, protocol errors of
+        the multiplexed socket): sent as is, never wrapped.
+        """
+        self.outbound.put(text)
+
+    async def send_text(self, text: str, peer_id: int):
+        """
+        Reply to this socket only. Like broadcasts, replies go through the outbound queue
+        (never coalesced), so one writer task owns the socket and the slow-consumer policy
+        covers every frame; this returns as soon as the frame is queued.
+        """
+        self.push(text, peer_id)
+
+    async def send_json(self, data: dict, peer_id: int):
+        self.push(json.dumps(data, separators=(",", ":"), ensure_ascii=False, default=str), peer_id)
+
+
        # Connecting Private Messages     
 class ConnectionManagerPrivate:
-    def __init__(self):
-        self.active_connections: Dict[Tuple[int, int], WebSocket] = {}
+    def __init__(self, broker: Optional[Broker] = None):
+        # Every device socket of a user, on this worker
+        self.connections: Dict[int, Set[Connection]] = {}
+        # Messages and events travel through the broker so that sockets held by other
+        # workers receive them too; every worker subscribes to the conversations it serves.
+        self.broker = broker or create_broker()
+        self.channel_refs: Dict[str, int] = {}
+        # Recent messages of the conversations subscribed on this worker
+        self.hot = create_hot_conversations()
+        self.background_tasks: Set[asyncio.Task] = set()
+
+    async def start(self):
+        """
+        Subscribe to the user invalidation channel. Other services can publish a user id
+        there too (e.g. `NOTIFY pm_users, '42'` with the Postgres broker).
+        """
+        await self.broker.start()
+        await self.broker.subscribe(USER_CHANNEL, self._invalidate_local)
+        await self.broker.subscribe(PROFILER_CHANNEL, self._configure_profiler)
+        # Summaries of new messages are updated by the writer, in the insert transaction
+        message_writer.on_commit = self.publish_inbox
+
+    async def invalidate_user(self, user_id: int):
+        """
+        Drop a changed or blocked user from the profile cache of every worker.
+        """
+        await self.broker.publish(USER_CHANNEL, str(user_id))
 
-    async def connect(self, websocket: WebSocket, user_id: int, recipient_id: int):
+    @staticmethod
+    async def _invalidate_local(payload: str):
+        user_cache.invalidate(int(payload))
+
+    async def configure_profiler(self, config: schemas.ProfilerConfig):
+        """
+        Turn the slow-operation profiler on or off, or retune it, on every worker.
+        """
+        await self.broker.publish(PROFILER_CHANNEL, config.model_dump_json(exclude_none=True))
+
+    @staticmethod
+    async def _configure_profiler(payload: str):
+        profiler.configure(**json.loads(payload))
+
+    async def connect(self, websocket: WebSocket, user_id: int, recipient_id: Optional[int] = None) -> Connection:
+        """
+        Register a device socket of `user_id`. With `recipient_id` it follows that single
+        conversation, without it the socket is multiplexed and follows what it subscribes to.
+        Other devices of the same user keep their own sockets.
+        """
         await websocket.accept()
-        self.active_connections[(user_id, recipient_id)] = websocket
+        outbound = OutboundQueue(websocket, settings.outbound_queue_size, settings.outbound_overflow_policy,
+                                 settings.outbound_send_timeout, self._close_slow_consumer)
+        connection = Connection(websocket, user_id, recipient_id is None, outbound)
+        outbound.start()
+        if user_id not in self.connections:
+            # One inbox subscription per user and worker, whatever the number of devices
+            await self.broker.subscribe(inbox_channel(user_id), self._deliver_inbox)
+        self.connections.setdefault(user_id, set()).add(connection)
+        if recipient_id is not None:
+            await self.subscribe(connection, recipient_id)
+        return connection
+
+    async def disconnect(self, connection: Connection):
+        sockets = self.connections.get(connection.user_id)
+        if sockets is None or connection not in sockets:
+            return
+        sockets.discard(connection)
+        if not sockets:
+            del self.connections[connection.user_id]
+            await self.broker.unsubscribe(inbox_channel(connection.user_id))
+        connection.outbound.close()
+        for peer_id in list(connection.peers):
+            await self.unsubscribe(connection, peer_id)
 
-    async def disconnect(self, user_id: int, recipient_id: int):
-        self.active_connections.pop((user_id, recipient_id), None)
+    async def subscribe(self, connection: Connection, peer_id: int):
+        """
+        Follow the conversation with `peer_id` on `connection`. The broker channel of the
+        conversation is subscribed once per worker, however many sockets follow it.
+        """
+        if peer_id in connection.peers:
+            return
+        connection.peers.add(peer_id)
+        channel = conversation_channel(connection.user_id, peer_id)
+        if self.channel_refs.get(channel, 0) == 0:
+            self.hot.open(models.conversation_key(connection.user_id, peer_id))
+            await self.broker.subscribe(channel, self._deliver)
+        self.channel_refs[channel] = self.channel_refs.get(channel, 0) + 1
+
+    async def unsubscribe(self, connection: Connection, peer_id: int):
+        if peer_id not in connection.peers:
+            return
+        connection.peers.discard(peer_id)
+        channel = conversation_channel(connection.user_id, peer_id)
+        self.channel_refs[channel] -= 1
+        if self.channel_refs[channel] == 0:
+            del self.channel_refs[channel]
+            await self.broker.unsubscribe(channel)
+            # Nothing is delivered for the conversation any more, so its buffer would go stale
+            self.hot.drop(models.conversation_key(connection.user_id, peer_id))
+
+    def followers(self, user_id: int, peer_id: int) -> List[Connection]:
+        """
+        Sockets of `user_id` on this worker that follow the conversation with `peer_id`.
+        """
+        return [connection for connection in self.connections.get(user_id, ()) if peer_id in connection.peers]
 
         
     async def send_private_all(self, message: Optional[str], file: Optional[str],
@@ -36,12 +190,20 @@ class ConnectionManagerPrivate:
                                avatar: str, id_return: Optional[int],
                                is_read: bool):
         
-        sender_to_recipient = (sender_id, receiver_id)
-        recipient_to_sender = (receiver_id, sender_id)
-        
+        async with profiler.profile("send_private_all", user_id=sender_id, peer_id=receiver_id,
+                                    has_file=file is not None):
+            return await self._send_private_all(message, file, sender_id, receiver_id, user_name, verified,
+                                                avatar, id_return, is_read)
+
+    async def _send_private_all(self, message: Optional[str], file: Optional[str],
+                                sender_id: int, receiver_id: int,
+                                user_name: str, verified: bool,
+                                avatar: str, id_return: Optional[int],
+                                is_read: bool):
         timezone = pytz.timezone('UTC')
         current_time_utc = datetime.now(timezone).isoformat()
         message_id = await self.add_private_all_to_database(sender_id, receiver_id, message, file, id_return, is_read)
+        MESSAGES_SENT.inc()
 
         # SocketModel
         socket_message = schemas.SocketModel(
@@ -61,26 +223,199 @@ class ConnectionManagerPrivate:
 
         # Серіалізація даних моделі у JSON
         message_json = socket_message.model_dump_json()
+        await self._publish(sender_id, receiver_id, message_json, ref=("message", message_id), message_id=message_id)
+        return message_id
 
+    async def mark_read(self, user_id: int, peer_id: int, message_id: Optional[int] = None):
+        """
+        Move the read watermark of `user_id` and notify both participants when it changed.
+        The watermark and the unread counter of the summary change in one transaction.
+        """
+        async with async_session_maker() as session:
+            last_read_id = await mark_messages_as_read(session, user_id, peer_id, message_id)
+            if last_read_id is None:
+                return
+            inbox = await refresh_unread(session, user_id, peer_id)
+            await session.commit()
+        await self.send_private_event(
+            schemas.ReadReceiptEvent(user_id=user_id, last_read_id=last_read_id), user_id, peer_id
+        )
+        await self.publish_inbox(inbox)
+
+    async def publish_inbox(self, updates: List[InboxUpdate]):
+        """
+        Publish changed conversation summaries to the inbox channels of their owners. The
+        events carry ids and counters only, so they can travel over an external broker.
+        """
+        for user_id, event in updates:
+            await self.broker.publish(inbox_channel(user_id),
+                                      json.dumps({"user_id": user_id, "data": event.model_dump_json()}))
+
+    async def send_private_event(self, event: BaseModel, sender_id: int, receiver_id: int):
+        """
+        Push a delta event (edit, delete, vote change) to both participants of a conversation.
+        """
+        ref = ("message_updated", event.id) if isinstance(event, schemas.MessageUpdatedEvent) else None
+        await self._publish(sender_id, receiver_id, event.model_dump_json(), ref=ref, key=self._coalesce_key(event))
+
+    def recent_messages(self, user_id: int, peer_id: int,
+                        last_seen_id: Optional[int] = None) -> Optional[List[schemas.SocketModel]]:
+        """
+        The newest history page of a conversation (or only the messages after `last_seen_id`),
+        newest first, from memory. None when the buffer cannot answer and the caller must
+        read the database.
+        """
+        key = models.conversation_key(user_id, peer_id)
+        if last_seen_id is None:
+            return self.hot.latest(key, settings.history_page_size)
+        return self.hot.since(key, last_seen_id, settings.history_page_max)
+
+    def has_unread(self, user_id: int, peer_id: int) -> Optional[bool]:
+        """
+        Whether `user_id` has unread messages from `peer_id`, from memory; None when the
+        buffer of the conversation cannot tell.
+        """
+        return self.hot.has_unread(models.conversation_key(user_id, peer_id), user_id)
+
+    def remember_page(self, user_id: int, peer_id: int, messages: List[schemas.SocketModel],
+                      limit: int, last_seen_id: Optional[int] = None):
+        """
+        Seed the buffer of a conversation with the newest page (or the messages after
+        `last_seen_id`) just read from the database with `limit`.
+        """
+        if len(messages) < limit:
+            floor = last_seen_id or 0
+        else:
+            floor = messages[-1].id - 1
+        self.hot.seed(models.conversation_key(user_id, peer_id), messages, floor)
+
+    def push_local(self, event: BaseModel, user_id: int, peer_id: int):
+        """
+        Push an ephemeral event (e.g. `ai_delta`) to the sockets of `user_id` on this worker
+        only. It skips the broker: nothing is stored that another worker could resolve, and
+        plaintext must not travel over an external broker.
+        """
+        text = event.model_dump_json()
+        for connection in self.followers(user_id, peer_id):
+            connection.push(text, peer_id)
+
+    @staticmethod
+    def _coalesce_key(event: BaseModel) -> Optional[Tuple[str, int]]:
+        """
+        Events that carry a current state (not a change) replace an older queued event of
+        the same target when a socket falls behind.
+        """
+        if isinstance(event, schemas.VoteChangedEvent):
+            return ("vote", event.message_id)
+        if isinstance(event, schemas.MessageUpdatedEvent):
+            return ("edit", event.id)
+        if isinstance(event, schemas.ReadReceiptEvent):
+            return ("read", event.user_id)
+        return None
+
+    async def _publish(self, sender_id: int, receiver_id: int, text: str,
+                       ref: Optional[Tuple[str, int]] = None, message_id: Optional[int] = None,
+                       key: Optional[Tuple[str, int]] = None):
+        """
+        Publish a frame to the conversation channel. Frames that contain message plaintext
+        (`ref` set) are not put on an external broker: subscribers get only the reference
+        and load the message from the database themselves.
+        """
+        envelope = {"sender_id": sender_id, "receiver_id": receiver_id, "message_id": message_id,
+                    "data": text, "key": key}
+        if ref is not None and self.broker.external:
+            envelope.update(data=None, ref=ref)
+        await self.broker.publish(conversation_channel(sender_id, receiver_id), json.dumps(envelope))
 
-        if sender_to_recipient in self.active_connections:
-            await self.active_connections[sender_to_recipient].send_text(message_json)
+    async def _deliver(self, payload: str):
+        """
+        Broker handler: send a published message or event to the sockets of this worker.
+        """
+        envelope = json.loads(payload)
+        sender_id, receiver_id = envelope["sender_id"], envelope["receiver_id"]
+        # Every device of both participants, each tagged with the other participant
+        targets = [(connection, receiver_id) for connection in self.followers(sender_id, receiver_id)]
+        if receiver_id != sender_id:
+            targets += [(connection, sender_id) for connection in self.followers(receiver_id, sender_id)]
+        key = models.conversation_key(sender_id, receiver_id)
+        if not targets and not self.hot.is_open(key):
+            return
 
-        if recipient_to_sender in self.active_connections:
-            await self.active_connections[recipient_to_sender].send_text(message_json)
+        text = envelope["data"]
+        if text is None:
+            text = await self._resolve(*envelope["ref"])
+            if text is None:
+                return
+        if envelope["message_id"] is not None:
+            self.hot.add(key, schemas.SocketModel.model_validate_json(text))
+        else:
+            self.hot.apply(key, json.loads(text))
+        coalesce_key = tuple(envelope["key"]) if envelope.get("key") else None
+        for connection, peer_id in targets:
+            connection.push(text, peer_id, coalesce_key)
+
+        # A new message delivered to an open conversation of the recipient counts as read;
+        # the watermark is written in the background to keep the DB off the delivery path
+        if envelope["message_id"] is not None and self.followers(receiver_id, sender_id):
+            task = asyncio.create_task(self.mark_read(receiver_id, sender_id, envelope["message_id"]),
+                                       context=contextvars.Context())
+            self.background_tasks.add(task)
+            task.add_done_callback(self.background_tasks.discard)
+
+    async def _deliver_inbox(self, payload: str):
+        """
+        Broker handler: send an `inbox_updated` event to the multiplexed sockets of its user.
+        Per-conversation sockets only carry their own conversation and do not get it.
+        """
+        envelope = json.loads(payload)
+        text = envelope["data"]
+        peer_id = json.loads(text)["peer_id"]
+        for connection in self.connections.get(envelope["user_id"], ()):
+            if connection.multiplexed:
+                # Only the latest state of a conversation matters to a socket that fell behind
+                connection.push(text, peer_id, ("inbox", peer_id))
+
+    def _close_slow_consumer(self, queue: OutboundQueue):
+        """
+        Close a socket whose outbound queue overflowed; its receive loop then disconnects it.
+        """
+        logger.warning(f"Closing slow consumer after {queue.dropped} dropped frames")
+        task = asyncio.create_task(self._close_socket(queue.websocket))
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+    @staticmethod
+    async def _close_socket(websocket: WebSocket):
+        try:
+            await asyncio.wait_for(websocket.close(code=SLOW_CONSUMER_CLOSE_CODE), settings.outbound_send_timeout)
+        except Exception as e:
+            logger.info(f"Error closing slow consumer: {e}")
+
+    def outbound_stats(self) -> list:
+        """
+        Queue depth and counters of every socket of this worker.
+        """
+        return [dict(user_id=connection.user_id, peers=sorted(connection.peers), **connection.outbound.stats())
+                for sockets in self.connections.values() for connection in sockets]
+
+    @staticmethod
+    async def _resolve(kind: str, message_id: int) -> Optional[str]:
+        async with async_session_maker() as session:
+            message = await fetch_private_message(session, message_id)
+        if message is None:
+            return None
+        if kind == "message_updated":
+            return schemas.MessageUpdatedEvent(id=message.id, message=message.message).model_dump_json()
+        return message.model_dump_json()
         
 
     @staticmethod
+    @DB_OPERATION_SECONDS.time("add_message")
     async def add_private_all_to_database(sender_id: int, receiver_id: int,
                                           message: Optional[str], file: Optional[str],
                                           id_return: Optional[int], is_read: bool):
         encrypt_message = await async_encrypt(message)
-        async with async_session_maker() as session:
-            stmt = insert(models.PrivateMessage).values(sender_id=sender_id, receiver_id=receiver_id,message=encrypt_message,
-                                                        is_read=is_read, fileUrl=file, id_return=id_return
-                                                        )
-            result = await session.execute(stmt)
-            await session.commit()
-            
-            message_id = result.inserted_primary_key[0]
-            return message_id
\ No newline at end of file
+        # Batched with concurrent sends into one INSERT and one COMMIT
+        return await message_writer.submit(dict(sender_id=sender_id, receiver_id=receiver_id,
+                                                conversation_id=models.conversation_key(sender_id, receiver_id),
+                                                message_data=encrypt_message, is_read=is_read, fileUrl=file, id_return=id_return))
@@ -0,0 +1,203 @@
+import asyncio
+import base64
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple, Union
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+from app.config import settings
+from app.metrics import CRYPTO_SECONDS, DECRYPT_FAILURES
+
+
+logger = logging.getLogger(__name__)
+
+Stored = Union[str, bytes, None]
+
+
+def load_keys() -> Dict[int, Fernet]:
+    """
+    The current key (`key_crypto`, as `key_crypto_version`) and the retired ones that old
+    rows may still use (`key_crypto_previous`, "version:key" pairs separated by commas).
+    """
+    keys = {settings.key_crypto_version: Fernet(settings.key_crypto)}
+    for item in filter(None, (part.strip() for part in settings.key_crypto_previous.split(","))):
+        version, key = item.split(":", 1)
+        keys[int(version)] = Fernet(key)
+    for version in keys:
+        if not 0 < version < 256:
+            raise ValueError(f"Key version {version} does not fit the one-byte header")
+    return keys
+
+
+# Ініціалізація шифрувальника
+keys = load_keys()
+key_version = settings.key_crypto_version
+cipher = keys[key_version]
+# Legacy rows do not say which key they use
+legacy_cipher = MultiFernet([cipher] + [key for version, key in keys.items() if version != key_version])
+
+# private_messages.message_data: format byte, key version byte, then the raw Fernet token
+# (not base64) - about 45% smaller than the legacy text column
+FORMAT_VERSION = 1
+HEADER_SIZE = 2
+
+# Legacy rows in private_messages.message hold standard base64 of a Fernet token. Every
+# Fernet token starts with the version byte 0x80 ("gAAAAA"), which is "Z0FBQUFB" once
+# base64-encoded again, so a prefix check replaces a full decode to sniff the format.
+ENCRYPTED_PREFIX = "Z0FBQUFB"
+
+
+def encrypt(data: Optional[str]) -> Optional[bytes]:
+    """
+    Encrypt a message for the `message_data` column.
+    """
+    if data is None:
+        return None
+
+    token = cipher.encrypt(data.encode())
+    return bytes((FORMAT_VERSION, key_version)) + base64.urlsafe_b64decode(token)
+
+
+def decrypt_bytes(stored: bytes) -> Optional[str]:
+    if len(stored) <= HEADER_SIZE or stored[0] != FORMAT_VERSION:
+        DECRYPT_FAILURES.inc()
+        return None
+
+    key = keys.get(stored[1])
+    if key is None:
+        logger.error(f"Message encrypted with unknown key version {stored[1]}")
+        DECRYPT_FAILURES.inc()
+        return None
+
+    try:
+        return key.decrypt(base64.urlsafe_b64encode(stored[HEADER_SIZE:])).decode('utf-8')
+    except InvalidToken:
+        DECRYPT_FAILURES.inc()
+        return None
+
+
+def decrypt_legacy(encoded_data: str) -> Optional[str]:
+    # Rows written before encryption (and old edits) hold plaintext
+    if not encoded_data.startswith(ENCRYPTED_PREFIX):
+        return encoded_data
+
+    try:
+        return legacy_cipher.decrypt(base64.b64decode(encoded_data)).decode('utf-8')
+    except (InvalidToken, ValueError):
+        DECRYPT_FAILURES.inc()
+        return None
+
+
+def decrypt(stored: Stored) -> Optional[str]:
+    """
+    Decrypt a stored message: `message_data` bytes, or the legacy `message` text.
+    """
+    if stored is None:
+        return None
+    if isinstance(stored, (bytes, memoryview)):
+        return decrypt_bytes(bytes(stored))
+    return decrypt_legacy(stored)
+
+
+def stored_message(message_data: Optional[bytes], message: Optional[str]) -> Stored:
+    """
+    The stored form of a row: new rows use `message_data`, old ones `message`.
+    """
+    return message_data if message_data is not None else message
+
+
+def needs_reencode(stored: Stored) -> bool:
+    if stored is None:
+        return False
+    if isinstance(stored, str):
+        return True
+    return len(stored) <= HEADER_SIZE or stored[0] != FORMAT_VERSION or stored[1] != key_version
+
+
+@CRYPTO_SECONDS.time("encrypt")
+async def async_encrypt(data: Optional[str]) -> Optional[bytes]:
+    return encrypt(data)
+
+
+@CRYPTO_SECONDS.time("decrypt")
+async def async_decrypt(stored: Stored) -> Optional[str]:
+    return decrypt(stored)
+
+
+class DecryptCache:
+    """
+    Bounded LRU cache of decrypted plaintext.
+
+    Keyed by message id *and* stored ciphertext, so an edit made on another worker can
+    never be served stale; `invalidate` frees the entry as soon as it is known to be dead.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries: "OrderedDict[int, Tuple[Stored, Optional[str]]]" = OrderedDict()
+
+    def get(self, message_id: int, encoded_data: Stored) -> Tuple[bool, Optional[str]]:
+        entry = self.entries.get(message_id)
+        if entry is None or entry[0] != encoded_data:
+            return False, None
+        self.entries.move_to_end(message_id)
+        return True, entry[1]
+
+    def put(self, message_id: int, encoded_data: Stored, plaintext: Optional[str]):
+        self.entries[message_id] = (encoded_data, plaintext)
+        self.entries.move_to_end(message_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, message_id: int):
+        self.entries.pop(message_id, None)
+
+
+decrypt_cache = DecryptCache(settings.decrypt_cache_size)
+decrypt_executor = ThreadPoolExecutor(max_workers=settings.decrypt_workers, thread_name_prefix="decrypt")
+
+
+def decrypt_batch(encoded: List[Stored]) -> List[Optional[str]]:
+    return [decrypt(item) for item in encoded]
+
+
+@CRYPTO_SECONDS.time("decrypt_batch")
+async def decrypt_many(items: List[Tuple[int, Stored]]) -> List[Optional[str]]:
+    """
+    Decrypt a batch of `(message_id, stored_message)` pairs, in order.
+
+    Cached plaintext is reused; the rest is decrypted inline when there is little of it,
+    otherwise in chunks on `decrypt_executor` so a big history load does not hold the
+    event loop for the other sockets of the process.
+    """
+    results: List[Optional[str]] = [None] * len(items)
+    missing = []
+    for index, (message_id, encoded_data) in enumerate(items):
+        if encoded_data is None:
+            continue
+        found, plaintext = decrypt_cache.get(message_id, encoded_data)
+        if found:
+            results[index] = plaintext
+        else:
+            missing.append(index)
+
+    if not missing:
+        return results
+
+    encoded = [items[index][1] for index in missing]
+    if len(missing) < settings.decrypt_offload_threshold:
+        decrypted = decrypt_batch(encoded)
+    else:
+        loop = asyncio.get_running_loop()
+        chunk = settings.decrypt_offload_threshold
+        parts = await asyncio.gather(*[
+            loop.run_in_executor(decrypt_executor, decrypt_batch, encoded[start:start + chunk])
+            for start in range(0, len(encoded), chunk)
+        ])
+        decrypted = [plaintext for part in parts for plaintext in part]
+
+    for index, plaintext in zip(missing, decrypted):
+        message_id, encoded_data = items[index]
+        results[index] = plaintext
+        decrypt_cache.put(message_id, encoded_data, plaintext)
+    return results
@@ -1,18 +1,46 @@
+import asyncio
 import time
+from sqlalchemy import text
 from sqlalchemy.orm import sessionmaker, declarative_base
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from typing import AsyncGenerator
 from .config import settings
-import psycopg2
-from psycopg2.extras import RealDictCursor
+from .metrics import DB_CHECKOUT_SECONDS
+from .profiler import profiler
 
 
 Base = declarative_base()
         
         
-ASINC_SQLALCHEMY_DATABASE_URL = f'postgresql+asyncpg://{settings.database_name}:{settings.database_password}@{settings.database_hostname}:{settings.database_port}/{settings.database_username}'
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """
+    Queue pool that records how long each checkout waited (`pm_db_pool_checkout_seconds`).
+    """
 
-engine_asinc = create_async_engine(ASINC_SQLALCHEMY_DATABASE_URL)
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_CHECKOUT_SECONDS.observe(time.perf_counter() - started)
+
+
+ASINC_SQLALCHEMY_DATABASE_URL = settings.database_url or f'postgresql+asyncpg://{settings.database_name}:{settings.database_password}@{settings.database_hostname}:{settings.database_port}/{settings.database_username}'
+
+# Sessions are short-lived (one per websocket command), so a small pool serves many sockets
+engine_asinc = create_async_engine(
+    ASINC_SQLALCHEMY_DATABASE_URL,
+    pool_size=settings.db_pool_size,
+    max_overflow=settings.db_max_overflow,
+    pool_timeout=settings.db_pool_timeout,
+    pool_recycle=settings.db_pool_recycle,
+    pool_pre_ping=settings.db_pool_pre_ping,
+    # aiosqlite (the benchmark stand-in) would default to no pool at all
+    poolclass=TimedQueuePool,
+)
+# Statements are only recorded while a profiled operation runs (see app.profiler)
+profiler.instrument(engine_asinc)
 async_session_maker = sessionmaker(engine_asinc, class_=AsyncSession, expire_on_commit=False)
 
 
@@ -21,15 +49,37 @@ async def get_async_session() -> AsyncGenerator[AsyncSession, None]:
         yield session
 
 
-while True:   
-    try:
-        conn = psycopg2.connect(host=settings.database_hostname, database=settings.database_name, user=settings.database_username,
-                                password=settings.database_password, cursor_factory=RealDictCursor)
-        cursor = conn.cursor()
-        print("Database connection was successful")
-        break
+async def ping_database():
+    async with engine_asinc.connect() as connection:
+        await connection.execute(text("SELECT 1"))
+
+
+async def warm_pool(connections: int) -> int:
+    """
+    Open `connections` pool connections concurrently and return them to the pool, so the
+    first requests after startup do not pay for the connect. Called from the app lifespan;
+    importing this module never touches the database.
+
+    Returns:
+        int: The number of connections opened.
+    """
+    connections = min(connections, settings.db_pool_size)
+    if connections <= 0:
+        return 0
+
+    # Hold all of them at once, otherwise the pool hands the same connection back every time
+    await asyncio.gather(*[ping_database() for _ in range(connections)])
+    return connections
+
 
-    except Exception as error:
-            print('Conection to database failed')
-            print("Error:",  error)
-            time.sleep(2)
\ No newline at end of file
+def pool_status() -> dict:
+    """
+    Current state of the engine pool, as reported by the readiness endpoint.
+    """
+    pool = engine_asinc.pool
+    return {
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+    }
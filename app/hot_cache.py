@@ -0,0 +1,229 @@
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import List, Optional
+from app import schemas
+from app.config import settings
+
+
+def message_size(message: schemas.SocketModel) -> int:
+    """
+    Rough memory footprint of a buffered message, for the global budget.
+    """
+    return 400 + len(message.message or "") + len(message.fileUrl or "") + len(message.avatar) + len(message.user_name)
+
+
+class ConversationBuffer:
+    """
+    The most recent messages of one conversation, oldest first.
+
+    `floor` says how far back the buffer is complete: every message with an id above it is
+    here. It is None until the buffer has been seeded from the database after the broker
+    subscription, because messages published before that were never delivered to it.
+    """
+
+    def __init__(self):
+        self.messages: List[schemas.SocketModel] = []
+        self.ids: List[int] = []
+        self.floor: Optional[int] = None
+        self.size = 0
+
+    def insert(self, message: schemas.SocketModel, replace: bool = True) -> int:
+        index = bisect_left(self.ids, message.id)
+        if index < len(self.ids) and self.ids[index] == message.id:
+            if not replace:
+                return index
+            self.size -= message_size(self.messages[index])
+            self.messages[index] = message
+        else:
+            # Deliveries from different workers can arrive slightly out of id order
+            self.ids.insert(index, message.id)
+            self.messages.insert(index, message)
+        self.size += message_size(message)
+        return index
+
+    def evict_oldest(self):
+        message = self.messages.pop(0)
+        self.ids.pop(0)
+        self.size -= message_size(message)
+        if self.floor is not None:
+            self.floor = max(self.floor, message.id)
+
+    def reset(self):
+        self.messages, self.ids, self.floor, self.size = [], [], None, 0
+
+
+class HotConversations:
+    """
+    In-memory ring buffers of the most recent decrypted messages of the conversations this
+    worker has sockets for, so reconnects and `last_seen_id` resumes are served without
+    touching the database.
+
+    Buffers are created when a worker subscribes to a conversation channel and dropped when
+    it unsubscribes. The manager keeps them current from broker deliveries: new messages,
+    edits, deletes, votes and read receipts. Each buffer keeps at most `per_conversation`
+    messages; over `budget_bytes` in total, the least recently used buffers are emptied.
+    """
+
+    def __init__(self, per_conversation: int, budget_bytes: int):
+        self.per_conversation = per_conversation
+        self.budget_bytes = budget_bytes
+        self.buffers: "OrderedDict[int, ConversationBuffer]" = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def open(self, key: int):
+        if key not in self.buffers:
+            self.buffers[key] = ConversationBuffer()
+
+    def is_open(self, key: int) -> bool:
+        return key in self.buffers
+
+    def drop(self, key: int):
+        buffer = self.buffers.pop(key, None)
+        if buffer is not None:
+            self.size -= buffer.size
+
+    def seed(self, key: int, messages: List[schemas.SocketModel], floor: int):
+        """
+        Merge a page loaded from the database (newest first) that holds every message with
+        an id above `floor`.
+        """
+        buffer = self.buffers.get(key)
+        if buffer is None:
+            return
+        for message in messages:
+            # Never overwrite a copy that a delivery has updated since the page was read
+            self._insert(buffer, message, replace=False)
+        if buffer.floor is None or floor < buffer.floor:
+            buffer.floor = floor
+        self._trim(key, buffer)
+
+    def add(self, key: int, message: schemas.SocketModel):
+        buffer = self.buffers.get(key)
+        if buffer is None:
+            return
+        self._insert(buffer, message)
+        self._trim(key, buffer)
+
+    def apply(self, key: int, event: dict):
+        """
+        Apply a delta event to the buffered copies of its messages.
+        """
+        buffer = self.buffers.get(key)
+        if buffer is None or not buffer.messages:
+            return
+
+        kind = event.get("type")
+        if kind == "message_deleted":
+            index = self._find(buffer, event["id"])
+            if index is not None:
+                self.size -= message_size(buffer.messages[index])
+                buffer.size -= message_size(buffer.messages[index])
+                del buffer.messages[index]
+                del buffer.ids[index]
+        elif kind == "message_updated":
+            index = self._find(buffer, event["id"])
+            if index is not None:
+                self._replace(buffer, index, message=event["message"], edited=True)
+        elif kind == "vote_changed":
+            index = self._find(buffer, event["message_id"])
+            if index is not None:
+                self._replace(buffer, index, vote=event["vote"])
+        elif kind == "read_receipt":
+            # `receiver_id` of a SocketModel is its sender; the reader's incoming messages
+            # up to the watermark are no longer unread
+            for index, message in enumerate(buffer.messages):
+                if message.id > event["last_read_id"]:
+                    break
+                if message.is_read and message.receiver_id != event["user_id"]:
+                    self._replace(buffer, index, is_read=False)
+
+    def latest(self, key: int, limit: int) -> Optional[List[schemas.SocketModel]]:
+        """
+        The newest `limit` messages, newest first, or None when the buffer cannot tell.
+        """
+        buffer = self.buffers.get(key)
+        if buffer is None or buffer.floor is None or (len(buffer.messages) < limit and buffer.floor > 0):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.buffers.move_to_end(key)
+        return buffer.messages[::-1][:limit]
+
+    def since(self, key: int, after_id: int, limit: int) -> Optional[List[schemas.SocketModel]]:
+        """
+        The messages with an id above `after_id` (at most the newest `limit`), newest first,
+        or None when some of them may be missing from the buffer.
+        """
+        buffer = self.buffers.get(key)
+        if buffer is None or buffer.floor is None or buffer.floor > after_id:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.buffers.move_to_end(key)
+        start = bisect_left(buffer.ids, after_id + 1)
+        return buffer.messages[start:][::-1][:limit]
+
+    def has_unread(self, key: int, reader_id: int) -> Optional[bool]:
+        """
+        Whether `reader_id` has unread messages in the conversation, None when the buffer
+        cannot tell.
+        """
+        buffer = self.buffers.get(key)
+        if buffer is None or buffer.floor is None:
+            return None
+        for message in reversed(buffer.messages):
+            # `receiver_id` of a SocketModel is its sender. The watermark only moves forward,
+            # so if the newest incoming message is read, so are the older ones.
+            if message.receiver_id != reader_id:
+                return message.is_read
+        # No incoming message above the floor: only a complete conversation has none at all
+        return None if buffer.floor > 0 else False
+
+    def _find(self, buffer: ConversationBuffer, message_id: int) -> Optional[int]:
+        index = bisect_left(buffer.ids, message_id)
+        if index < len(buffer.ids) and buffer.ids[index] == message_id:
+            return index
+        return None
+
+    def _insert(self, buffer: ConversationBuffer, message: schemas.SocketModel, replace: bool = True):
+        before = buffer.size
+        buffer.insert(message, replace)
+        self.size += buffer.size - before
+
+    def _replace(self, buffer: ConversationBuffer, index: int, **changes):
+        self._insert(buffer, buffer.messages[index].model_copy(update=changes))
+
+    def _trim(self, key: int, buffer: ConversationBuffer):
+        self.buffers.move_to_end(key)
+        while len(buffer.messages) > self.per_conversation:
+            before = buffer.size
+            buffer.evict_oldest()
+            self.size += buffer.size - before
+
+        # Over the global budget: empty the least recently used buffers (they stay open and
+        # become usable again after the next seed)
+        for other_key, other in self.buffers.items():
+            if self.size <= self.budget_bytes:
+                break
+            if other is buffer:
+                continue
+            self.size -= other.size
+            other.reset()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "conversations": len(self.buffers),
+            "messages": sum(len(buffer.messages) for buffer in self.buffers.values()),
+            "bytes": self.size,
+            "budget_bytes": self.budget_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+def create_hot_conversations() -> HotConversations:
+    return HotConversations(settings.hot_cache_per_conversation, settings.hot_cache_budget_bytes)
@@ -0,0 +1,208 @@
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import and_, case, delete, desc, func, or_, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from app import models, schemas
+from app.config import settings
+from app.crypto import decrypt_many, stored_message
+from app.metrics import DB_OPERATION_SECONDS
+
+
+# (user whose inbox changed, event for that user)
+InboxUpdate = Tuple[int, schemas.InboxUpdatedEvent]
+
+Summary = models.ConversationSummary
+
+# Columns that describe the newest message of a conversation
+LAST_MESSAGE_COLUMNS = ("last_sender_id", "last_message_data", "last_message", "last_file_url", "last_message_at")
+
+
+def summary_rows(rows: List[dict], ids: List[int]) -> List[dict]:
+    """
+    Aggregate a batch of inserted `PrivateMessage` rows into one summary row per
+    (user, peer), for both participants: the newest message, and how many new messages
+    the user received. Sorted by key, so concurrent batches lock summaries in one order.
+    """
+    summaries: Dict[Tuple[int, int], dict] = {}
+    for values, message_id in zip(rows, ids):
+        sender_id, receiver_id = values["sender_id"], values["receiver_id"]
+        for user_id, peer_id, unread in ((sender_id, receiver_id, 0), (receiver_id, sender_id, 1)):
+            if user_id == peer_id and unread:
+                # A note to self is one conversation and never unread
+                continue
+            summary = summaries.setdefault((user_id, peer_id), {"user_id": user_id, "peer_id": peer_id,
+                                                                "last_message_id": 0, "unread_count": 0})
+            summary["unread_count"] += unread
+            if message_id > summary["last_message_id"]:
+                summary.update(last_message_id=message_id, last_sender_id=sender_id,
+                               last_message_data=values.get("message_data"), last_message=values.get("message"),
+                               last_file_url=values.get("fileUrl"))
+    return [summaries[key] for key in sorted(summaries)]
+
+
+def returning_updates(stmt):
+    return stmt.returning(Summary.user_id, Summary.peer_id, Summary.last_message_id, Summary.last_sender_id,
+                          Summary.last_message_at, Summary.unread_count)
+
+
+def inbox_updates(result) -> List[InboxUpdate]:
+    return [(row.user_id, schemas.InboxUpdatedEvent(peer_id=row.peer_id, last_message_id=row.last_message_id,
+                                                    last_sender_id=row.last_sender_id,
+                                                    last_message_at=row.last_message_at,
+                                                    unread_count=row.unread_count))
+            for row in result.all()]
+
+
+async def record_new_messages(session: AsyncSession, rows: List[dict], ids: List[int]) -> List[InboxUpdate]:
+    """
+    Update the conversation summaries of a batch of new messages, in the transaction
+    that inserts them (see `MessageWriter.after_insert`).
+
+    Returns:
+        List[InboxUpdate]: The new state of every summary touched, to publish after commit.
+    """
+    values = summary_rows(rows, ids)
+    if not values:
+        return []
+
+    stmt = pg_insert(Summary).values(values)
+    # Batches of different workers can commit out of id order: only a newer message
+    # replaces the preview, while the unread counters always add up
+    newer = stmt.excluded.last_message_id > Summary.last_message_id
+    set_ = {name: case((newer, getattr(stmt.excluded, name)), else_=getattr(Summary, name))
+            for name in LAST_MESSAGE_COLUMNS}
+    set_["last_message_id"] = func.greatest(Summary.last_message_id, stmt.excluded.last_message_id)
+    set_["unread_count"] = Summary.unread_count + stmt.excluded.unread_count
+    stmt = stmt.on_conflict_do_update(index_elements=[Summary.user_id, Summary.peer_id], set_=set_)
+
+    result = await session.execute(returning_updates(stmt))
+    return inbox_updates(result)
+
+
+def unread_query(user_id: int, peer_id: int, last_read_id=None):
+    """
+    Messages from `peer_id` to `user_id` above the read watermark: a range scan of the
+    conversation index that only covers the unread tail.
+    """
+    if last_read_id is None:
+        last_read_id = func.coalesce(
+            select(models.PrivateReadState.last_read_id)
+            .where(models.PrivateReadState.user_id == user_id, models.PrivateReadState.peer_id == peer_id)
+            .scalar_subquery(),
+            0
+        )
+    return select(func.count()).where(
+        models.PrivateMessage.conversation_id == models.conversation_key(user_id, peer_id),
+        models.PrivateMessage.sender_id == peer_id,
+        models.PrivateMessage.id > last_read_id
+    ).scalar_subquery()
+
+
+async def refresh_unread(session: AsyncSession, user_id: int, peer_id: int) -> List[InboxUpdate]:
+    """
+    Recount the unread messages of `user_id` from `peer_id` after the read watermark moved,
+    against the stored watermark: in the transaction that moved it, a concurrent move that
+    committed first is counted too.
+    """
+    if user_id == peer_id:
+        return []
+    result = await session.execute(returning_updates(
+        update(Summary)
+        .where(Summary.user_id == user_id, Summary.peer_id == peer_id)
+        .values(unread_count=unread_query(user_id, peer_id))
+    ))
+    return inbox_updates(result)
+
+
+async def refresh_summary(session: AsyncSession, user_id: int, peer_id: int) -> List[InboxUpdate]:
+    """
+    Recompute the summaries of both participants from the newest message of the
+    conversation, after a delete or edit changed it. A conversation without messages
+    left is removed from both inboxes.
+    """
+    result = await session.execute(
+        select(models.PrivateMessage)
+        .where(models.PrivateMessage.conversation_id == models.conversation_key(user_id, peer_id))
+        .order_by(desc(models.PrivateMessage.id))
+        .limit(1)
+    )
+    newest = result.scalar()
+    pairs = [(user_id, peer_id)] if user_id == peer_id else [(user_id, peer_id), (peer_id, user_id)]
+
+    if newest is None:
+        await session.execute(delete(Summary).where(
+            or_(*[and_(Summary.user_id == user, Summary.peer_id == peer) for user, peer in pairs])
+        ))
+        return [(user, schemas.InboxUpdatedEvent(peer_id=peer)) for user, peer in pairs]
+
+    stmt = pg_insert(Summary).values([
+        {"user_id": user, "peer_id": peer, "last_message_id": newest.id, "last_sender_id": newest.sender_id,
+         "last_message_data": newest.message_data, "last_message": newest.message,
+         "last_file_url": newest.fileUrl, "last_message_at": newest.created_at,
+         "unread_count": 0 if user == peer else unread_query(user, peer)}
+        for user, peer in pairs
+    ])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Summary.user_id, Summary.peer_id],
+        set_={name: getattr(stmt.excluded, name)
+              for name in ("last_message_id", *LAST_MESSAGE_COLUMNS, "unread_count")}
+    )
+    result = await session.execute(returning_updates(stmt))
+    return inbox_updates(result)
+
+
+@DB_OPERATION_SECONDS.time("fetch_inbox")
+async def fetch_inbox(session: AsyncSession, user_id: int, before_id: Optional[int] = None,
+                      limit: Optional[int] = None) -> List[schemas.InboxEntry]:
+    """
+    Fetch one page of the conversations of `user_id`, most recent first.
+
+    Served from `conversation_summary` only: one range scan of its (user_id, last_message_id)
+    index joined with the peer profiles, never a scan of `private_messages`.
+
+    Args:
+    session (AsyncSession): The database session to execute the query.
+    user_id (int): The owner of the inbox.
+    before_id (Optional[int]): Keyset cursor, only conversations whose last message is older.
+    limit (Optional[int]): Page size, defaults to `settings.inbox_page_size`.
+
+    Returns:
+    List[InboxEntry]: Up to `limit` conversations ordered by their last message, newest first.
+    """
+    if limit is None:
+        limit = settings.inbox_page_size
+    limit = max(1, min(limit, settings.inbox_page_max))
+
+    conditions = [Summary.user_id == user_id]
+    if before_id is not None:
+        conditions.append(Summary.last_message_id < before_id)
+
+    result = await session.execute(
+        select(Summary, models.User)
+        .join(models.User, Summary.peer_id == models.User.id)
+        .where(*conditions)
+        .order_by(desc(Summary.last_message_id))
+        .limit(limit)
+    )
+    rows = result.all()
+    previews = await decrypt_many([(summary.last_message_id,
+                                    stored_message(summary.last_message_data, summary.last_message))
+                                   for summary, _ in rows])
+
+    entries = []
+    for (summary, peer), preview in zip(rows, previews):
+        if preview is not None and len(preview) > settings.inbox_preview_length:
+            preview = preview[:settings.inbox_preview_length]
+        entries.append(schemas.InboxEntry(
+            peer_id=summary.peer_id,
+            user_name=peer.user_name,
+            avatar=peer.avatar,
+            verified=peer.verified,
+            last_message_id=summary.last_message_id,
+            last_sender_id=summary.last_sender_id,
+            last_message=preview,
+            last_file_url=summary.last_file_url,
+            last_message_at=summary.last_message_at,
+            unread_count=summary.unread_count,
+        ))
+    return entries
@@ -0,0 +1,204 @@
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Dict, List, Optional, Tuple
+from app.config import settings
+
+
+# Extra fields that may hold message plaintext (user messages, Sayory prompts and replies)
+BODY_FIELDS = ("body", "prompt", "reply")
+
+# Attributes every LogRecord has; anything else was passed with `extra=` and is written as a field
+RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+def redact(value) -> str:
+    return f"<redacted {len(value) if isinstance(value, str) else 0} chars>"
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line: time, level, logger, message, the `extra=` fields of the
+    call and the traceback. Message bodies (`BODY_FIELDS`) are written as their length
+    only, unless `include_bodies` is set.
+    """
+
+    def __init__(self, include_bodies: bool = False):
+        super().__init__()
+        self.include_bodies = include_bodies
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for name, value in vars(record).items():
+            if name in RECORD_ATTRIBUTES:
+                continue
+            entry[name] = value if self.include_bodies or name not in BODY_FIELDS else redact(value)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def parse_limits(spec: str) -> Dict[str, Tuple[float, float]]:
+    """
+    `settings.log_limits`: "logger:sample_rate:max_per_second" items separated by commas.
+    """
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, sample_rate, per_second = item.rsplit(":", 2)
+        limits[name] = (float(sample_rate), float(per_second))
+    return limits
+
+
+class LogLimiter(logging.Filter):
+    """
+    Per-logger sampling and rate limit, applied before a record is queued.
+
+    `limits` maps a logger name (and its children) to `(sample_rate, max_per_second)`.
+    Sampling keeps every n-th record below WARNING, so it is deterministic; the rate limit
+    applies to every level, so an error storm cannot flood the disk either. The next
+    record that passes carries how many were `suppressed` since the last one.
+    """
+
+    def __init__(self, limits: Dict[str, Tuple[float, float]]):
+        super().__init__()
+        self.limits = limits
+        self.lock = threading.Lock()
+        # Per configured logger: [records seen, tokens, last refill, suppressed]
+        self.state: Dict[str, List[float]] = {}
+        self.resolved: Dict[str, Optional[str]] = {}
+
+    def _limit_of(self, name: str) -> Optional[str]:
+        if name not in self.resolved:
+            candidate = name
+            while candidate and candidate not in self.limits:
+                candidate = candidate.rpartition(".")[0]
+            self.resolved[name] = candidate or None
+        return self.resolved[name]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = self._limit_of(record.name)
+        if key is None:
+            return True
+        sample_rate, per_second = self.limits[key]
+        with self.lock:
+            state = self.state.get(key)
+            if state is None:
+                state = self.state[key] = [0, max(per_second, 1), time.monotonic(), 0]
+            if record.levelno < logging.WARNING and sample_rate < 1:
+                state[0] += 1
+                if sample_rate <= 0 or (state[0] - 1) % round(1 / sample_rate):
+                    return False
+            now = time.monotonic()
+            state[1] = min(max(per_second, 1), state[1] + (now - state[2]) * per_second)
+            state[2] = now
+            if state[1] < 1:
+                state[3] += 1
+                return False
+            state[1] -= 1
+            if state[3]:
+                record.suppressed = int(state[3])
+                state[3] = 0
+        return True
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    Queues records for the writer thread and never waits: when the writer falls behind
+    and the queue is full, the record is dropped and counted instead.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Only what cannot cross threads is resolved here; the JSON is built by the writer
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+listener: Optional[QueueListener] = None
+queue_handler: Optional[NonBlockingQueueHandler] = None
+
+
+def setup_logging(log_file: Optional[str] = None, level: Optional[str] = None,
+                  limits: Optional[str] = None, include_bodies: Optional[bool] = None) -> QueueListener:
+    """
+    Route every log record of the process through one queue to a background thread that
+    writes JSON lines to a rotating file, so no request ever waits on the disk.
+
+    Idempotent; the arguments default to the `log_*` settings.
+    """
+    global listener, queue_handler
+    if listener is not None:
+        return listener
+
+    log_file = log_file or settings.log_file
+    directory = os.path.dirname(log_file)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    file_handler = RotatingFileHandler(log_file, maxBytes=settings.log_max_bytes, backupCount=settings.log_backups,
+                                       encoding="utf-8")
+    file_handler.setFormatter(JsonFormatter(settings.log_message_bodies if include_bodies is None
+                                            else include_bodies))
+
+    queue_handler = NonBlockingQueueHandler(queue.Queue(settings.log_queue_size))
+    queue_handler.addFilter(LogLimiter(parse_limits(settings.log_limits if limits is None else limits)))
+
+    root = logging.getLogger()
+    root.setLevel(level or settings.log_level)
+    root.addHandler(queue_handler)
+
+    listener = QueueListener(queue_handler.queue, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(shutdown_logging)
+    return listener
+
+
+def shutdown_logging():
+    """
+    Write out the queued records and stop the writer thread.
+    """
+    global listener, queue_handler
+    if listener is None:
+        return
+    logging.getLogger().removeHandler(queue_handler)
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+    if queue_handler.dropped:
+        print(f"Dropped {queue_handler.dropped} log records, the log writer fell behind", file=sys.stderr)
+    listener = None
+    queue_handler = None
+
+
+def logging_stats() -> dict:
+    if queue_handler is None:
+        return {"queued": 0, "dropped": 0}
+    return {"queued": queue_handler.queue.qsize(), "dropped": queue_handler.dropped}
@@ -1,9 +1,42 @@
 
+import logging
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from .routers import private_messages
+from .AI.jobs import ai_jobs
+from .config import settings
+from .database import warm_pool
+from .logging_setup import setup_logging, shutdown_logging
+from .routers import admin, health, inbox, metrics, private_messages
+from .write_pipeline import message_writer
+
+
+logger = logging.getLogger(__name__)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Only a running server writes the log file, not every import of the app (tests, benchmark)
+    setup_logging()
+    # A database that is down must not keep the worker from starting; /health/ready reports it
+    try:
+        warmed = await warm_pool(settings.db_pool_warm)
+    except Exception as e:
+        logger.error(f"Error warming the database pool: {e}", exc_info=True)
+        warmed = 0
+    await private_messages.manager.start()
+    health.startup.mark_ready(warmed)
+    logger.info(f"Ready in {health.startup.startup_seconds}s, {warmed} database connections warmed")
+    yield
+    await ai_jobs.close()
+    # Commit the messages still waiting for a group commit before the worker exits
+    await message_writer.close()
+    await private_messages.manager.broker.close()
+    shutdown_logging()
+
 
 app = FastAPI(
+    lifespan=lifespan,
     docs_url="/docs",
     title="Private Messages API",
     description="API for private messages",
@@ -22,3 +55,8 @@ app.add_middleware(
 
 
 app.include_router(private_messages.router)
+app.include_router(inbox.router)
+app.include_router(admin.router)
+app.include_router(health.router)
+if settings.metrics_enabled:
+    app.include_router(metrics.router)
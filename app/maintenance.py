@@ -0,0 +1,251 @@
+"""
+One-off maintenance commands, run as `python -m app.maintenance <command>`.
+"""
+import argparse
+import asyncio
+from typing import List
+from sqlalchemy import BigInteger, and_, bindparam, func, null, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from app import crypto, inbox, models
+from app.database import async_session_maker
+
+
+async def max_message_id(session: AsyncSession) -> int:
+    result = await session.execute(select(func.coalesce(func.max(models.PrivateMessage.id), 0)))
+    return result.scalar()
+
+
+async def reconcile_vote_counts(batch_size: int = 5000) -> int:
+    """
+    Recompute `private_messages.vote_count` from `private_message_votes`.
+
+    Works through the table in id ranges of `batch_size`, one short transaction per range,
+    and only rewrites rows whose counter is wrong. Safe to run on a live database.
+
+    Returns:
+        int: The number of messages whose counter was corrected.
+    """
+    fixed = 0
+    async with async_session_maker() as session:
+        last_id = await max_message_id(session)
+
+        for low in range(0, last_id, batch_size):
+            total = select(
+                func.coalesce(func.sum(models.PrivateMessageVote.dir), 0)
+            ).where(
+                models.PrivateMessageVote.message_id == models.PrivateMessage.id
+            ).scalar_subquery()
+
+            result = await session.execute(
+                update(models.PrivateMessage)
+                .where(models.PrivateMessage.id > low,
+                       models.PrivateMessage.id <= low + batch_size,
+                       models.PrivateMessage.vote_count != total)
+                .values(vote_count=total)
+                .execution_options(synchronize_session=False)
+            )
+            await session.commit()
+            fixed += result.rowcount
+
+    return fixed
+
+
+async def backfill_conversation_ids(batch_size: int = 5000) -> int:
+    """
+    Fill `private_messages.conversation_id` for rows written before the column existed.
+
+    Uses the same (min(user), max(user)) key as `models.conversation_key`, one short
+    transaction per id range, and skips rows that already have a key.
+
+    Returns:
+        int: The number of messages updated.
+    """
+    updated = 0
+    low_user = func.least(models.PrivateMessage.sender_id, models.PrivateMessage.receiver_id)
+    high_user = func.greatest(models.PrivateMessage.sender_id, models.PrivateMessage.receiver_id)
+
+    async with async_session_maker() as session:
+        last_id = await max_message_id(session)
+
+        for low in range(0, last_id, batch_size):
+            result = await session.execute(
+                update(models.PrivateMessage)
+                .where(models.PrivateMessage.id > low,
+                       models.PrivateMessage.id <= low + batch_size,
+                       models.PrivateMessage.conversation_id.is_(None))
+                .values(conversation_id=low_user.cast(BigInteger) * (1 << 32) + high_user)
+                .execution_options(synchronize_session=False)
+            )
+            await session.commit()
+            updated += result.rowcount
+
+    return updated
+
+
+async def reencode_messages(batch_size: int = 1000, start_id: int = 0) -> int:
+    """
+    Rewrite messages into the binary `message_data` format under the current key: rows
+    that still hold the legacy base64 text in `message`, and rows of retired key versions
+    after a key rotation. The `conversation_summary` rows whose last message falls in the
+    same id range are re-encoded with it, so no copy under a retired key is left behind.
+
+    One short transaction per id range, so no long lock is taken. Each row is only
+    overwritten if it has not changed since it was read (a concurrent edit wins). Progress
+    is printed per range; after an interruption, continue with `--start-id`.
+
+    Returns:
+        int: The number of messages re-encoded.
+    """
+    message = models.PrivateMessage
+    table = message.__table__
+    reencoded = 0
+    summaries = 0
+
+    async with async_session_maker() as session:
+        last_id = await max_message_id(session)
+
+        for low in range(start_id, last_id, batch_size):
+            high = low + batch_size
+            result = await session.execute(
+                select(message.id, message.message, message.message_data)
+                .where(message.id > low, message.id <= high,
+                       stale_encoding(message.message, message.message_data))
+            )
+            rows = reencoded_rows(result, "message", ("id",))
+            if rows:
+                await session.execute(
+                    update(table)
+                    .where(table.c.id == bindparam("row_id"),
+                           table.c.message.is_not_distinct_from(bindparam("old_message")),
+                           table.c.message_data.is_not_distinct_from(bindparam("old_data")))
+                    .values(message_data=bindparam("new_data"), message=null()),
+                    rows
+                )
+            summaries += await reencode_summaries(session, low, high)
+            await session.commit()
+            reencoded += len(rows)
+            print(f"Re-encoded {reencoded} messages and {summaries} summaries, done up to id {min(high, last_id)}")
+
+    return reencoded
+
+
+def stale_encoding(text_column, data_column):
+    """
+    Rows still in the legacy text format, or encrypted under another format or key version.
+    """
+    return or_(and_(data_column.is_(None), text_column.is_not(None)),
+               func.get_byte(data_column, 0) != crypto.FORMAT_VERSION,
+               func.get_byte(data_column, 1) != crypto.key_version)
+
+
+def reencoded_rows(result, label: str, key_names) -> List[dict]:
+    """
+    The update parameters of the selected `(*key, text, data)` rows under the current key.
+    """
+    rows = []
+    for *key, text, data in result.all():
+        stored = crypto.stored_message(data, text)
+        plaintext = crypto.decrypt(stored)
+        if plaintext is None:
+            print(f"Skipping {label} {', '.join(map(str, key))}: cannot be decrypted with the configured keys")
+            continue
+        row = {f"row_{name}": value for name, value in zip(key_names, key)}
+        row.update(old_message=text, old_data=data, new_data=crypto.encrypt(plaintext))
+        rows.append(row)
+    return rows
+
+
+async def reencode_summaries(session: AsyncSession, low: int, high: int) -> int:
+    """
+    Re-encode the inbox summaries whose last message id is in (`low`, `high`], like the messages.
+    """
+    summary = models.ConversationSummary.__table__
+    result = await session.execute(
+        select(summary.c.user_id, summary.c.peer_id, summary.c.last_message, summary.c.last_message_data)
+        .where(summary.c.last_message_id > low, summary.c.last_message_id <= high,
+               stale_encoding(summary.c.last_message, summary.c.last_message_data))
+    )
+    rows = reencoded_rows(result, "summary", ("user_id", "peer_id"))
+    if rows:
+        await session.execute(
+            update(summary)
+            .where(summary.c.user_id == bindparam("row_user_id"),
+                   summary.c.peer_id == bindparam("row_peer_id"),
+                   summary.c.last_message.is_not_distinct_from(bindparam("old_message")),
+                   summary.c.last_message_data.is_not_distinct_from(bindparam("old_data")))
+            .values(last_message_data=bindparam("new_data"), last_message=null()),
+            rows
+        )
+    return len(rows)
+
+
+async def rebuild_summaries(batch_size: int = 5000) -> int:
+    """
+    Rebuild `conversation_summary` for every conversation, e.g. after the table is created
+    or to correct drifted unread counters.
+
+    Finds the conversations of each id range of `private_messages` and recomputes both
+    summaries of each one once, one short transaction per range.
+
+    Returns:
+        int: The number of conversations rebuilt.
+    """
+    message = models.PrivateMessage
+    seen = set()
+
+    async with async_session_maker() as session:
+        last_id = await max_message_id(session)
+
+        for low in range(0, last_id, batch_size):
+            result = await session.execute(
+                select(message.conversation_id)
+                .where(message.id > low, message.id <= low + batch_size)
+                .distinct()
+            )
+            for conversation_id in result.scalars().all():
+                if conversation_id in seen:
+                    continue
+                seen.add(conversation_id)
+                await inbox.refresh_summary(session, *models.conversation_users(conversation_id))
+            await session.commit()
+
+    return len(seen)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Private messages maintenance commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    votes = commands.add_parser("reconcile-votes", help="recompute private_messages.vote_count")
+    votes.add_argument("--batch-size", type=int, default=5000)
+
+    conversations = commands.add_parser("backfill-conversations", help="fill private_messages.conversation_id")
+    conversations.add_argument("--batch-size", type=int, default=5000)
+
+    reencode = commands.add_parser("reencode-messages",
+                                   help="move messages (and the conversation_summary copies of the last "
+                                        "message) to message_data under the current key")
+    reencode.add_argument("--batch-size", type=int, default=1000)
+    reencode.add_argument("--start-id", type=int, default=0, help="resume after this message id")
+
+    summaries = commands.add_parser("rebuild-summaries", help="recompute conversation_summary")
+    summaries.add_argument("--batch-size", type=int, default=5000)
+
+    args = parser.parse_args()
+
+    if args.command == "reconcile-votes":
+        fixed = await reconcile_vote_counts(args.batch_size)
+        print(f"Corrected vote_count of {fixed} messages")
+    elif args.command == "backfill-conversations":
+        updated = await backfill_conversation_ids(args.batch_size)
+        print(f"Set conversation_id of {updated} messages")
+    elif args.command == "reencode-messages":
+        reencoded = await reencode_messages(args.batch_size, args.start_id)
+        print(f"Re-encoded {reencoded} messages")
+    elif args.command == "rebuild-summaries":
+        rebuilt = await rebuild_summaries(args.batch_size)
+        print(f"Rebuilt the summaries of {rebuilt} conversations")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
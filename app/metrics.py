@@ -0,0 +1,183 @@
+import functools
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+
+# Latency buckets in seconds, from sub-millisecond cache hits to timeouts
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = Tuple[str, ...]
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+class Metric:
+    """
+    One metric family in the Prometheus text format. Label values are passed positionally
+    in the order of `labelnames`, so an update is a dict lookup and an add: cheap enough
+    to leave on permanently on every hot path.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 registry: Optional["Registry"] = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        (registry or REGISTRY).register(self)
+
+    def samples(self) -> List[Tuple[str, Labels, Sequence[str], float]]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, names, values, value in self.samples():
+            lines.append(f"{self.name}{suffix}{format_labels(names, values)} {format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    """
+    Monotonic counter. Safe to increment from executor threads (decrypt failures).
+    """
+
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: Dict[Labels, float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        return [("_total", self.labelnames, labels, value) for labels, value in sorted(self.values.items())]
+
+
+class Gauge(Metric):
+    """
+    Current value, either set by the code or read from `function` at scrape time. The
+    function returns a number, or `{label_values: number}` for a labelled gauge.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 function: Optional[Callable[[], object]] = None, registry: Optional["Registry"] = None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.values: Dict[Labels, float] = {}
+        self.function = function
+
+    def set(self, value: float, *labels: str):
+        self.values[labels] = value
+
+    def samples(self):
+        values = self.values
+        if self.function is not None:
+            current = self.function()
+            values = current if isinstance(current, dict) else {(): current}
+        return [("", self.labelnames, labels, value) for labels, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+    """
+    Latency distribution. Only observed on the event loop thread.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS, registry: Optional["Registry"] = None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(buckets)
+        # Per label values: [count per bucket (the last one is +Inf), sum]
+        self.values: Dict[Labels, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *labels: str):
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1][0] += value
+
+    def time(self, *labels: str):
+        """
+        Decorator that observes the duration of every call of an async function.
+        """
+        def decorator(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - started, *labels)
+            return wrapper
+        return decorator
+
+    def samples(self):
+        samples = []
+        names = self.labelnames + ("le",)
+        for labels, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                samples.append(("_bucket", names, labels + (format_value(bound),), cumulative))
+            samples.append(("_sum", self.labelnames, labels, total[0]))
+            samples.append(("_count", self.labelnames, labels, cumulative))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+
+    def unregister(self, name: str):
+        self.metrics.pop(name, None)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+# Hot-path metrics, updated where the work happens. Gauges that describe the state of
+# other objects (sockets, pool, queues) are read at scrape time, see app.routers.metrics.
+WS_COMMAND_SECONDS = Histogram("pm_ws_command_seconds", "Time to handle one websocket command.", ["command"])
+WS_SEND_SECONDS = Histogram("pm_ws_send_seconds", "Time of one websocket frame write.", ["path"])
+DB_OPERATION_SECONDS = Histogram("pm_db_operation_seconds", "Time of one database operation.", ["operation"])
+DB_CHECKOUT_SECONDS = Histogram("pm_db_pool_checkout_seconds",
+                                "Wait for a connection from the database pool (including connects).")
+CRYPTO_SECONDS = Histogram("pm_crypto_seconds", "Time to encrypt one message or decrypt one batch.",
+                           ["operation"])
+MESSAGES_SENT = Counter("pm_messages_sent", "Messages stored and published.")
+DECRYPT_FAILURES = Counter("pm_decrypt_failures", "Stored messages that could not be decrypted.")
+SAYORY_CALLS = Counter("pm_sayory_calls", "Upstream Sayory completions, by result.", ["result"])
@@ -1,5 +1,6 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Boolean, Enum
+from sqlalchemy import BigInteger, Column, Integer, String, ForeignKey, Boolean, Enum, Index, LargeBinary
 from enum import Enum as PythonEnum
+from typing import Tuple
 from sqlalchemy.sql.expression import text
 from sqlalchemy.sql.sqltypes import TIMESTAMP
 from .database import Base
@@ -9,18 +10,43 @@ class UserRole(str, PythonEnum):
 	user = "user"
 	admin = "admin"
 
+def conversation_key(user_id: int, peer_id: int) -> int:
+    """
+    Normalized key of the conversation between two users, the same for both directions.
+    """
+    low, high = sorted((user_id, peer_id))
+    return (low << 32) | high
+
+
+def conversation_users(key: int) -> Tuple[int, int]:
+    """
+    The two users of a `conversation_key`, lower id first.
+    """
+    return key >> 32, key & 0xFFFFFFFF
+
+
 class PrivateMessage(Base):
     __tablename__ = 'private_messages'
     
     id = Column(Integer, primary_key=True, nullable=False, index=True, autoincrement=True)
     sender_id = Column(Integer, ForeignKey('users.id', ondelete="CASCADE"), nullable=False, index=True)
     receiver_id = Column(Integer, ForeignKey('users.id', ondelete="CASCADE"), nullable=False, index=True)
+    conversation_id = Column(BigInteger, nullable=False)
+    # Legacy text storage, new rows use message_data (see app.crypto)
     message = Column(String)
+    message_data = Column(LargeBinary)
     created_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'))
     is_read = Column(Boolean, nullable=False, default=True)
     fileUrl = Column(String)
     edited = Column(Boolean, server_default='false')
     id_return = Column(Integer)
+    # Sum of private_message_votes.dir, maintained by process_vote
+    vote_count = Column(Integer, nullable=False, server_default='0')
+    
+    __table_args__ = (
+        # Serves a whole two-party thread newest-first for keyset pagination
+        Index('ix_private_messages_conversation_id', conversation_id, id.desc()),
+    )
     
     
 class User(Base):
@@ -42,5 +68,36 @@ class PrivateMessageVote(Base):
     __tablename__ = 'private_message_votes'
     
     user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
-    message_id = Column(Integer, ForeignKey("private_messages.id", ondelete="CASCADE"), primary_key=True)
-    dir = Column(Integer) 
\ No newline at end of file
+    message_id = Column(Integer, ForeignKey("private_messages.id", ondelete="CASCADE"), primary_key=True, index=True)
+    dir = Column(Integer)
+
+
+class PrivateReadState(Base):
+    __tablename__ = 'private_read_state'
+    
+    # Read watermark: `user_id` has read every message from `peer_id` up to `last_read_id`
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    peer_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    last_read_id = Column(Integer, nullable=False, server_default='0')
+    updated_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'))
+
+
+class ConversationSummary(Base):
+    __tablename__ = 'conversation_summary'
+    
+    # One row per participant: the inbox of `user_id` lists its rows, newest message first
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    peer_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    last_message_id = Column(Integer, nullable=False)
+    last_sender_id = Column(Integer, nullable=False)
+    # Stored (encrypted) form of the last message, like PrivateMessage.message_data/message
+    last_message_data = Column(LargeBinary)
+    last_message = Column(String)
+    last_file_url = Column(String)
+    last_message_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'))
+    # Messages from `peer_id` above the read watermark of `user_id`
+    unread_count = Column(Integer, nullable=False, server_default='0')
+    
+    __table_args__ = (
+        Index('ix_conversation_summary_user_id_last_message_id', user_id, last_message_id.desc()),
+    )
@@ -2,12 +2,12 @@
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
 
-from sqlalchemy import select
-from . import schemas, database, models
+from . import schemas, database
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.ext.asyncio import AsyncSession
 from .config import settings
+from .user_cache import user_cache
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
@@ -36,7 +36,7 @@ def verify_access_token(token: str, credentials_exception):
         id: str = payload.get("user_id")
         if id is None:
             raise credentials_exception
-        token_data = schemas.TokenData(id=id)
+        token_data = schemas.TokenData(id=id, exp=payload.get("exp"))
     except JWTError:
         raise credentials_exception
 
@@ -49,10 +49,14 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession
         headers={"WWW-Authenticate": "Bearer"}
         )
     
-    token = verify_access_token(token, credentials_exception)
+    user_id = user_cache.get_token(token)
+    if user_id is None:
+        token_data = verify_access_token(token, credentials_exception)
+        user_id = token_data.id
+        user_cache.put_token(token, user_id, token_data.exp)
     
-    async with db.begin() as session:
-        user = await db.execute(select(models.User).filter(models.User.id == token.id))
-        user = user.scalar()
+    user = await user_cache.get_user(db, user_id)
+    if user is None:
+        raise credentials_exception
     
     return user
@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Callable, Deque, Hashable, Optional, Tuple
+from fastapi import WebSocket
+from app.metrics import WS_SEND_SECONDS
+
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_POLICIES = ("drop_oldest", "coalesce", "disconnect")
+
+# Close code sent to a consumer that cannot keep up (1013 = try again later)
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+
+class OutboundQueue:
+    """
+    Bounded queue of frames waiting to be written to one websocket, drained by its own
+    writer task. `put` never waits on the network, so a slow or half-dead client only
+    ever delays itself.
+
+    When the queue is full, `policy` decides what happens:
+    - "drop_oldest": the oldest queued frame is discarded.
+    - "coalesce": a queued frame with the same key (an older vote total, edit or read
+      receipt of the same target) is replaced; if there is none the consumer is disconnected.
+    - "disconnect": the consumer is disconnected; the client reloads history on reconnect.
+
+    A send that takes longer than `send_timeout` seconds also disconnects the consumer.
+    """
+
+    def __init__(self, websocket: WebSocket, max_size: int, policy: str, send_timeout: float,
+                 on_slow_consumer: Optional[Callable[["OutboundQueue"], None]] = None):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown outbound overflow policy: {policy}")
+        self.websocket = websocket
+        self.max_size = max_size
+        self.policy = policy
+        self.send_timeout = send_timeout
+        self.on_slow_consumer = on_slow_consumer
+        self.frames: Deque[Tuple[Optional[Hashable], str]] = deque()
+        self.ready = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.closed = False
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_depth = 0
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    def close(self):
+        self.closed = True
+        self.frames.clear()
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def put(self, text: str, key: Optional[Hashable] = None):
+        """
+        Queue one frame. `key` identifies frames that supersede each other (see `policy`).
+        """
+        if self.closed:
+            return
+
+        if len(self.frames) >= self.max_size and not self._make_room(key, text):
+            return
+
+        self.frames.append((key, text))
+        self.max_depth = max(self.max_depth, len(self.frames))
+        self.ready.set()
+
+    def _make_room(self, key: Optional[Hashable], text: str) -> bool:
+        """
+        Apply the overflow policy. Returns True when the new frame should still be appended.
+        """
+        if self.policy == "drop_oldest":
+            self.frames.popleft()
+            self.dropped += 1
+            return True
+
+        if self.policy == "coalesce" and key is not None:
+            for index, (queued_key, _) in enumerate(self.frames):
+                if queued_key == key:
+                    self.frames[index] = (key, text)
+                    self.coalesced += 1
+                    return False
+
+        self._slow_consumer()
+        return False
+
+    def _slow_consumer(self):
+        self.dropped += len(self.frames) + 1
+        self.close()
+        if self.on_slow_consumer is not None:
+            self.on_slow_consumer(self)
+
+    async def _run(self):
+        while True:
+            await self.ready.wait()
+            while self.frames:
+                _, text = self.frames.popleft()
+                # asyncio.wait, unlike wait_for, never swallows a cancellation of the writer
+                started = time.perf_counter()
+                send = asyncio.ensure_future(self.websocket.send_text(text))
+                try:
+                    done, _ = await asyncio.wait({send}, timeout=self.send_timeout)
+                except asyncio.CancelledError:
+                    send.cancel()
+                    raise
+                WS_SEND_SECONDS.observe(time.perf_counter() - started, "queued")
+                if not done:
+                    send.cancel()
+                    logger.warning(f"Send timed out after {self.send_timeout}s, disconnecting slow consumer")
+                    self.task = None
+                    self._slow_consumer()
+                    return
+                try:
+                    send.result()
+                except Exception as e:
+                    # The socket is gone; its receive loop will clean up the registration
+                    logger.info(f"Dropping outbound frames of a closed socket: {e}")
+                    self.frames.clear()
+                    break
+                self.sent += 1
+            self.ready.clear()
+
+    def stats(self) -> dict:
+        return {
+            "depth": len(self.frames),
+            "max_depth": self.max_depth,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+        }
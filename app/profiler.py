@@ -0,0 +1,267 @@
+import asyncio
+import json
+import logging
+import random
+import sys
+import threading
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import RotatingFileHandler
+from typing import Dict, List, Optional, Set
+from sqlalchemy import event
+from app.config import settings
+
+
+logger = logging.getLogger(__name__)
+
+# Profiles go to their own rotating file, never to the application logs
+profile_logger = logging.getLogger("app.profiles")
+profile_logger.propagate = False
+
+# Statements longer than this are cut in the profile
+MAX_STATEMENT_LENGTH = 500
+# Bound on the statements kept per operation (a runaway loop must not eat memory)
+MAX_STATEMENTS = 200
+
+
+def frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_name}:{frame.f_lineno}"
+
+
+def coroutine_frames(coroutine) -> list:
+    """
+    Frames of a suspended coroutine chain, outermost first (where a task is waiting).
+    """
+    frames = []
+    while coroutine is not None:
+        frame = getattr(coroutine, "cr_frame", None) or getattr(coroutine, "ag_frame", None) \
+            or getattr(coroutine, "gi_frame", None)
+        if frame is None:
+            break
+        frames.append(frame)
+        coroutine = getattr(coroutine, "cr_await", None) or getattr(coroutine, "ag_await", None) \
+            or getattr(coroutine, "gi_yieldfrom", None)
+    return frames
+
+
+def thread_frames(frame) -> list:
+    frames = []
+    while frame is not None:
+        frames.append(frame)
+        frame = frame.f_back
+    return frames[::-1]
+
+
+class Recording:
+    """
+    What one profiled operation collected: sampled stacks (folded, flamegraph-ready) and
+    the SQL statements it issued.
+    """
+
+    def __init__(self, operation: str, context: dict, task: Optional[asyncio.Task]):
+        self.operation = operation
+        self.context = context
+        self.task = task
+        self.started_at = datetime.now(timezone.utc)
+        self.started = time.perf_counter()
+        self.stacks: Dict[str, int] = {}
+        self.samples = 0
+        self.statements: List[dict] = []
+        self.sql_seconds = 0.0
+        self.finished = False
+
+    def sample(self, loop_frame):
+        """
+        Called from the sampler thread. While the task runs on the loop, the loop thread's
+        stack shows where the CPU goes (decryption, pydantic, ...); while it is suspended,
+        its coroutine chain shows what it waits for (SQL, a socket write, ...).
+        """
+        if self.task is None:
+            return
+        waiting = coroutine_frames(self.task.get_coro())
+        if not waiting:
+            return
+        outer = waiting[0].f_code
+        running = thread_frames(loop_frame) if loop_frame is not None else []
+        for index, frame in enumerate(running):
+            if frame.f_code is outer:
+                stack, state = running[index:], "running"
+                break
+        else:
+            stack, state = waiting, "waiting"
+        key = ";".join([state] + [frame_label(frame) for frame in stack])
+        self.stacks[key] = self.stacks.get(key, 0) + 1
+        self.samples += 1
+
+    def add_statement(self, statement: str, seconds: float, executemany: bool):
+        self.sql_seconds += seconds
+        if len(self.statements) < MAX_STATEMENTS:
+            self.statements.append({"statement": " ".join(statement.split())[:MAX_STATEMENT_LENGTH],
+                                    "ms": round(seconds * 1000, 3), "many": executemany})
+
+    def report(self, duration: float, reason: str) -> dict:
+        return {
+            "operation": self.operation,
+            "reason": reason,
+            "started_at": self.started_at.isoformat(),
+            "duration_ms": round(duration * 1000, 3),
+            "sql_ms": round(self.sql_seconds * 1000, 3),
+            "context": self.context,
+            "sql": self.statements,
+            "samples": self.samples,
+            "stacks": dict(sorted(self.stacks.items(), key=lambda item: -item[1])),
+        }
+
+
+current_recording: ContextVar[Optional[Recording]] = ContextVar("current_recording", default=None)
+
+
+class Profiler:
+    """
+    Opt-in sampling profiler for slow operations (websocket commands, `send_private_all`).
+
+    While enabled, every profiled operation records stack samples (every `interval_ms`,
+    from a background thread) and the SQL it issues. Operations slower than `threshold_ms`,
+    and a `sample_rate` fraction of the others, are written as one JSON line to a rotating
+    file; the rest are discarded. Disabled, `profile` costs one attribute check.
+
+    `configure` changes the settings at runtime; the admin endpoint broadcasts it to
+    every worker.
+    """
+
+    def __init__(self):
+        self.enabled = settings.profiler_enabled
+        self.threshold_ms = settings.profiler_threshold_ms
+        self.sample_rate = settings.profiler_sample_rate
+        self.interval_ms = settings.profiler_interval_ms
+        self.active: Set[Recording] = set()
+        self.lock = threading.Lock()
+        self.sampler: Optional[threading.Thread] = None
+        self.loop_thread_id: Optional[int] = None
+        self.engines = set()
+        self.handler: Optional[logging.Handler] = None
+        self.profiled = 0
+        self.written = 0
+
+    def configure(self, enabled: Optional[bool] = None, threshold_ms: Optional[float] = None,
+                  sample_rate: Optional[float] = None, interval_ms: Optional[float] = None):
+        if threshold_ms is not None:
+            self.threshold_ms = threshold_ms
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+        if interval_ms is not None:
+            self.interval_ms = interval_ms
+        if enabled is not None:
+            self.enabled = enabled
+        logger.info(f"Profiler configured: {self.config()}")
+
+    def config(self) -> dict:
+        return {"enabled": self.enabled, "threshold_ms": self.threshold_ms,
+                "sample_rate": self.sample_rate, "interval_ms": self.interval_ms}
+
+    def instrument(self, engine):
+        """
+        Capture the statements of `engine` for the operation that issues them.
+        """
+        sync_engine = getattr(engine, "sync_engine", engine)
+        if sync_engine in self.engines:
+            return
+        self.engines.add(sync_engine)
+        event.listen(sync_engine, "before_cursor_execute", self._before_execute)
+        event.listen(sync_engine, "after_cursor_execute", self._after_execute)
+
+    @staticmethod
+    def _before_execute(conn, cursor, statement, parameters, context, executemany):
+        if current_recording.get() is not None:
+            conn.info.setdefault("profiler_started", []).append(time.perf_counter())
+
+    @staticmethod
+    def _after_execute(conn, cursor, statement, parameters, context, executemany):
+        recording = current_recording.get()
+        started = conn.info.get("profiler_started")
+        if recording is None or not started:
+            return
+        elapsed = time.perf_counter() - started.pop()
+        if recording.finished:
+            # A task that inherited the context of a finished operation
+            return
+        # Parameters are never recorded: they hold message ciphertext and user data
+        recording.add_statement(statement, elapsed, executemany)
+
+    @asynccontextmanager
+    async def profile(self, operation: str, **context):
+        """
+        Profile the block as `operation`; `context` (ids, sizes) is written with the profile.
+        Nested profiles are part of the outermost one.
+        """
+        if not self.enabled or current_recording.get() is not None:
+            yield
+            return
+
+        recording = Recording(operation, context, asyncio.current_task())
+        token = current_recording.set(recording)
+        self._start(recording)
+        try:
+            yield
+        finally:
+            current_recording.reset(token)
+            recording.finished = True
+            self._stop(recording)
+            self._finish(recording, time.perf_counter() - recording.started)
+
+    def _start(self, recording: Recording):
+        self.loop_thread_id = threading.get_ident()
+        with self.lock:
+            self.active.add(recording)
+            if self.sampler is None or not self.sampler.is_alive():
+                self.sampler = threading.Thread(target=self._sample_loop, name="profiler", daemon=True)
+                self.sampler.start()
+
+    def _stop(self, recording: Recording):
+        with self.lock:
+            self.active.discard(recording)
+
+    def _sample_loop(self):
+        while True:
+            time.sleep(self.interval_ms / 1000)
+            with self.lock:
+                if not self.active:
+                    # Exits when idle; the next profiled operation starts a new one
+                    self.sampler = None
+                    return
+                loop_frame = sys._current_frames().get(self.loop_thread_id)
+                for recording in self.active:
+                    try:
+                        recording.sample(loop_frame)
+                    except Exception as e:
+                        logger.debug(f"Profiler sample failed: {e}")
+
+    def _finish(self, recording: Recording, duration: float):
+        self.profiled += 1
+        if duration * 1000 >= self.threshold_ms:
+            reason = "slow"
+        elif self.sample_rate > 0 and random.random() < self.sample_rate:
+            reason = "sampled"
+        else:
+            return
+        self.written += 1
+        self._open_output()
+        profile_logger.info(json.dumps(recording.report(duration, reason), default=str))
+
+    def _open_output(self):
+        if self.handler is None:
+            self.handler = RotatingFileHandler(settings.profiler_file, maxBytes=settings.profiler_max_bytes,
+                                               backupCount=settings.profiler_backups, delay=True)
+            self.handler.setFormatter(logging.Formatter("%(message)s"))
+            profile_logger.addHandler(self.handler)
+            profile_logger.setLevel(logging.INFO)
+
+    def stats(self) -> dict:
+        return dict(self.config(), active=len(self.active), profiled=self.profiled, written=self.written,
+                    file=settings.profiler_file)
+
+
+profiler = Profiler()
@@ -0,0 +1,83 @@
+from fastapi import APIRouter, Depends, HTTPException, status
+
+from app import oauth2, schemas
+from app.AI.jobs import ai_jobs
+from app.AI.prompt_cache import prompt_cache
+from app.models import UserRole
+from app.profiler import profiler
+from app.user_cache import user_cache
+from .private_messages import manager
+
+router = APIRouter(prefix="/admin", tags=['Admin'])
+
+
+async def get_admin_user(current_user: schemas.UserProfile = Depends(oauth2.get_current_user)):
+    if current_user.role != UserRole.admin:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin role required")
+    return current_user
+
+
+@router.post("/users/{user_id}/invalidate", status_code=status.HTTP_204_NO_CONTENT)
+async def invalidate_user(user_id: int, admin: schemas.UserProfile = Depends(get_admin_user)):
+    """
+    Drop a user from the profile cache of every worker after a profile change or block.
+    """
+    await manager.invalidate_user(user_id)
+
+
+@router.get("/user-cache")
+async def user_cache_stats(admin: schemas.UserProfile = Depends(get_admin_user)):
+    """
+    Size and hit/miss counters of the user profile cache of this worker.
+    """
+    return user_cache.stats()
+
+
+@router.get("/connections")
+async def connection_stats(admin: schemas.UserProfile = Depends(get_admin_user)):
+    """
+    Outbound queue depth and sent/dropped/coalesced counters of every socket of this worker.
+    """
+    return manager.outbound_stats()
+
+
+@router.get("/ai-jobs")
+async def ai_job_stats(admin: schemas.UserProfile = Depends(get_admin_user)):
+    """
+    Queued, running, completed, failed, timed out and rejected Sayory requests of this worker.
+    """
+    return ai_jobs.stats()
+
+
+@router.get("/sayory-cache")
+async def sayory_cache_stats(admin: schemas.UserProfile = Depends(get_admin_user)):
+    """
+    Size, hit rate and saved upstream time of the Sayory prompt cache of this worker.
+    """
+    return prompt_cache.stats()
+
+
+@router.get("/hot-conversations")
+async def hot_conversation_stats(admin: schemas.UserProfile = Depends(get_admin_user)):
+    """
+    Size and hit rate of the in-memory recent-message buffers of this worker.
+    """
+    return manager.hot.stats()
+
+
+@router.get("/profiler")
+async def profiler_stats(admin: schemas.UserProfile = Depends(get_admin_user)):
+    """
+    Settings and counters of the slow-operation profiler of this worker.
+    """
+    return profiler.stats()
+
+
+@router.put("/profiler", status_code=status.HTTP_202_ACCEPTED)
+async def configure_profiler(config: schemas.ProfilerConfig, admin: schemas.UserProfile = Depends(get_admin_user)):
+    """
+    Turn the slow-operation profiler on or off, or change its threshold and sample rate,
+    on every worker without a restart. Profiles go to `settings.profiler_file`.
+    """
+    await manager.configure_profiler(config)
+    return config.model_dump(exclude_none=True)
@@ -1,95 +1,101 @@
 
 import logging
 from fastapi import HTTPException, status
-from pydantic import ValidationError
 from sqlalchemy.future import select
 from sqlalchemy.ext.asyncio import AsyncSession
-from typing import List, Optional
-from sqlalchemy import and_, asc, or_, update, func
+from typing import Dict, List, Optional
+from sqlalchemy import and_, desc, or_, update, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from app import models, schemas
 from app.config import settings
+from app.user_cache import user_cache
 
 from app.AI import sayory
 
-import base64
-from cryptography.fernet import Fernet, InvalidToken
+from app.crypto import async_encrypt, decrypt_cache, decrypt_many, stored_message
+from app.inbox import refresh_summary
+from app.metrics import DB_OPERATION_SECONDS
 
-# Ініціалізація шифрувальника
-key = settings.key_crypto
-cipher = Fernet(key)
-
-def is_base64(s):
-    try:
-        return base64.b64encode(base64.b64decode(s)).decode('utf-8') == s
-    except Exception:
-        return False
-
-async def async_encrypt(data: Optional[str]):
-    if data is None:
-        return None
-    
-    encrypted = cipher.encrypt(data.encode())
-    encoded_string = base64.b64encode(encrypted).decode('utf-8')
-    return encoded_string
-
-async def async_decrypt(encoded_data: Optional[str]):
-    if encoded_data is None:
-        return None
-    
-    if not is_base64(encoded_data):
-        return encoded_data
-
-    try:
-        encrypted = base64.b64decode(encoded_data.encode('utf-8'))
-        decrypted = cipher.decrypt(encrypted).decode('utf-8')
-        return decrypted
-    except InvalidToken:
-        return None  
-    
-logging.basicConfig(filename='_log/func_vote.log', format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 
 
-async def fetch_last_private_messages(session: AsyncSession, sender_id: int, receiver_id: int) -> List[dict]:
+@DB_OPERATION_SECONDS.time("fetch_history")
+async def fetch_last_private_messages(session: AsyncSession, sender_id: int, receiver_id: int,
+                                      before_id: Optional[int] = None,
+                                      limit: Optional[int] = None,
+                                      after_id: Optional[int] = None) -> List[schemas.SocketModel]:
     
     """
-    Fetch the last private messages between two users from the database.
+    Fetch one page of private messages between two users from the database, newest first.
+
+    The page is one range scan of the (conversation_id, id DESC) index, so its cost
+    does not grow with the length of the thread.
 
     Args:
     session (AsyncSession): The database session to execute the query.
     sender_id (int): The ID of the user who sent the message.
     receiver_id (int): The ID of the user who received the message.
+    before_id (Optional[int]): Keyset cursor, only messages with a smaller ID are returned.
+    limit (Optional[int]): Page size, defaults to `settings.history_page_size`.
+    after_id (Optional[int]): Only messages with a greater ID (the ones a reconnecting client missed).
 
     Returns:
-    List[dict]: A list of dictionaries containing message details.
+    List[SocketModel]: Up to `limit` messages ordered from newest to oldest.
+    """
+    if limit is None:
+        limit = settings.history_page_size
+    limit = max(1, min(limit, settings.history_page_max))
+
+    conditions = [models.PrivateMessage.conversation_id == models.conversation_key(sender_id, receiver_id)]
+    if before_id is not None:
+        conditions.append(models.PrivateMessage.id < before_id)
+    if after_id is not None:
+        conditions.append(models.PrivateMessage.id > after_id)
+    
+    query = messages_with_senders(
+        *conditions
+    ).order_by(desc(models.PrivateMessage.id)).limit(limit)
+               
+    result = await session.execute(query)
+    raw_messages = result.all()
+    watermarks = await fetch_read_watermarks(session, sender_id, receiver_id)
+    return await build_socket_messages(raw_messages, watermarks)
+
+
+@DB_OPERATION_SECONDS.time("fetch_message")
+async def fetch_private_message(session: AsyncSession, message_id: int) -> Optional[schemas.SocketModel]:
     """
+    Fetch a single private message as it is sent over the socket, None if it does not exist.
+    """
+    result = await session.execute(messages_with_senders(models.PrivateMessage.id == message_id))
+    raw_messages = result.all()
+    if not raw_messages:
+        return None
     
-    query = select(
+    private = raw_messages[0][0]
+    watermarks = await fetch_read_watermarks(session, private.sender_id, private.receiver_id)
+    messages = await build_socket_messages(raw_messages, watermarks)
+    return messages[0]
+
+
+def messages_with_senders(*conditions):
+    return select(
         models.PrivateMessage,
-        models.User,
-        func.coalesce(func.sum(models.PrivateMessageVote.dir), 0).label('vote')
+        models.User
     ).join(
         models.User, models.PrivateMessage.sender_id == models.User.id
-    ).outerjoin(
-        models.PrivateMessageVote, models.PrivateMessage.id == models.PrivateMessageVote.message_id
     ).where(
-        or_(
-            and_(models.PrivateMessage.sender_id == sender_id, models.PrivateMessage.receiver_id == receiver_id),
-            and_(models.PrivateMessage.sender_id == receiver_id, models.PrivateMessage.receiver_id == sender_id)
-            )
-    ).group_by(
-        models.PrivateMessage.id, models.User.id
-    ).order_by(asc(models.PrivateMessage.id))
-               
-    result = await session.execute(query)
-    raw_messages = result.all()
+        *conditions
+    )
+
+
+async def build_socket_messages(raw_messages, watermarks: Dict[int, int]) -> List[schemas.SocketModel]:
+    plaintexts = await decrypt_many([(private.id, stored_message(private.message_data, private.message))
+                                     for private, _ in raw_messages])
 
     messages = []
-    for private, user, votes in raw_messages:
-        decrypted_message = await async_decrypt(private.message)
-        if decrypted_message is None:
-            decrypted_message = None
+    for (private, user), decrypted_message in zip(raw_messages, plaintexts):
 
         message_data = {
             "created_at": private.created_at,
@@ -101,26 +107,22 @@ async def fetch_last_private_messages(session: AsyncSession, sender_id: int, rec
             "user_name": user.user_name,
             "verified": user.verified,
             "avatar": user.avatar,
-            "is_read": private.is_read,
-            "vote": votes,
+            # Keeps the historical wire meaning: True until the recipient has seen the message
+            "is_read": private.id > watermarks.get(private.receiver_id, 0),
+            "vote": private.vote_count,
             "edited": private.edited
         }
-        try:
-            messages.append(schemas.SocketModel(**message_data))
-        except ValidationError as e:
-            raise HTTPException(status_code=400, detail=f"Data validation error: {str(e)}")
+        # Rows come straight from our own tables, so they skip validation
+        messages.append(schemas.SocketModel.model_construct(**message_data))
             
-    messages.reverse()  # Optionally reverse the list if needed
     return messages
 
 
 
 
-async def get_recipient_by_id(session: AsyncSession, receiver_id: id):
-    recipient = await session.execute(select(models.User).filter(models.User.id == receiver_id))
-    result = recipient.scalars().first()
-    
-    return result   
+async def get_recipient_by_id(session: AsyncSession, receiver_id: int) -> Optional[schemas.UserProfile]:
+    # Shares the profile cache with oauth2.get_current_user
+    return await user_cache.get_user(session, receiver_id)
 
 
 async def unique_user_name_id(user_id: int, user_name: str):
@@ -131,31 +133,95 @@ async def unique_user_name_id(user_id: int, user_name: str):
 
 
 
-async def mark_messages_as_read(session: AsyncSession, user_id: int, sender_id: int):
+async def latest_message_id(session: AsyncSession, sender_id: int, receiver_id: int) -> Optional[int]:
+    """
+    Returns the ID of the newest message sent by `sender_id` to `receiver_id`, if any.
+    """
+    result = await session.execute(
+        select(models.PrivateMessage.id)
+        .where(models.PrivateMessage.conversation_id == models.conversation_key(sender_id, receiver_id),
+               models.PrivateMessage.sender_id == sender_id)
+        .order_by(desc(models.PrivateMessage.id))
+        .limit(1)
+    )
+    return result.scalar()
+
+
+async def fetch_read_watermarks(session: AsyncSession, user_id: int, peer_id: int) -> Dict[int, int]:
+    """
+    Returns the read watermark of both participants of a conversation.
+
+    Returns:
+        Dict[int, int]: `{reader_id: last_read_id}`, 0 for a participant who has read nothing yet.
+    """
+    result = await session.execute(
+        select(models.PrivateReadState.user_id, models.PrivateReadState.last_read_id).where(
+            or_(
+                and_(models.PrivateReadState.user_id == user_id, models.PrivateReadState.peer_id == peer_id),
+                and_(models.PrivateReadState.user_id == peer_id, models.PrivateReadState.peer_id == user_id)
+            )
+        )
+    )
+    watermarks = {user_id: 0, peer_id: 0}
+    watermarks.update(dict(result.all()))
+    return watermarks
+
+
+@DB_OPERATION_SECONDS.time("mark_read")
+async def mark_messages_as_read(session: AsyncSession, user_id: int, sender_id: int,
+                                message_id: Optional[int] = None) -> Optional[int]:
     """
-    Marks all private messages sent by a specific user as unread for a specific recipient.
+    Moves the read watermark of a user in the conversation with `sender_id` forward, in
+    the caller's transaction.
+
+    Called when a message is delivered to an open socket of the recipient, when the
+    conversation is opened and when the client acknowledges a message explicitly.
+    The watermark never moves backwards and never past the newest message of the sender.
 
     Args:
         session (AsyncSession): The database session.
         user_id (int): The ID of the recipient.
         sender_id (int): The ID of the user who sent the messages.
+        message_id (Optional[int]): The last message read, defaults to the newest one.
 
     Returns:
-        None
+        Optional[int]: The new watermark, or None when it did not move.
+    """
+    latest_id = await latest_message_id(session, sender_id, user_id)
+    if latest_id is None:
+        return None
+    if message_id is None or message_id > latest_id:
+        message_id = latest_id
+
+    stmt = pg_insert(models.PrivateReadState).values(user_id=user_id, peer_id=sender_id, last_read_id=message_id)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[models.PrivateReadState.user_id, models.PrivateReadState.peer_id],
+        set_={"last_read_id": stmt.excluded.last_read_id, "updated_at": func.now()},
+        where=models.PrivateReadState.last_read_id < stmt.excluded.last_read_id
+    ).returning(models.PrivateReadState.last_read_id)
+
+    result = await session.execute(stmt)
+    return result.scalar()
+    
+    
+async def apply_vote(session: AsyncSession, message_id: int, delta: int) -> int:
+    """
+    Atomically adds `delta` to the vote counter of a message, in the caller's transaction.
 
-    Raises:
-        HTTPException: If an error occurs while updating the database.
+    Returns:
+        int: The new vote total of the message.
     """
-    await session.execute(
+    result = await session.execute(
         update(models.PrivateMessage)
-        .where(models.PrivateMessage.receiver_id == user_id,
-               models.PrivateMessage.is_read == True).filter(models.PrivateMessage.sender_id == sender_id)
-        .values(is_read=False)
+        .where(models.PrivateMessage.id == message_id)
+        .values(vote_count=models.PrivateMessage.vote_count + delta)
+        .returning(models.PrivateMessage.vote_count)
     )
-    await session.commit()
-    
-    
-async def process_vote(vote: schemas.Vote, session: AsyncSession, current_user: models.User):
+    return result.scalar()
+
+
+@DB_OPERATION_SECONDS.time("vote")
+async def process_vote(vote: schemas.Vote, session: AsyncSession, current_user: models.User, receiver_id: int):
     """
     Processes a vote submitted by a user.
 
@@ -163,16 +229,20 @@ async def process_vote(vote: schemas.Vote, session: AsyncSession, current_user:
         vote (schemas.Vote): The vote submitted by the user.
         session (AsyncSession): The database session.
         current_user (models.User): The current user.
+        receiver_id (int): The other participant; the message must belong to this conversation.
 
     Returns:
-        dict: A message indicating the result of the vote.
+        dict: A message indicating the result of the vote and the new vote total of the message.
 
     Raises:
         HTTPException: If an error occurs while processing the vote.
     """
     try:
         # Check if the message exists
-        result = await session.execute(select(models.PrivateMessage).filter(models.PrivateMessage.id == vote.message_id))
+        result = await session.execute(select(models.PrivateMessage).filter(
+            models.PrivateMessage.id == vote.message_id,
+            models.PrivateMessage.conversation_id == models.conversation_key(current_user.id, receiver_id)
+        ))
         message = result.scalars().first()
         
         if not message:
@@ -186,28 +256,31 @@ async def process_vote(vote: schemas.Vote, session: AsyncSession, current_user:
         ))
         found_vote = vote_result.scalars().first()
         
-        # Toggle vote logic
+        # Toggle vote logic; the vote row and the counter change in one transaction
         if vote.dir == 1:
             if found_vote:
                 # If vote exists, remove it
                 await session.delete(found_vote)
+                total = await apply_vote(session, vote.message_id, -found_vote.dir)
                 await session.commit()
-                return {"message": "Successfully removed vote"}
+                return {"message": "Successfully removed vote", "vote": total}
             else:
                 # If vote does not exist, add it
                 new_vote = models.PrivateMessageVote(message_id=vote.message_id, user_id=current_user.id, dir=vote.dir)
                 session.add(new_vote)
+                total = await apply_vote(session, vote.message_id, vote.dir)
                 await session.commit()
-                return {"message": "Successfully added vote"}
+                return {"message": "Successfully added vote", "vote": total}
 
         else:
             if not found_vote:
-                return {"message": "Vote does not exist or has already been removed"}
+                return {"message": "Vote does not exist or has already been removed", "vote": message.vote_count}
             
             # Remove the vote
             await session.delete(found_vote)
+            total = await apply_vote(session, vote.message_id, -found_vote.dir)
             await session.commit()
-            return {"message": "Successfully deleted vote"}
+            return {"message": "Successfully deleted vote", "vote": total}
 
     except HTTPException as http_exc:
         logger.error(f"HTTP error occurred: {http_exc.detail}")
@@ -220,32 +293,43 @@ async def process_vote(vote: schemas.Vote, session: AsyncSession, current_user:
 
         
         
+@DB_OPERATION_SECONDS.time("edit")
 async def change_message(id_messages: int, message_update: schemas.SocketUpdate,
                          session: AsyncSession, 
-                         current_user: models.User):
+                         current_user: models.User,
+                         receiver_id: int):
     
     
-    query = select(models.PrivateMessage).where(models.PrivateMessage.id == id_messages, models.PrivateMessage.sender_id == current_user.id)
+    query = select(models.PrivateMessage).where(models.PrivateMessage.id == id_messages, models.PrivateMessage.sender_id == current_user.id,
+                                                models.PrivateMessage.conversation_id == models.conversation_key(current_user.id, receiver_id))
     result = await session.execute(query)
     messages = result.scalar()
 
     if messages is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Message not found or you don't have permission to edit this message")
 
-    messages.message = message_update.message
+    messages.message_data = await async_encrypt(message_update.message)
+    messages.message = None
     messages.edited = True
     session.add(messages)
+    await session.flush()
+    # The edited message may be the inbox preview of the conversation
+    inbox = await refresh_summary(session, current_user.id, receiver_id)
     await session.commit()
+    decrypt_cache.invalidate(id_messages)
 
-    return {"message": "Message updated successfully"}
+    return {"message": "Message updated successfully", "inbox": inbox}
 
 
+@DB_OPERATION_SECONDS.time("delete")
 async def delete_message(id_message: int,
                          session: AsyncSession, 
-                         current_user: models.User):
+                         current_user: models.User,
+                         receiver_id: int):
     
     
-    query = select(models.PrivateMessage).where(models.PrivateMessage.id == id_message, models.PrivateMessage.sender_id == current_user.id)
+    query = select(models.PrivateMessage).where(models.PrivateMessage.id == id_message, models.PrivateMessage.sender_id == current_user.id,
+                                                models.PrivateMessage.conversation_id == models.conversation_key(current_user.id, receiver_id))
     result = await session.execute(query)
     message = result.scalar()
 
@@ -253,9 +337,13 @@ async def delete_message(id_message: int,
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Message not found or you don't have permission to delete this message")
 
     await session.delete(message)
+    await session.flush()
+    # Same transaction: the summaries never point at a message that is gone
+    inbox = await refresh_summary(session, current_user.id, receiver_id)
     await session.commit()
+    decrypt_cache.invalidate(id_message)
 
-    return {"message": "Message deleted successfully"}
+    return {"message": "Message deleted successfully", "inbox": inbox}
 
 
     
@@ -0,0 +1,69 @@
+import asyncio
+import time
+from typing import Optional
+from fastapi import APIRouter, Response, status
+
+from app.config import settings
+from app.database import ping_database, pool_status
+
+router = APIRouter(prefix="/health", tags=['Health'])
+
+
+class StartupState:
+    """
+    Tracks the cold start of the worker: from import of the app to the end of the
+    lifespan startup (pool warmed, broker subscribed).
+    """
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.ready_at: Optional[float] = None
+        self.warmed_connections = 0
+
+    def mark_ready(self, warmed_connections: int):
+        self.warmed_connections = warmed_connections
+        self.ready_at = time.monotonic()
+
+    @property
+    def startup_seconds(self) -> Optional[float]:
+        if self.ready_at is None:
+            return None
+        return round(self.ready_at - self.started_at, 3)
+
+
+startup = StartupState()
+
+
+@router.get("/live")
+async def live():
+    """
+    Liveness probe: the process is up and serving its event loop. Never touches the database.
+    """
+    return {"status": "ok"}
+
+
+@router.get("/ready")
+async def ready(response: Response):
+    """
+    Readiness probe: startup finished and the database answers. Reports the pool state and
+    the cold-start time of this worker; responds 503 while not ready.
+    """
+    body = {
+        "status": "ok",
+        "startup_seconds": startup.startup_seconds,
+        "warmed_connections": startup.warmed_connections,
+        "pool": pool_status(),
+    }
+
+    if startup.ready_at is None:
+        body["status"] = "starting"
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        return body
+
+    try:
+        await asyncio.wait_for(ping_database(), settings.db_pool_timeout)
+    except Exception as e:
+        body["status"] = "unavailable"
+        body["error"] = str(e)
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return body
@@ -0,0 +1,24 @@
+from typing import List, Optional
+from fastapi import APIRouter, Depends, Query
+from sqlalchemy.ext.asyncio import AsyncSession
+from app import oauth2, schemas
+from app.database import get_async_session
+from app.inbox import fetch_inbox
+
+router = APIRouter(tags=['Inbox'])
+
+
+@router.get("/inbox", response_model=List[schemas.InboxEntry])
+async def get_inbox(
+    before_id: Optional[int] = None,
+    limit: Optional[int] = Query(None, ge=1),
+    session: AsyncSession = Depends(get_async_session),
+    current_user: schemas.UserProfile = Depends(oauth2.get_current_user)
+):
+    """
+    Return one page of the conversations of the current user: the peer profile, a preview
+    of the last message and the number of unread messages, most recent conversation first.
+
+    Pass the `last_message_id` of the last entry received as `before_id` to get the next page.
+    """
+    return await fetch_inbox(session, current_user.id, before_id, limit)
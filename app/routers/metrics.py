@@ -0,0 +1,52 @@
+from fastapi import APIRouter, Response
+
+from app.AI.jobs import ai_jobs
+from app.database import pool_status
+from app.logging_setup import logging_stats
+from app.metrics import REGISTRY, Gauge
+from .private_messages import manager
+
+router = APIRouter(tags=['Metrics'])
+
+# Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def connection_gauges() -> dict:
+    sockets = [connection for connections in manager.connections.values() for connection in connections]
+    return {("sockets",): len(sockets), ("users",): len(manager.connections),
+            ("multiplexed",): sum(1 for connection in sockets if connection.multiplexed)}
+
+
+def outbound_depth() -> dict:
+    depths = [len(connection.outbound.frames)
+              for connections in manager.connections.values() for connection in connections]
+    return {("total",): sum(depths), ("max",): max(depths, default=0)}
+
+
+def outbound_dropped() -> float:
+    return sum(connection.outbound.dropped
+               for connections in manager.connections.values() for connection in connections)
+
+
+# Read from the live objects at scrape time, so they cost nothing between scrapes
+Gauge("pm_ws_connections", "Websockets held by this worker.", ["kind"], function=connection_gauges)
+Gauge("pm_ws_outbound_queue_depth", "Frames waiting in the outbound queues of this worker.", ["aggregate"],
+      function=outbound_depth)
+Gauge("pm_ws_outbound_dropped_frames", "Frames dropped by the outbound queues of the open sockets.",
+      function=outbound_dropped)
+Gauge("pm_db_pool_connections", "Connections of the database pool, by state.", ["state"],
+      function=lambda: {(state,): value for state, value in pool_status().items()})
+Gauge("pm_ai_jobs", "Sayory requests of this worker, by state.", ["state"],
+      function=lambda: {("pending",): ai_jobs.size, ("running",): len(ai_jobs.running)})
+Gauge("pm_hot_cache_bytes", "Memory used by the recent-message buffers.", function=lambda: manager.hot.size)
+Gauge("pm_log_records", "Log records waiting for the writer thread, and dropped because it fell behind.",
+      ["state"], function=lambda: {(state,): value for state, value in logging_stats().items()})
+
+
+@router.get("/metrics")
+async def metrics():
+    """
+    Latency histograms, counters and gauges of this worker in the Prometheus text format.
+    """
+    return Response(content=REGISTRY.render(), media_type=CONTENT_TYPE)
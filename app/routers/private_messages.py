@@ -1,33 +1,383 @@
 import asyncio
+import functools
 import logging
 import json
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, HTTPException, status
-from app.connection_manager import ConnectionManagerPrivate
-from app.database import get_async_session
+import time
+import uuid
+from typing import List, Optional
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, HTTPException, Query, status
+from app.connection_manager import Connection, ConnectionManagerPrivate
+from app.database import async_session_maker, get_async_session
 from app import oauth2, schemas
+from app.config import settings
 from sqlalchemy.ext.asyncio import AsyncSession
-from .func_private import change_message, delete_message, fetch_last_private_messages, mark_messages_as_read, process_vote
+from .func_private import change_message, delete_message, fetch_last_private_messages, process_vote
 from .func_private import get_recipient_by_id
+from app.commands import CommandDispatcher, CommandError, ordering_key, parse_command, request_id_of
+from app.inbox import fetch_inbox
+from app.metrics import WS_COMMAND_SECONDS
+from app.profiler import profiler
 from app.AI import sayory
+from app.AI.jobs import AiQueueFull, ai_jobs
 
-# Налаштування логування
-logging.basicConfig(filename='_log/private_message.log', format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
 manager = ConnectionManagerPrivate()
 
 
+@router.get("/private/{receiver_id}/messages", response_model=List[schemas.SocketModel])
+async def get_private_messages(
+    receiver_id: int,
+    before_id: Optional[int] = None,
+    limit: Optional[int] = Query(None, ge=1),
+    session: AsyncSession = Depends(get_async_session),
+    current_user: schemas.UserProfile = Depends(oauth2.get_current_user)
+):
+    """
+    Return one page of the conversation with `receiver_id`, newest first.
+
+    Pass the ID of the oldest message received as `before_id` to get the next (older) page.
+    """
+    return await fetch_last_private_messages(session, current_user.id, receiver_id, before_id, limit)
+
 
 
     
 
+async def send_history_page(connection: Connection, peer_id: int,
+                            messages: List[schemas.SocketModel], batch: bool = False):
+    """
+    Send one history page of the conversation with `peer_id`: a header with the cursor of
+    the next (older) page, then the messages from oldest to newest.
+
+    With `batch` the page goes out as a single `history` frame instead (see `history_frame`).
+    """
+    next_before_id = messages[-1].id if messages else None
+    if batch:
+        connection.push(json.dumps(history_frame(messages, next_before_id), default=str), peer_id)
+        return
+
+    # Queued back to back without yielding, so no reply of a concurrent command lands inside the page
+    frames = [json.dumps({"message": "History page", "next_before_id": next_before_id})]
+    frames.extend(message.model_dump_json() for message in reversed(messages))
+    for frame in frames:
+        connection.push(frame, peer_id)
+
+
+def history_frame(messages: List[schemas.SocketModel], next_before_id: Optional[int]) -> dict:
+    """
+    Build the batched history frame. Sender profile fields are sent once per sender in
+    `users` (keyed by the `receiver_id` of the messages, which is the sender's id), and
+    the messages carry only their own fields, oldest first.
+    """
+    users = {}
+    rows = []
+    for message in reversed(messages):
+        if message.receiver_id not in users:
+            users[message.receiver_id] = {
+                "user_name": message.user_name,
+                "avatar": message.avatar,
+                "verified": message.verified,
+            }
+        rows.append({
+            "id": message.id,
+            "created_at": message.created_at.isoformat(),
+            "receiver_id": message.receiver_id,
+            "message": message.message,
+            "fileUrl": message.fileUrl,
+            "id_return": message.id_return,
+            "is_read": message.is_read,
+            "vote": message.vote,
+            "edited": message.edited,
+        })
+    return {"type": "history", "next_before_id": next_before_id, "users": users, "messages": rows}
+
+
+@WS_COMMAND_SECONDS.time("open")
+async def open_conversation(connection: Connection, user: schemas.UserProfile, peer_id: int,
+                            batch_history: bool = False, last_seen_id: Optional[int] = None):
+    """
+    Mark the conversation with `peer_id` as read and send its newest history page, or
+    with `last_seen_id` only the messages the client missed since then.
+
+    The page comes from the manager's in-memory buffer of the conversation when it can
+    answer, so reconnect storms do not reach the database. For the same reason the
+    watermark is not written when the buffer shows everything is already read.
+    """
+    if manager.has_unread(user.id, peer_id) is not False:
+        await manager.mark_read(user.id, peer_id)
+    messages = manager.recent_messages(user.id, peer_id, last_seen_id)
+    if messages is None:
+        limit = settings.history_page_size if last_seen_id is None else settings.history_page_max
+        async with async_session_maker() as session:
+            messages = await fetch_last_private_messages(session, user.id, peer_id,
+                                                         limit=limit, after_id=last_seen_id)
+        manager.remember_page(user.id, peer_id, messages, limit, last_seen_id)
+    await send_history_page(connection, peer_id, messages, batch_history)
+
+
+def ack_frame(message: Optional[str], request_id=None, command: Optional[str] = None,
+              ok: bool = True, **fields) -> Optional[dict]:
+    """
+    The reply to a command: `{"message": ...}` as before, plus `type`, `request_id`,
+    `command`, `ok` and the result fields when the client sent a request id to match it
+    against. Without a request id, commands that never had a reply still have none.
+    """
+    if request_id is None:
+        return None if message is None else {"message": message}
+    frame = {"type": "ack", "request_id": request_id, "command": command, "ok": ok, **fields}
+    if message is not None:
+        frame["message"] = message
+    return frame
+
+
+async def reply(connection: Connection, command: schemas.CommandBase, peer_id: int,
+                message: Optional[str] = None, ok: bool = True, **fields):
+    frame = ack_frame(message, command.request_id, command.type, ok, **fields)
+    if frame is not None:
+        await connection.send_json(frame, peer_id)
+
+
+async def vote_command(connection: Connection, user: schemas.UserProfile, peer_id: int,
+                       command: schemas.VoteCommand, batch_history: bool):
+    try:
+        async with async_session_maker() as session:
+            result = await process_vote(command, session, user, peer_id)
+
+        await reply(connection, command, peer_id, "Vote posted ", vote=result["vote"])
+        await manager.send_private_event(
+            schemas.VoteChangedEvent(message_id=command.message_id, vote=result["vote"]),
+            user.id, peer_id
+        )
+
+    except Exception as e:
+        logger.error(f"Error processing vote: {e}", exc_info=True)  # Запис помилки
+        await reply(connection, command, peer_id, f"Error processing vote: {e}", ok=False)
+
+
+async def delete_message_command(connection: Connection, user: schemas.UserProfile, peer_id: int,
+                                 command: schemas.DeleteMessageCommand, batch_history: bool):
+    try:
+        async with async_session_maker() as session:
+            result = await delete_message(command.id, session, user, peer_id)
+
+        await reply(connection, command, peer_id, "Message deleted.")
+        await manager.send_private_event(schemas.MessageDeletedEvent(id=command.id), user.id, peer_id)
+        await manager.publish_inbox(result["inbox"])
+
+    except Exception as e:
+        logger.error(f"Error processing delete: {e}", exc_info=True)
+        await reply(connection, command, peer_id, f"Error processing delete: {e}", ok=False)
+
+
+async def change_message_command(connection: Connection, user: schemas.UserProfile, peer_id: int,
+                                 command: schemas.ChangeMessageCommand, batch_history: bool):
+    try:
+        async with async_session_maker() as session:
+            result = await change_message(command.id, command, session, user, peer_id)
+
+        await reply(connection, command, peer_id, "Message updated ")
+        await manager.send_private_event(
+            schemas.MessageUpdatedEvent(id=command.id, message=command.message), user.id, peer_id
+        )
+        await manager.publish_inbox(result["inbox"])
+
+    except Exception as e:
+        logger.error(f"Error processing change: {e}", exc_info=True)
+        await reply(connection, command, peer_id, f"Error processing change: {e}", ok=False)
+
+
+async def read_command(connection: Connection, user: schemas.UserProfile, peer_id: int,
+                       command: schemas.ReadCommand, batch_history: bool):
+    try:
+        await manager.mark_read(user.id, peer_id, command.message_id)
+        await reply(connection, command, peer_id)
+
+    except Exception as e:
+        logger.error(f"Error processing read ack: {e}", exc_info=True)
+        await reply(connection, command, peer_id, f"Error processing read ack: {e}", ok=False)
+
+
+async def load_more_command(connection: Connection, user: schemas.UserProfile, peer_id: int,
+                            command: schemas.LoadMoreCommand, batch_history: bool):
+    try:
+        async with async_session_maker() as session:
+            messages = await fetch_last_private_messages(session, user.id, peer_id,
+                                                         command.before_id, command.limit)
+        await send_history_page(connection, peer_id, messages, batch_history)
+        await reply(connection, command, peer_id, next_before_id=messages[-1].id if messages else None)
+
+    except Exception as e:
+        logger.error(f"Error loading history: {e}", exc_info=True)
+        await reply(connection, command, peer_id, f"Error loading history: {e}", ok=False)
+
+
+async def send_command(connection: Connection, user: schemas.UserProfile, peer_id: int,
+                       command: schemas.SendCommand, batch_history: bool):
+    try:
+        # Відправка повідомлення користувача, незалежно від ID одержувача
+        message_id = await manager.send_private_all(
+            message=command.message,
+            file=command.fileUrl,
+            receiver_id=peer_id,
+            sender_id=user.id,
+            user_name=user.user_name,
+            avatar=user.avatar,
+            verified=user.verified,
+            id_return=command.original_message_id,
+            is_read=True
+        )
+        logger.info("Sent message", extra={"user_id": user.id, "peer_id": peer_id, "message_id": message_id,
+                                           "has_file": command.fileUrl is not None, "body": command.message})
+        await reply(connection, command, peer_id, message_id=message_id)
+    except Exception as e:
+        logger.error(f"Error sending message: {e}", exc_info=True)
+        await reply(connection, command, peer_id, f"Error sending message: {e}", ok=False)
+
+    if peer_id == settings.sayory_user_id:
+        async def report_error(e: Exception):
+            connection.push(json.dumps({"message": f"Error processing GPT query: {e}"}), peer_id)
+
+        try:
+            # Answered by an AI worker; this socket keeps handling commands meanwhile
+            ai_jobs.submit(user.id, connection,
+                           lambda: reply_as_sayory(user.id, peer_id, command.message,
+                                                   command.fileUrl, command.original_message_id),
+                           report_error)
+        except AiQueueFull as e:
+            await connection.send_json({"message": f"Error processing GPT query: {e}"}, peer_id)
+
+
+# Commands of one conversation, by `type` (see app.commands and schemas.Command)
+COMMAND_HANDLERS = {
+    "vote": vote_command,
+    "delete_message": delete_message_command,
+    "change_message": change_message_command,
+    "read": read_command,
+    "load_more": load_more_command,
+    "send": send_command,
+}
+
+
+async def handle_command(connection: Connection, user: schemas.UserProfile, receiver_id: int,
+                         command: schemas.CommandBase, batch_history: bool = False):
+    """
+    Handle one command of the conversation with `receiver_id`, for both the
+    per-conversation and the multiplexed endpoint. Replies go to `connection` only,
+    delta events to every device of both participants.
+    """
+    started = time.perf_counter()
+    try:
+        async with profiler.profile(f"command:{command.type}", user_id=user.id, peer_id=receiver_id):
+            await COMMAND_HANDLERS[command.type](connection, user, receiver_id, command, batch_history)
+    finally:
+        WS_COMMAND_SECONDS.observe(time.perf_counter() - started, command.type)
+
+
+async def dispatch_command(dispatcher: CommandDispatcher, connection: Connection, user: schemas.UserProfile,
+                           receiver_id: int, command: schemas.CommandBase, batch_history: bool = False):
+    """
+    Start `command` on the socket's dispatcher: the receive loop goes on reading while it runs.
+    """
+    if command.type not in COMMAND_HANDLERS:
+        await connection.send_json(ack_frame("Unknown command.", command.request_id, command.type, ok=False),
+                                   receiver_id)
+        return
+    await dispatcher.submit(ordering_key(command, receiver_id),
+                            functools.partial(handle_command, connection, user, receiver_id, command,
+                                              batch_history))
+
+
+async def reply_as_sayory(user_id: int, sayory_id: int, message: str,
+                          file_url: Optional[str], id_return: Optional[int]) -> str:
+    """
+    Stream the answer of Sayory to `message`.
+
+    Text chunks are pushed to the sockets of `user_id` as `ai_delta` events (at most one per
+    `sayory_delta_interval_ms`); the complete answer is stored once at the end and sent as a
+    normal message, followed by a final `ai_delta` with `done` and its `message_id`.
+
+    If the stream fails part way, the fallback reply is appended to what arrived, so the
+    stored answer does not read as complete, and the final `ai_delta` is marked `truncated`.
+
+    Returns:
+        str: The stored answer.
+    """
+    stream_id = uuid.uuid4().hex
+    loop = asyncio.get_running_loop()
+    interval = settings.sayory_delta_interval_ms / 1000
+    parts, pending = [], []
+    truncated = False
+    last_push = loop.time()
+
+    try:
+        async for chunk in sayory.stream_reply(message):
+            parts.append(chunk)
+            pending.append(chunk)
+            if loop.time() - last_push >= interval:
+                manager.push_local(schemas.AiDeltaEvent(stream_id=stream_id, id_return=id_return,
+                                                        delta="".join(pending)), user_id, sayory_id)
+                pending = []
+                last_push = loop.time()
+    except Exception as e:
+        logger.error(f"Error streaming GPT response: {e}", exc_info=True)
+        if not parts:
+            parts = pending = [sayory.fallback_reply]
+        else:
+            truncated = True
+            suffix = f"\n\n{sayory.fallback_reply}"
+            parts.append(suffix)
+            pending.append(suffix)
+
+    if pending:
+        manager.push_local(schemas.AiDeltaEvent(stream_id=stream_id, id_return=id_return,
+                                                delta="".join(pending)), user_id, sayory_id)
+
+    reply = "".join(parts)
+    message_id = await manager.send_private_all(
+        message=reply,
+        file=file_url,
+        receiver_id=user_id,
+        sender_id=sayory_id,
+        user_name=settings.sayory_user_name,
+        avatar=settings.sayory_avatar,
+        verified=True,
+        id_return=id_return,
+        is_read=True
+    )
+    manager.push_local(schemas.AiDeltaEvent(stream_id=stream_id, id_return=id_return, done=True,
+                                            message_id=message_id, truncated=truncated), user_id, sayory_id)
+    logger.info("Sent Sayory response", extra={"user_id": user_id, "message_id": message_id, "reply": reply,
+                                               "truncated": truncated})
+    return reply
+
+
+async def send_inbox_page(connection: Connection, user: schemas.UserProfile, command: schemas.InboxCommand):
+    """
+    Send one page of the conversation list of `user` (see `GET /inbox`) on a multiplexed socket.
+    """
+    try:
+        async with async_session_maker() as session:
+            entries = await fetch_inbox(session, user.id, command.before_id, command.limit)
+        frame = {"type": "inbox", "entries": [entry.model_dump(mode="json") for entry in entries]}
+        if command.request_id is not None:
+            frame["request_id"] = command.request_id
+        connection.push_raw(json.dumps(frame, ensure_ascii=False))
+
+    except Exception as e:
+        logger.error(f"Error loading inbox: {e}", exc_info=True)
+        connection.push_raw(json.dumps(ack_frame(f"Error loading inbox: {e}", command.request_id,
+                                                 command.type, ok=False)))
+
+
 @router.websocket("/private/{receiver_id}")
 async def web_private_endpoint(
     websocket: WebSocket,
     receiver_id: int,
     token: str,
-    session: AsyncSession = Depends(get_async_session)
+    batch_history: bool = False,
+    last_seen_id: Optional[int] = None
 ):
     
     """
@@ -37,158 +387,143 @@ async def web_private_endpoint(
     websocket (WebSocket): The WebSocket connection instance.
     recipient_id (int): The ID of the message recipient.
     token (str): The authentication token of the current user.
-    session (AsyncSession): The database session, injected by dependency.
+    batch_history (bool): Send history pages as one `history` frame instead of one frame per message.
+    last_seen_id (Optional[int]): On reconnect, the ID of the newest message the client has;
+        only the messages after it are sent instead of the newest page.
+
+    The socket does not hold a database session: authentication and every command open
+    their own short-lived session, so idle sockets do not pin pool connections.
 
     Operations:
     - Authenticates the current user.
     - Establishes a WebSocket connection.
-    - Fetches and sends the last private messages to the connected client.
+    - Marks the conversation as read and sends a `read_receipt` event when the watermark moves.
+    - Fetches and sends the newest page of private messages to the connected client.
+    - Sends older pages on `load_more` commands (`before_id`/`limit` keyset cursor).
     - Listens for incoming messages and handles sending and receiving of private messages.
+    - Accepts versioned commands (`{"v": 1, "type": "send", "request_id": "r1", "message": ...}`)
+      as well as the legacy `{"send": {...}}` form, and runs up to `ws_command_concurrency` of
+      them at once (see `app.commands`); replies to commands with a `request_id` are `ack`
+      frames carrying it, so clients can pipeline commands and match the answers.
+    - Pushes `message_updated`, `message_deleted` and `vote_changed` delta events to both
+      participants after edits, deletes and votes instead of re-sending the history.
     - Disconnects on WebSocket disconnect event.
+
+    Clients following several conversations should use the multiplexed `/ws` endpoint.
     """
     
     
-    user = await oauth2.get_current_user(token, session)
-    recipient = await get_recipient_by_id(session, receiver_id)
+    async with async_session_maker() as session:
+        user = await oauth2.get_current_user(token, session)
+        recipient = await get_recipient_by_id(session, receiver_id)
     if not recipient:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail="Recipient not found.")
    
-    await manager.connect(websocket, user.id, receiver_id)
-    await mark_messages_as_read(session, user.id, receiver_id)
-    messages = await fetch_last_private_messages(session, user.id, receiver_id)
-    messages.reverse()
+    connection = await manager.connect(websocket, user.id, receiver_id)
+    dispatcher = CommandDispatcher(settings.ws_command_concurrency)
     
-    
-    for message in messages:  
-        message_json = message.json()
-        await websocket.send_text(message_json)
-    
-    async def periodic_task():
-        while True:
-            await mark_messages_as_read(session, user.id, receiver_id)
-            await asyncio.sleep(1)  # чекає 1 секунду
-    
-    task = asyncio.create_task(periodic_task())
-
     try:
+        await open_conversation(connection, user, receiver_id, batch_history, last_seen_id)
         while True:
             data = await websocket.receive_json()
-            if 'vote' in data:
-                try:
-                    vote_data = schemas.Vote(**data['vote'])
-                    await process_vote(vote_data, session, user)
-                 
-                    messages = await fetch_last_private_messages(session, user.id, receiver_id)
-                    
-                    await websocket.send_json({"message": "Vote posted "})
-                    messages.reverse()
-    
-                    for message in messages:  
-                        message_json = message.model_dump_json()
-                        await websocket.send_text(message_json)
-                                
-
-                except Exception as e:
-                    logger.error(f"Error processing vote: {e}", exc_info=True)  # Запис помилки
-                    await websocket.send_json({"message": f"Error processing vote: {e}"})
-                
-            # Block delete message       
-            elif 'delete_message' in data:
-                try:
-                    message_data = schemas.SocketDelete(**data['delete_message'])
-                    await delete_message(message_data.id, session, user)
-                    
-                    messages = await fetch_last_private_messages(session, user.id, receiver_id)
-                    
-                    await websocket.send_json({"message": "Message deleted."})
-                    messages.reverse()
-    
-                    for message in messages:  
-                        message_json = message.model_dump_json()
-                        await websocket.send_text(message_json)
-                
-                                
-                except Exception as e:
-                    logger.error(f"Error processing delete: {e}", exc_info=True)
-                    await websocket.send_json({"message": f"Error processing change: {e}"})
-                    
-            elif 'change_message' in data:
-                try:
-                    message_data = schemas.SocketUpdate(**data['change_message'])
-                    await change_message(message_data.id, message_data, session, user)
-                    
-                    messages = await fetch_last_private_messages(session, user.id, receiver_id)
-                    
-                    await websocket.send_json({"message": "Message updated "})
-                    messages.reverse()
-                        
-                    for message in messages:  
-                        message_json =  message.model_dump_json()
-                        await websocket.send_text(message_json)
-                    
-
-                except Exception as e:
-                    logger.error(f"Error processing vote: {e}", exc_info=True)  # Запис помилки
-                    await websocket.send_json({"message": f"Error processing change: {e}"})
-
-                
-            elif 'send' in data:
-                
-                message_data = data['send']
-                original_message_id = message_data['original_message_id']
-                original_message = message_data['message']
-                file_url = message_data['fileUrl']
-                    
-                try:
-                    # Відправка повідомлення користувача, незалежно від ID одержувача
-                    await manager.send_private_all(
-                        message=original_message,
-                        file=file_url,
-                        receiver_id=receiver_id,
-                        sender_id=user.id,
-                        user_name=user.user_name,
-                        avatar=user.avatar,
-                        verified=user.verified,
-                        id_return=original_message_id,
-                        is_read=True
-                    )
-                    await mark_messages_as_read(session, user.id, receiver_id)
-                    logger.info(f"Sent message: {original_message}")
-                except Exception as e:
-                    logger.error(f"Error sending message: {e}", exc_info=True)
-                    await websocket.send_json({"message": f"Error sending message: {e}"})
-
-                if receiver_id == 2:
-                    try:
-                        response_sayory = await sayory.ask_to_gpt(original_message)
-                        
-                        for message in response_sayory:
-                            await manager.send_private_all(
-                                message=message,
-                                file=file_url,
-                                receiver_id=user.id,
-                                sender_id=receiver_id,
-                                user_name="SayOry",
-                                avatar="https://tygjaceleczftbswxxei.supabase.co/storage/v1/object/public/image_bucket/inne/image/girl_5.webp",
-                                verified=True,
-                                id_return=original_message_id,
-                                is_read=True
-                            )
-                            await asyncio.sleep(1)
-                        await mark_messages_as_read(session, user.id, receiver_id)
-                        logger.info(f"Sent GPT response: {response_sayory}")
-                    except Exception as e:
-                        logger.error(f"Error processing GPT query: {e}", exc_info=True)
-                        await websocket.send_json({"message": f"Error processing GPT query: {e}"})
-                        
-                
+            try:
+                command = parse_command(data)
+            except CommandError as e:
+                await connection.send_json(ack_frame(str(e), request_id_of(data), ok=False), receiver_id)
+                continue
+            await dispatch_command(dispatcher, connection, user, receiver_id, command, batch_history)
                                             
     except WebSocketDisconnect:
-        task.cancel()
-        await manager.disconnect(user.id, receiver_id)
+        pass
     finally:
-        await session.close()
-        print("Session closed")
+        await dispatcher.close()
+        ai_jobs.cancel(connection)
+        await manager.disconnect(connection)
+        logger.debug("Session closed", extra={"user_id": user.id, "peer_id": receiver_id})
 
 
+@router.websocket("/ws")
+async def web_multiplexed_endpoint(
+    websocket: WebSocket,
+    token: str,
+    batch_history: bool = False
+):
+    """
+    Multiplexed WebSocket endpoint: one socket per user device for any number of conversations.
+
+    Args:
+    websocket (WebSocket): The WebSocket connection instance.
+    token (str): The authentication token of the current user.
+    batch_history (bool): Send history pages as one `history` frame instead of one frame per message.
+
+    Every command carries the conversation in `peer_id`:
+    - `{"peer_id": 5, "subscribe": {}}` follows the conversation with user 5, marks it as
+      read and sends its newest history page; `{"subscribe": {"last_seen_id": 120}}` sends
+      only the messages after 120 instead.
+    - `{"peer_id": 5, "unsubscribe": {}}` stops following it.
+    - `{"inbox": {"before_id": ..., "limit": ...}}` (no `peer_id`) sends one page of the
+      conversation list as an unwrapped `{"type": "inbox", "entries": [...]}` frame.
+    - Any command of `/private/{receiver_id}` (`send`, `vote`, `load_more`, ...) with
+      `peer_id` in place of `receiver_id`.
+    - The versioned form of each: `{"v": 1, "type": "subscribe", "peer_id": 5, "request_id": "r1"}`.
+
+    Every frame sent to the client is wrapped as `{"peer_id": 5, "frame": {...}}`, where
+    `frame` is exactly what `/private/5` would have sent. Changes to the conversation list
+    (new messages, reads, edits and deletes in any conversation, followed or not) arrive
+    as `inbox_updated` frames, wrapped with the `peer_id` of the conversation.
+    """
+    async with async_session_maker() as session:
+        user = await oauth2.get_current_user(token, session)
+
+    connection = await manager.connect(websocket, user.id)
+    dispatcher = CommandDispatcher(settings.ws_command_concurrency)
+
+    try:
+        while True:
+            data = await websocket.receive_json()
+            try:
+                command = parse_command(data)
+            except CommandError as e:
+                connection.push_raw(json.dumps(ack_frame(str(e), request_id_of(data), ok=False)))
+                continue
+
+            if command.type == "inbox":
+                await dispatcher.submit(ordering_key(command, None),
+                                        functools.partial(send_inbox_page, connection, user, command))
+                continue
+
+            peer_id = command.peer_id
+            if peer_id is None:
+                connection.push_raw(json.dumps(ack_frame("peer_id is required.", command.request_id, command.type,
+                                                         ok=False)))
+                continue
+
+            if command.type == "subscribe":
+                async with async_session_maker() as session:
+                    recipient = await get_recipient_by_id(session, peer_id)
+                if not recipient:
+                    await connection.send_json(ack_frame("Recipient not found.", command.request_id, command.type,
+                                                         ok=False), peer_id)
+                    continue
+                await manager.subscribe(connection, peer_id)
+                await open_conversation(connection, user, peer_id, batch_history, command.last_seen_id)
+                await reply(connection, command, peer_id)
+
+            elif command.type == "unsubscribe":
+                await manager.unsubscribe(connection, peer_id)
+                await reply(connection, command, peer_id)
+
+            elif peer_id not in connection.peers:
+                await connection.send_json(ack_frame("Subscribe to the conversation first.", command.request_id,
+                                                     command.type, ok=False), peer_id)
+
+            else:
+                await dispatch_command(dispatcher, connection, user, peer_id, command, batch_history)
+
+    except WebSocketDisconnect:
+        pass
+    finally:
+        await dispatcher.close()
+        ai_jobs.cancel(connection)
+        await manager.disconnect(connection)
@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Literal, Optional, Union
 from pydantic import BaseModel, Field
 from typing import Annotated
 from pydantic import BaseModel
@@ -32,11 +32,133 @@ class SocketUpdate(BaseModel):
 class SocketDelete(BaseModel):
     id: int
 
+class MessageUpdatedEvent(BaseModel):
+    type: Literal["message_updated"] = "message_updated"
+    id: int
+    message: Optional[str] = None
+    edited: bool = True
+
+class MessageDeletedEvent(BaseModel):
+    type: Literal["message_deleted"] = "message_deleted"
+    id: int
+
+class VoteChangedEvent(BaseModel):
+    type: Literal["vote_changed"] = "vote_changed"
+    message_id: int
+    vote: int
+
+class ReadReceiptEvent(BaseModel):
+    type: Literal["read_receipt"] = "read_receipt"
+    user_id: int
+    last_read_id: int
+
+class AiDeltaEvent(BaseModel):
+    type: Literal["ai_delta"] = "ai_delta"
+    stream_id: str
+    id_return: Optional[int] = None
+    delta: str = ""
+    done: bool = False
+    message_id: Optional[int] = None
+    # The upstream stream failed part way; the stored answer ends with the fallback reply
+    truncated: bool = False
+
+class InboxEntry(BaseModel):
+    peer_id: int
+    user_name: str
+    avatar: str
+    verified: bool
+    last_message_id: int
+    last_sender_id: int
+    last_message: Optional[str] = None
+    last_file_url: Optional[str] = None
+    last_message_at: datetime
+    unread_count: int
+
+class InboxUpdatedEvent(BaseModel):
+    # No message text: the event may travel over an external broker.
+    # `last_message_id` is None when the conversation has no messages left.
+    type: Literal["inbox_updated"] = "inbox_updated"
+    peer_id: int
+    last_message_id: Optional[int] = None
+    last_sender_id: Optional[int] = None
+    last_message_at: Optional[datetime] = None
+    unread_count: int = 0
+
+class ReadAck(BaseModel):
+    message_id: Optional[int] = None
+
+class HistoryPage(BaseModel):
+    before_id: Optional[int] = None
+    limit: Optional[Annotated[int, Field(ge=1)]] = None
+
     
 class TokenData(BaseModel):
     id: Optional[int] = None
+    exp: Optional[float] = None
+
+class UserProfile(BaseModel):
+    id: int
+    user_name: str
+    avatar: str
+    verified: bool
+    blocked: bool = False
+    role: Optional[str] = None
+    
+    class Config:
+        from_attributes = True
     
 class Vote(BaseModel):
     message_id: int
     dir: Annotated[int, Field(strict=True, le=1)]
     
+
+class ProfilerConfig(BaseModel):
+    enabled: Optional[bool] = None
+    threshold_ms: Optional[Annotated[float, Field(ge=0)]] = None
+    sample_rate: Optional[Annotated[float, Field(ge=0, le=1)]] = None
+    interval_ms: Optional[Annotated[float, Field(ge=1)]] = None
+
+# Websocket command protocol (see app.commands): `{"v": 1, "type": "vote", "request_id": "r1",
+# "message_id": 7, "dir": 1}`; the legacy `{"vote": {...}}` frames are normalized into it
+class CommandBase(BaseModel):
+    v: Literal[1] = 1
+    request_id: Optional[Union[Annotated[str, Field(max_length=64)], int]] = None
+    # The conversation, on the multiplexed socket
+    peer_id: Optional[int] = None
+
+class VoteCommand(CommandBase, Vote):
+    type: Literal["vote"]
+
+class DeleteMessageCommand(CommandBase, SocketDelete):
+    type: Literal["delete_message"]
+
+class ChangeMessageCommand(CommandBase, SocketUpdate):
+    type: Literal["change_message"]
+
+class ReadCommand(CommandBase, ReadAck):
+    type: Literal["read"]
+
+class LoadMoreCommand(CommandBase, HistoryPage):
+    type: Literal["load_more"]
+
+class SendCommand(CommandBase):
+    type: Literal["send"]
+    message: Optional[str] = None
+    fileUrl: Optional[str] = None
+    original_message_id: Optional[int] = None
+
+class SubscribeCommand(CommandBase):
+    type: Literal["subscribe"]
+    last_seen_id: Optional[int] = None
+
+class UnsubscribeCommand(CommandBase):
+    type: Literal["unsubscribe"]
+
+class InboxCommand(CommandBase, HistoryPage):
+    type: Literal["inbox"]
+
+Command = Annotated[
+    Union[VoteCommand, DeleteMessageCommand, ChangeMessageCommand, ReadCommand, LoadMoreCommand, SendCommand,
+          SubscribeCommand, UnsubscribeCommand, InboxCommand],
+    Field(discriminator="type")
+]
@@ -0,0 +1,104 @@
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+from sqlalchemy.future import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app import models, schemas
+from app.config import settings
+from app.metrics import DB_OPERATION_SECONDS
+
+
+class UserCache:
+    """
+    Bounded TTL/LRU cache of user profiles and verified tokens, shared by the token
+    check in `oauth2.get_current_user` and the recipient lookup of the websocket.
+
+    Entries expire after `ttl` seconds; profile changes and blocks must call
+    `invalidate` (ConnectionManagerPrivate.invalidate_user does it on every worker).
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.profiles: "OrderedDict[int, Tuple[float, schemas.UserProfile]]" = OrderedDict()
+        self.tokens: "OrderedDict[str, Tuple[float, int]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: int) -> Optional[schemas.UserProfile]:
+        entry = self.profiles.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            self.profiles.pop(user_id, None)
+            self.misses += 1
+            return None
+        self.profiles.move_to_end(user_id)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, profile: schemas.UserProfile):
+        self.profiles[profile.id] = (time.monotonic() + self.ttl, profile)
+        self.profiles.move_to_end(profile.id)
+        while len(self.profiles) > self.max_size:
+            self.profiles.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        """
+        Drop the profile of `user_id` and the tokens verified for it, so the next request
+        of a changed or blocked user is checked against the database again.
+        """
+        self.profiles.pop(user_id, None)
+        for token in [token for token, (_, owner) in self.tokens.items() if owner == user_id]:
+            del self.tokens[token]
+
+    def get_token(self, token: str) -> Optional[int]:
+        """
+        Returns the user id of a token verified before, None if unknown or expired.
+        """
+        entry = self.tokens.get(token)
+        if entry is None or entry[0] < time.time():
+            self.tokens.pop(token, None)
+            return None
+        self.tokens.move_to_end(token)
+        return entry[1]
+
+    def put_token(self, token: str, user_id: int, expires_at: Optional[float]):
+        # Never trust a token past its own expiry
+        valid_until = time.time() + self.ttl
+        if expires_at is not None:
+            valid_until = min(valid_until, expires_at)
+        self.tokens[token] = (valid_until, user_id)
+        self.tokens.move_to_end(token)
+        while len(self.tokens) > self.max_size:
+            self.tokens.popitem(last=False)
+
+    async def get_user(self, session: AsyncSession, user_id: int) -> Optional[schemas.UserProfile]:
+        """
+        Returns the profile of a user, from the cache when possible.
+        """
+        profile = self.get(user_id)
+        if profile is not None:
+            return profile
+
+        started = time.perf_counter()
+        result = await session.execute(select(models.User).filter(models.User.id == user_id))
+        user = result.scalars().first()
+        DB_OPERATION_SECONDS.observe(time.perf_counter() - started, "get_user")
+        if user is None:
+            return None
+
+        profile = schemas.UserProfile.model_validate(user)
+        self.put(profile)
+        return profile
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self.profiles),
+            "tokens": len(self.tokens),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+user_cache = UserCache(settings.user_cache_size, settings.user_cache_ttl)
@@ -0,0 +1,161 @@
+import asyncio
+import contextvars
+import logging
+from typing import Any, Awaitable, Callable, List, Optional, Set, Tuple
+from sqlalchemy import insert
+from app import models
+from app.inbox import record_new_messages
+from app.metrics import DB_OPERATION_SECONDS
+from app.config import settings
+from app.database import async_session_maker
+
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriter:
+    """
+    Group-commit writer for private message inserts.
+
+    Messages submitted from all sockets are collected for up to `flush_interval` seconds
+    (or until `max_batch` are waiting), written with one multi-row INSERT ... RETURNING id
+    and committed once. Every sender then gets the id of its own row.
+
+    `after_insert(session, rows, ids)` runs in the same transaction (the conversation
+    summaries are kept there); whatever it returns is handed to `on_commit` in the
+    background once the batch is committed.
+    """
+
+    def __init__(self, session_maker=async_session_maker,
+                 max_batch: Optional[int] = None, flush_interval: Optional[float] = None,
+                 after_insert: Optional[Callable[[Any, List[dict], List[int]], Awaitable[Any]]] = None):
+        self.session_maker = session_maker
+        self.after_insert = after_insert
+        self.on_commit: Optional[Callable[[Any], Awaitable]] = None
+        self.background_tasks: Set[asyncio.Task] = set()
+        self.max_batch = max_batch or settings.write_batch_size
+        self.flush_interval = settings.write_flush_interval_ms / 1000 if flush_interval is None else flush_interval
+        self.queue: Optional[asyncio.Queue] = None
+        self.full: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+        self.closing = False
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.queue = self.queue or asyncio.Queue()
+            self.full = self.full or asyncio.Event()
+            self.closing = False
+            # Started by the first submit, possibly inside a profiled command: a fresh context
+            # keeps the writer's statements out of that command's profile (see app.profiler)
+            self.task = asyncio.create_task(self._run(), context=contextvars.Context())
+
+    async def close(self):
+        """
+        Write whatever is still queued and stop the background task. A flush that is
+        already running is allowed to finish, so no sender is left waiting.
+        """
+        if self.task is None:
+            return
+        self.closing = True
+        self.queue.put_nowait(None)
+        self.full.set()
+        await self.task
+        self.task = None
+
+    async def submit(self, values: dict) -> int:
+        """
+        Queue one `PrivateMessage` row and wait until it is committed.
+
+        Returns:
+            int: The ID of the inserted message.
+        """
+        future = asyncio.get_running_loop().create_future()
+        if self.closing:
+            # Shutting down: write straight through instead of queueing behind the sentinel
+            await self._flush([(values, future)])
+            return await future
+
+        self.start()
+        self.queue.put_nowait((values, future))
+        # The writer already holds one row while it waits, so a batch is full one row earlier
+        if self.queue.qsize() >= self.max_batch - 1:
+            self.full.set()
+        return await future
+
+    async def _run(self):
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                return
+            batch = [item]
+            if self.flush_interval > 0 and len(batch) + self.queue.qsize() < self.max_batch:
+                self.full.clear()
+                try:
+                    await asyncio.wait_for(self.full.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            stop = self._drain(batch)
+            await self._flush(batch)
+            if stop:
+                return
+
+    def _drain(self, batch: List[Tuple[dict, asyncio.Future]]) -> bool:
+        """
+        Move queued rows into `batch` up to `max_batch`. Returns True when the close
+        sentinel was reached.
+        """
+        while len(batch) < self.max_batch and not self.queue.empty():
+            item = self.queue.get_nowait()
+            if item is None:
+                # Rows queued behind the sentinel still have to be written
+                while not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                return True
+            batch.append(item)
+        return False
+
+    @DB_OPERATION_SECONDS.time("insert_batch")
+    async def _write(self, rows: List[dict]) -> List[int]:
+        async with self.session_maker() as session:
+            result = await session.execute(
+                insert(models.PrivateMessage).returning(models.PrivateMessage.id, sort_by_parameter_order=True),
+                rows
+            )
+            ids = result.scalars().all()
+            committed = await self.after_insert(session, rows, ids) if self.after_insert is not None else None
+            await session.commit()
+
+        if committed and self.on_commit is not None:
+            # Senders are not kept waiting for the notifications
+            task = asyncio.create_task(self._notify(committed), context=contextvars.Context())
+            self.background_tasks.add(task)
+            task.add_done_callback(self.background_tasks.discard)
+        return ids
+
+    async def _notify(self, committed: Any):
+        try:
+            await self.on_commit(committed)
+        except Exception as e:
+            logger.error(f"Error in message commit callback: {e}", exc_info=True)
+
+    async def _flush(self, batch: List[Tuple[dict, asyncio.Future]]):
+        try:
+            ids = await self._write([values for values, _ in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                logger.error(f"Error writing message: {e}", exc_info=True)
+                if not batch[0][1].done():
+                    batch[0][1].set_exception(e)
+                return
+            # One bad row (e.g. a deleted receiver) must not fail everybody else's message
+            logger.warning(f"Batch of {len(batch)} messages failed, retrying row by row: {e}")
+            for item in batch:
+                await self._flush([item])
+            return
+
+        for (_, future), message_id in zip(batch, ids):
+            if not future.done():
+                future.set_result(message_id)
+
+
+message_writer = MessageWriter(after_insert=record_new_messages)
@@ -0,0 +1,461 @@
+"""
+Websocket load and latency benchmark of the private messages app, runnable fully offline.
+
+Starts the app with uvicorn on a local port, against Postgres when it is reachable (the
+DATABASE_* settings or `--database-url`) and otherwise against a throwaway aiosqlite
+database. Sayory always uses the offline fake client. N simulated client pairs then
+talk over real websockets to `/private/{receiver_id}`:
+
+- connect: open the socket until the first history page arrives
+- send:    a message from one side until the other side receives it
+- vote:    a vote until the other side receives `vote_changed`
+- edit:    an edit until the other side receives `message_updated`
+- history: a `load_more` page until it arrives
+- ai:      a message to Sayory until its stored reply arrives
+
+Every conversation is seeded with `--thread-sizes` messages first, so connect and history
+costs can be compared as threads grow. p50/p95/p99 latency and throughput are printed as
+JSON. With `--baseline`, the run fails when a result is worse than the stored one by more
+than `--tolerance`; `--save-baseline` stores the results instead.
+
+    python -m benchmarks.websocket_load --pairs 10 --thread-sizes 0,1000
+    python -m benchmarks.websocket_load --baseline benchmarks/baseline.json
+
+Clients and server share one event loop, so the numbers include the client side; compare
+runs of the same backend on the same machine only.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from typing import Callable, Dict, List, Optional
+
+from cryptography.fernet import Fernet
+
+
+# Placeholders for the settings the app requires; a real .env or environment wins
+DEFAULT_ENVIRONMENT = {
+    "DATABASE_HOSTNAME": "localhost",
+    "DATABASE_PORT": "5432",
+    "DATABASE_PASSWORD": "postgres",
+    "DATABASE_NAME": "postgres",
+    "DATABASE_USERNAME": "postgres",
+    "SECRET_KEY": "benchmark-secret",
+    "ALGORITHM": "HS256",
+    "ACCESS_TOKEN_EXPIRE_MINUTES": "60",
+    "KEY_CRYPTO": Fernet.generate_key().decode(),
+    "OPENAI_API_KEY": "benchmark",
+}
+
+
+def percentile(samples: List[float], fraction: float) -> float:
+    """
+    Nearest-rank percentile of `samples` (0 < fraction <= 1).
+    """
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def summarize(latencies: List[float], elapsed: float) -> dict:
+    return {
+        "count": len(latencies),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "throughput": round(len(latencies) / elapsed, 1) if elapsed > 0 else 0.0,
+    }
+
+
+def compare_to_baseline(results: dict, baseline: dict, tolerance: float, min_delta_ms: float) -> List[str]:
+    """
+    The regressions of `results` against `baseline`: a p50 or p95 latency more than
+    `tolerance` (a fraction) and `min_delta_ms` above the baseline, or a throughput more
+    than `tolerance` below it. Operations missing from either side are not compared.
+    """
+    regressions = []
+    for thread_size, operations in results["results"].items():
+        for operation, current in operations.items():
+            base = baseline["results"].get(thread_size, {}).get(operation)
+            if base is None:
+                continue
+            for metric in ("p50_ms", "p95_ms"):
+                if current[metric] > base[metric] * (1 + tolerance) and current[metric] - base[metric] > min_delta_ms:
+                    regressions.append(f"{operation} @ {thread_size} messages: {metric} "
+                                       f"{current[metric]} > baseline {base[metric]}")
+            if current["throughput"] < base["throughput"] * (1 - tolerance):
+                regressions.append(f"{operation} @ {thread_size} messages: throughput "
+                                   f"{current['throughput']}/s < baseline {base['throughput']}/s")
+    return regressions
+
+
+def postgres_available(timeout: float) -> bool:
+    """
+    Whether the database of the DATABASE_* settings answers. Probed in a child process,
+    because importing `app.database` fixes the engine of this one.
+    """
+    probe = ("import asyncio\n"
+             "from app.database import ping_database\n"
+             f"asyncio.run(asyncio.wait_for(ping_database(), {timeout}))\n")
+    try:
+        completed = subprocess.run([sys.executable, "-c", probe], capture_output=True, timeout=timeout + 10)
+    except subprocess.TimeoutExpired:
+        return False
+    return completed.returncode == 0
+
+
+def configure_environment(args) -> str:
+    """
+    Pick the database and stub Sayory, before any `app` module reads the settings.
+
+    Returns:
+        str: The backend used, "postgresql" or "sqlite".
+    """
+    for name, value in DEFAULT_ENVIRONMENT.items():
+        os.environ.setdefault(name, value)
+    os.environ["SAYORY_BACKEND"] = "fake"
+    # Answers to identical prompts would come from the cache instead of the AI workers
+    os.environ["SAYORY_CACHE_ENABLED"] = "false"
+
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+    elif not os.environ.get("DATABASE_URL") and (args.sqlite or not postgres_available(args.probe_timeout)):
+        path = os.path.join(tempfile.mkdtemp(prefix="pm-bench-"), "bench.db")
+        os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{path}"
+    url = os.environ.get("DATABASE_URL", "postgresql")
+    if url.startswith("sqlite"):
+        # SQLite has one writer at a time: queue on the pool instead of the busy-wait
+        # backoff of the driver, whose sleeps would dominate the percentiles
+        os.environ.setdefault("DB_POOL_SIZE", "1")
+        os.environ.setdefault("DB_MAX_OVERFLOW", "0")
+        os.environ.setdefault("DB_POOL_TIMEOUT", "60")
+        return "sqlite"
+    return "postgresql"
+
+
+def make_sqlite_compatible(engine, metadata):
+    """
+    Let the Postgres schema and queries run on SQLite: literal server defaults that SQLite
+    does not parse, the GREATEST/LEAST functions of the summary upserts and the GET_BYTE
+    of the re-encode command.
+    """
+    from sqlalchemy import event, text
+    from sqlalchemy.schema import DefaultClause
+
+    replacements = {"now()": "CURRENT_TIMESTAMP", "false": "0", "true": "1"}
+    for table in metadata.tables.values():
+        for column in table.columns:
+            default = column.server_default
+            if default is not None and getattr(default.arg, "text", None) in replacements:
+                column.server_default = DefaultClause(text(replacements[default.arg.text]))
+                column.server_default._set_parent(column)
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def register_functions(dbapi_connection, connection_record):
+        dbapi_connection.create_function("greatest", -1, max)
+        dbapi_connection.create_function("least", -1, min)
+        dbapi_connection.create_function("get_byte", 2, lambda data, index: data[index] if data else None)
+
+
+class Client:
+    """
+    One simulated device socket. A reader task matches incoming frames against the
+    expectations registered with `expect`, so a frame is never missed between a command
+    and the wait for its effect.
+    """
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.waiters: List[tuple] = []
+        self.reader = asyncio.create_task(self._read())
+
+    @classmethod
+    async def connect(cls, url: str, first: Callable[[dict], bool], timeout: float) -> "Client":
+        import websockets
+
+        websocket = await websockets.connect(url, max_size=None)
+        client = cls(websocket)
+        await asyncio.wait_for(client.expect(first), timeout)
+        return client
+
+    def expect(self, predicate: Callable[[dict], bool]) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((predicate, future))
+        return future
+
+    async def send(self, command: dict):
+        await self.websocket.send(json.dumps(command))
+
+    async def close(self):
+        await self.websocket.close()
+        self.reader.cancel()
+
+    async def _read(self):
+        try:
+            async for raw in self.websocket:
+                frame = json.loads(raw)
+                for waiter in list(self.waiters):
+                    predicate, future = waiter
+                    if future.done():
+                        self.waiters.remove(waiter)
+                    elif predicate(frame):
+                        future.set_result(frame)
+                        self.waiters.remove(waiter)
+        except Exception as e:
+            for _, future in self.waiters:
+                if not future.done():
+                    future.set_exception(ConnectionError(f"Socket closed: {e}"))
+
+
+def is_history(frame: dict) -> bool:
+    return frame.get("type") == "history"
+
+
+class Benchmark:
+    def __init__(self, args, base_url: str):
+        self.args = args
+        self.base_url = base_url
+        self.run_id = uuid.uuid4().hex[:8]
+        self.sequence = 0
+        self.sayory_id: Optional[int] = None
+
+    def next_id(self) -> int:
+        self.sequence += 1
+        return self.sequence
+
+    async def timed(self, coroutine) -> float:
+        started = time.perf_counter()
+        await asyncio.wait_for(coroutine, self.args.timeout)
+        return time.perf_counter() - started
+
+    async def create_users(self, count: int, label: str) -> List[dict]:
+        from app import models, oauth2
+        from app.database import async_session_maker
+
+        async with async_session_maker() as session:
+            users = [models.User(email=f"bench-{self.run_id}-{label}-{index}@example.com",
+                                 user_name=f"bench-{self.run_id}-{label}-{index}",
+                                 password="benchmark", avatar="", verified=True, blocked=False)
+                     for index in range(count)]
+            session.add_all(users)
+            await session.commit()
+            return [{"id": user.id, "token": oauth2.create_access_token({"user_id": user.id})} for user in users]
+
+    async def seed_thread(self, sender_id: int, receiver_id: int, size: int):
+        from sqlalchemy import insert
+        from app import crypto, models
+        from app.database import async_session_maker
+
+        key = models.conversation_key(sender_id, receiver_id)
+        async with async_session_maker() as session:
+            for start in range(0, size, 1000):
+                rows = []
+                for index in range(start, min(size, start + 1000)):
+                    # Alternate the sender, like a real thread
+                    sender, receiver = (sender_id, receiver_id) if index % 2 == 0 else (receiver_id, sender_id)
+                    rows.append(dict(sender_id=sender, receiver_id=receiver, conversation_id=key, is_read=True,
+                                     message_data=crypto.encrypt(f"seed message {index} of a benchmark thread")))
+                await session.execute(insert(models.PrivateMessage), rows)
+                await session.commit()
+
+    def socket_url(self, user: dict, peer_id: int) -> str:
+        return f"{self.base_url}/private/{peer_id}?token={user['token']}&batch_history=true"
+
+    async def open_pair(self, left: dict, right: dict, samples: List[float]) -> tuple:
+        async def open_socket(user, peer_id):
+            started = time.perf_counter()
+            client = await Client.connect(self.socket_url(user, peer_id), is_history, self.args.timeout)
+            samples.append(time.perf_counter() - started)
+            return client
+
+        return await asyncio.gather(open_socket(left, right["id"]), open_socket(right, left["id"]))
+
+    async def send(self, sender: Client, receiver: Client, text: str) -> tuple:
+        id_return = self.next_id()
+        arrived = receiver.expect(lambda frame: frame.get("id_return") == id_return and "user_name" in frame)
+        command = {"send": {"original_message_id": id_return, "message": text, "fileUrl": None}}
+        latency = await self.timed(self._round_trip(sender, command, arrived))
+        return latency, arrived.result()["id"]
+
+    async def _round_trip(self, client: Client, command: dict, arrived: asyncio.Future):
+        await client.send(command)
+        await arrived
+
+    async def phase(self, name: str, results: dict, pairs: list, run: Callable) -> None:
+        """
+        Run `run(pair_index, pair, samples)` for every pair concurrently and record the
+        latencies it collects as operation `name`.
+        """
+        samples: List[float] = []
+        started = time.perf_counter()
+        await asyncio.gather(*[run(index, pair, samples) for index, pair in enumerate(pairs)])
+        results[name] = summarize(samples, time.perf_counter() - started)
+
+    async def run_thread_size(self, thread_size: int) -> Dict[str, dict]:
+        args = self.args
+        users = await self.create_users(args.pairs * 2, f"t{thread_size}")
+        user_pairs = [(users[index], users[index + 1]) for index in range(0, len(users), 2)]
+        for left, right in user_pairs:
+            await self.seed_thread(left["id"], right["id"], thread_size)
+
+        results: Dict[str, dict] = {}
+        sockets: List[tuple] = [None] * len(user_pairs)
+        sent: List[List[int]] = [[] for _ in user_pairs]
+
+        async def connect(index, pair, samples):
+            sockets[index] = await self.open_pair(*pair, samples)
+
+        async def send(index, pair, samples):
+            left, right = sockets[index]
+            for number in range(args.messages):
+                latency, message_id = await self.send(left, right, f"benchmark message {number}")
+                samples.append(latency)
+                sent[index].append(message_id)
+
+        async def vote(index, pair, samples):
+            left, right = sockets[index]
+            for message_id in sent[index]:
+                arrived = right.expect(lambda frame, message_id=message_id:
+                                       frame.get("type") == "vote_changed" and frame.get("message_id") == message_id)
+                samples.append(await self.timed(self._round_trip(
+                    left, {"vote": {"message_id": message_id, "dir": 1}}, arrived)))
+
+        async def edit(index, pair, samples):
+            left, right = sockets[index]
+            for message_id in sent[index]:
+                arrived = right.expect(lambda frame, message_id=message_id:
+                                       frame.get("type") == "message_updated" and frame.get("id") == message_id)
+                samples.append(await self.timed(self._round_trip(
+                    left, {"change_message": {"id": message_id, "message": "edited benchmark message"}}, arrived)))
+
+        async def history(index, pair, samples):
+            left, _ = sockets[index]
+            for _ in range(args.messages):
+                arrived = left.expect(is_history)
+                samples.append(await self.timed(self._round_trip(
+                    left, {"load_more": {"limit": args.history_limit}}, arrived)))
+
+        async def ai(index, pair, samples):
+            left_user, _ = pair
+            client = await Client.connect(self.socket_url(left_user, self.sayory_id), is_history, args.timeout)
+            try:
+                for number in range(args.ai_messages):
+                    id_return = self.next_id()
+                    # The stored reply of Sayory carries the id_return of the question
+                    arrived = client.expect(lambda frame, id_return=id_return:
+                                            frame.get("id_return") == id_return
+                                            and frame.get("receiver_id") == self.sayory_id)
+                    command = {"send": {"original_message_id": id_return, "fileUrl": None,
+                                        "message": f"benchmark question {index}-{number}"}}
+                    samples.append(await self.timed(self._round_trip(client, command, arrived)))
+            finally:
+                await client.close()
+
+        try:
+            await self.phase("connect", results, user_pairs, connect)
+            await self.phase("send", results, user_pairs, send)
+            await self.phase("vote", results, user_pairs, vote)
+            await self.phase("edit", results, user_pairs, edit)
+            await self.phase("history", results, user_pairs, history)
+            if args.ai_messages:
+                await self.phase("ai", results, user_pairs, ai)
+        finally:
+            for pair in sockets:
+                for client in pair or ():
+                    await client.close()
+        return results
+
+    async def run(self, thread_sizes: List[int]) -> Dict[str, Dict[str, dict]]:
+        from app.config import settings
+
+        # A Sayory account of this run, so no benchmark pair is answered by the AI
+        sayory = (await self.create_users(1, "sayory"))[0]
+        self.sayory_id = settings.sayory_user_id = sayory["id"]
+        return {str(size): await self.run_thread_size(size) for size in thread_sizes}
+
+
+async def serve_and_run(args, backend: str) -> dict:
+    import uvicorn
+    from app import models  # noqa: F401 (registers the tables)
+    from app.database import Base, engine_asinc
+    from app.main import app
+
+    if backend == "sqlite":
+        make_sqlite_compatible(engine_asinc, Base.metadata)
+    async with engine_asinc.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=0, log_level="warning", lifespan="on"))
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        if serving.done():
+            serving.result()
+        await asyncio.sleep(0.01)
+    port = server.servers[0].sockets[0].getsockname()[1]
+
+    try:
+        benchmark = Benchmark(args, f"ws://127.0.0.1:{port}")
+        results = await benchmark.run([int(size) for size in args.thread_sizes.split(",")])
+    finally:
+        server.should_exit = True
+        await serving
+        await engine_asinc.dispose()
+
+    return {"backend": backend, "pairs": args.pairs, "messages": args.messages, "results": results}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Websocket load and latency benchmark")
+    parser.add_argument("--pairs", type=int, default=10, help="simulated client pairs")
+    parser.add_argument("--messages", type=int, default=20, help="messages (and votes, edits, pages) per pair")
+    parser.add_argument("--ai-messages", type=int, default=2, help="Sayory questions per pair, 0 to skip")
+    parser.add_argument("--thread-sizes", default="0,1000", help="comma-separated messages seeded per conversation")
+    parser.add_argument("--history-limit", type=int, default=50, help="page size of the history loads")
+    parser.add_argument("--timeout", type=float, default=30.0, help="seconds before one operation fails")
+    parser.add_argument("--database-url", help="async SQLAlchemy URL of the database to use")
+    parser.add_argument("--sqlite", action="store_true", help="use the aiosqlite stand-in without probing Postgres")
+    parser.add_argument("--probe-timeout", type=float, default=3.0)
+    parser.add_argument("--output", help="also write the results to this file")
+    parser.add_argument("--baseline", help="fail when a result regresses past this baseline file")
+    parser.add_argument("--save-baseline", help="write the results to this baseline file")
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="allowed regression as a fraction of the baseline (0.5 = 50%%)")
+    parser.add_argument("--min-delta-ms", type=float, default=20.0,
+                        help="latency differences below this are never regressions")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    backend = configure_environment(args)
+    report = asyncio.run(serve_and_run(args, backend))
+    print(json.dumps(report, indent=2))
+
+    for path in filter(None, (args.output, args.save_baseline)):
+        with open(path, "w") as file:
+            json.dump(report, file, indent=2)
+            file.write("\n")
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        setup = ("backend", "pairs", "messages")
+        if any(baseline.get(name) != report[name] for name in setup):
+            print(f"Baseline was measured with {[baseline.get(name) for name in setup]}, "
+                  f"this run used {[report[name] for name in setup]}", file=sys.stderr)
+            return 2
+        regressions = compare_to_baseline(report, baseline, args.tolerance, args.min_delta_ms)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,4 @@
+-- Keyset pagination of conversation history (fetch_last_private_messages).
+-- Each direction of a thread is read newest-first straight from this index.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_private_messages_sender_receiver_id
+    ON private_messages (sender_id, receiver_id, id DESC);
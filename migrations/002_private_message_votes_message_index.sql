@@ -0,0 +1,3 @@
+-- Vote totals are computed per message (process_vote, history join on message_id).
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_private_message_votes_message_id
+    ON private_message_votes (message_id);
@@ -0,0 +1,17 @@
+-- Per-conversation read watermark replacing the per-row is_read rewrites.
+CREATE TABLE IF NOT EXISTS private_read_state (
+    user_id      INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    peer_id      INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    last_read_id INTEGER NOT NULL DEFAULT 0,
+    updated_at   TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (user_id, peer_id)
+);
+
+-- Seed the watermarks from rows already flagged by the old polling task (is_read = false).
+INSERT INTO private_read_state (user_id, peer_id, last_read_id)
+SELECT receiver_id, sender_id, max(id)
+FROM private_messages
+WHERE is_read = false
+GROUP BY receiver_id, sender_id
+ON CONFLICT (user_id, peer_id) DO UPDATE
+    SET last_read_id = GREATEST(private_read_state.last_read_id, EXCLUDED.last_read_id);
@@ -0,0 +1,3 @@
+-- Denormalized vote total maintained by process_vote.
+-- After adding the column, backfill it with: python -m app.maintenance reconcile-votes
+ALTER TABLE private_messages ADD COLUMN IF NOT EXISTS vote_count INTEGER NOT NULL DEFAULT 0;
@@ -0,0 +1,20 @@
+-- Normalized two-party conversation key: (least(user) << 32) | greatest(user).
+-- Run the steps in order, deploying the code that writes the column after step 1.
+
+-- 1. Add the column (no table rewrite while it is nullable).
+ALTER TABLE private_messages ADD COLUMN IF NOT EXISTS conversation_id BIGINT;
+
+-- 2. Backfill existing rows in batches:
+--      python -m app.maintenance backfill-conversations
+
+-- 3. Build the thread index without blocking writes, then drop the per-direction one.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_private_messages_conversation_id
+    ON private_messages (conversation_id, id DESC);
+DROP INDEX CONCURRENTLY IF EXISTS ix_private_messages_sender_receiver_id;
+
+-- 4. Enforce NOT NULL; the validation scan does not block reads or writes.
+ALTER TABLE private_messages
+    ADD CONSTRAINT private_messages_conversation_id_not_null CHECK (conversation_id IS NOT NULL) NOT VALID;
+ALTER TABLE private_messages VALIDATE CONSTRAINT private_messages_conversation_id_not_null;
+ALTER TABLE private_messages ALTER COLUMN conversation_id SET NOT NULL;
+ALTER TABLE private_messages DROP CONSTRAINT private_messages_conversation_id_not_null;
@@ -0,0 +1,7 @@
+-- Compact binary storage of encrypted messages (format byte, key version byte, raw Fernet token).
+-- New rows and edits write message_data and leave message NULL; rows that still use the
+-- legacy base64 text in message are read as before.
+-- Adding a nullable column without a default does not rewrite the table.
+-- Re-encode old rows (and rows of retired keys after a rotation) in the background with:
+--   python -m app.maintenance reencode-messages
+ALTER TABLE private_messages ADD COLUMN IF NOT EXISTS message_data BYTEA;
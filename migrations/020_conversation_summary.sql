@@ -0,0 +1,22 @@
+-- One row per participant of every conversation: the newest message (still encrypted)
+-- and the number of messages the participant has not read. Kept up to date by the
+-- message writer, read receipts, edits and deletes; the inbox is served from it alone.
+CREATE TABLE IF NOT EXISTS conversation_summary (
+    user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    peer_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    last_message_id INTEGER NOT NULL,
+    last_sender_id INTEGER NOT NULL,
+    last_message_data BYTEA,
+    last_message VARCHAR,
+    last_file_url VARCHAR,
+    last_message_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+    unread_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, peer_id)
+);
+
+-- Serves an inbox page newest-first for keyset pagination
+CREATE INDEX IF NOT EXISTS ix_conversation_summary_user_id_last_message_id
+    ON conversation_summary (user_id, last_message_id DESC);
+
+-- Fill it for the existing conversations, after deploying the code that maintains it:
+--   python -m app.maintenance rebuild-summaries
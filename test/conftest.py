@@ -0,0 +1,45 @@
+import asyncio
+import os
+
+import pytest
+from cryptography.fernet import Fernet
+
+
+# Settings are read from the environment at import time; the tests never reach Postgres
+for name, value in {
+    "DATABASE_HOSTNAME": "localhost",
+    "DATABASE_PORT": "5432",
+    "DATABASE_PASSWORD": "test",
+    "DATABASE_NAME": "test",
+    "DATABASE_USERNAME": "test",
+    "SECRET_KEY": "test-secret",
+    "ALGORITHM": "HS256",
+    "ACCESS_TOKEN_EXPIRE_MINUTES": "30",
+    "KEY_CRYPTO": Fernet.generate_key().decode(),
+    "OPENAI_API_KEY": "test",
+}.items():
+    os.environ.setdefault(name, value)
+
+
+@pytest.fixture
+def database(tmp_path):
+    """
+    Session maker of a fresh SQLite database with the full schema, for the queries that
+    are worth running for real (pagination, counters, backfills). Each connection is
+    opened and closed within the `asyncio.run` of the test.
+    """
+    from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+    from sqlalchemy.orm import sessionmaker
+    from sqlalchemy.pool import NullPool
+    from app.database import Base
+    from benchmarks.websocket_load import make_sqlite_compatible
+
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'test.db'}", poolclass=NullPool)
+    make_sqlite_compatible(engine, Base.metadata)
+
+    async def create_schema():
+        async with engine.begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+
+    asyncio.run(create_schema())
+    return sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
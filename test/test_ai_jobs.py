@@ -0,0 +1,68 @@
+import asyncio
+
+from app.AI.jobs import AiJobQueue, AiQueueFull
+
+
+def test_users_are_served_round_robin_within_the_cap():
+    async def scenario():
+        queue = AiJobQueue(concurrency=1, max_pending=10, max_per_user=5, timeout=1.0)
+        order = []
+
+        def job(name):
+            async def run():
+                order.append(name)
+            return run
+
+        for name in ("a1", "a2", "a3"):
+            queue.submit(1, "socket-a", job(name))
+        queue.submit(2, "socket-b", job("b1"))
+        queue.submit(3, "socket-c", job("c1"))
+        await asyncio.sleep(0.05)
+        await queue.close()
+        return order, queue.stats()
+
+    order, stats = asyncio.run(scenario())
+
+    assert order == ["a1", "b1", "c1", "a2", "a3"]
+    assert stats["completed"] == 5
+
+
+def test_limits_timeout_and_cancel_on_disconnect():
+    async def scenario():
+        queue = AiJobQueue(concurrency=1, max_pending=10, max_per_user=2, timeout=0.05)
+        errors, cancelled = [], []
+
+        async def slow():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        async def report(error):
+            errors.append(error)
+
+        queue.submit(1, "socket-a", slow, report)
+        queue.submit(1, "socket-a", slow, report)
+        try:
+            queue.submit(1, "socket-a", slow, report)
+        except AiQueueFull:
+            rejected = True
+
+        # Closing socket-a cancels its running job and drops the queued one; socket-b's job times out
+        await asyncio.sleep(0.01)
+        queue.cancel("socket-a")
+        await asyncio.sleep(0)
+        queue.submit(2, "socket-b", slow, report)
+        await asyncio.sleep(0.1)
+        await queue.close()
+        return rejected, errors, cancelled, queue.stats()
+
+    rejected, errors, cancelled, stats = asyncio.run(scenario())
+
+    assert rejected
+    assert len(cancelled) == 2
+    assert [type(error) for error in errors] == [TimeoutError]
+    assert stats["timed_out"] == 1
+    assert stats["rejected"] == 1
+    assert stats["pending"] == 0
@@ -0,0 +1,47 @@
+import json
+import os
+import subprocess
+import sys
+
+from benchmarks.websocket_load import compare_to_baseline, percentile, summarize
+
+
+def report(**operations):
+    return {"results": {"0": operations}}
+
+
+def test_percentiles_use_the_nearest_rank():
+    samples = [i / 1000 for i in range(1, 101)]
+
+    assert percentile(samples, 0.50) == 0.050
+    assert percentile(samples, 0.95) == 0.095
+    assert percentile(samples, 0.99) == 0.099
+    assert summarize(samples, 2.0)["throughput"] == 50.0
+
+
+def test_only_regressions_past_the_tolerance_fail():
+    base = {"p50_ms": 10.0, "p95_ms": 40.0, "throughput": 100.0}
+    noisy = {"p50_ms": 14.0, "p95_ms": 55.0, "throughput": 60.0}
+    slower = {"p50_ms": 25.0, "p95_ms": 200.0, "throughput": 20.0}
+
+    assert compare_to_baseline(report(send=noisy), report(send=base), 0.5, 20.0) == []
+    regressions = compare_to_baseline(report(send=slower, vote=slower), report(send=base), 0.5, 20.0)
+    # p50 is within min_delta_ms; vote has no baseline
+    assert [line.split(":")[1].split()[0] for line in regressions] == ["p95_ms", "throughput"]
+
+
+def test_benchmark_runs_offline_against_sqlite(tmp_path):
+    output = tmp_path / "results.json"
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    completed = subprocess.run(
+        [sys.executable, "-m", "benchmarks.websocket_load", "--sqlite", "--pairs", "2", "--messages", "2",
+         "--ai-messages", "1", "--thread-sizes", "0,30", "--timeout", "10", "--output", str(output)],
+        cwd=root, capture_output=True, text=True, timeout=120
+    )
+
+    assert completed.returncode == 0, completed.stderr
+    results = json.loads(output.read_text())["results"]
+    assert list(results) == ["0", "30"]
+    assert {operation: stats["count"] for operation, stats in results["30"].items()} == {
+        "connect": 4, "send": 4, "vote": 4, "edit": 4, "history": 4, "ai": 2
+    }
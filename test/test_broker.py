@@ -0,0 +1,36 @@
+
+import asyncio
+
+from app.broker import InMemoryBroker, InMemoryHub, conversation_channel
+
+
+def test_conversation_channel_is_symmetric():
+    assert conversation_channel(3, 7) == conversation_channel(7, 3) == "pm_3_7"
+
+
+def test_publish_reaches_subscribers_on_other_workers():
+    async def scenario():
+        hub = InMemoryHub()
+        worker_1, worker_2, worker_3 = InMemoryBroker(hub), InMemoryBroker(hub), InMemoryBroker(hub)
+        received = {1: [], 2: [], 3: []}
+
+        async def handler(worker):
+            async def handle(payload):
+                received[worker].append(payload)
+            return handle
+
+        channel = conversation_channel(1, 2)
+        await worker_1.subscribe(channel, await handler(1))
+        await worker_2.subscribe(channel, await handler(2))
+        await worker_3.subscribe(conversation_channel(1, 3), await handler(3))
+
+        await worker_1.publish(channel, "hello")
+        await worker_2.unsubscribe(channel)
+        await worker_3.publish(channel, "again")
+        return received
+
+    received = asyncio.run(scenario())
+
+    assert received[1] == ["hello", "again"]
+    assert received[2] == ["hello"]
+    assert received[3] == []
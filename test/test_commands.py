@@ -0,0 +1,187 @@
+import asyncio
+import json
+
+import pytest
+from sqlalchemy import insert
+
+from app import crypto, models, schemas
+from app.broker import InMemoryBroker
+from app.connection_manager import ConnectionManagerPrivate
+from app.routers import private_messages
+from app.commands import UNTAGGED, CommandDispatcher, CommandError, ordering_key, parse_command, request_id_of
+
+
+def test_legacy_and_versioned_frames_parse_to_the_same_command():
+    legacy = parse_command({"peer_id": 5, "vote": {"message_id": 7, "dir": 1}})
+    versioned = parse_command({"v": 1, "type": "vote", "request_id": "r1", "peer_id": 5, "message_id": 7, "dir": 1})
+
+    assert isinstance(legacy, schemas.VoteCommand) and isinstance(versioned, schemas.VoteCommand)
+    assert (legacy.peer_id, legacy.message_id, legacy.dir, legacy.request_id) == (5, 7, 1, None)
+    assert (versioned.peer_id, versioned.message_id, versioned.dir, versioned.request_id) == (5, 7, 1, "r1")
+    assert parse_command({"inbox": None}).type == "inbox"
+    assert parse_command({"send": {"message": "hi"}}).original_message_id is None
+
+
+@pytest.mark.parametrize("data, error", [
+    ({"v": 1, "type": "dance"}, "Unknown command."),
+    ({"ping": {}}, "Unknown command."),
+    ({"v": 2, "type": "send", "request_id": 3}, "Unsupported protocol version, expected 1."),
+    ({"vote": {"message_id": "x", "dir": 1}}, "Invalid vote command: message_id"),
+    ({"type": "change_message", "id": 4}, "Invalid change_message command: message"),
+    ([1, 2], "Command must be an object."),
+])
+def test_invalid_frames_are_rejected_with_a_reason(data, error):
+    with pytest.raises(CommandError) as raised:
+        parse_command(data)
+    assert str(raised.value).startswith(error)
+
+
+def test_request_id_of_an_invalid_frame_is_still_echoed():
+    assert request_id_of({"v": 2, "type": "send", "request_id": 3}) == 3
+    assert request_id_of({"request_id": {"nested": True}}) is None
+
+
+def test_ordering_keys_keep_sends_and_each_message_in_order():
+    send = parse_command({"type": "send", "request_id": 1, "message": "a"})
+    edit = parse_command({"type": "change_message", "request_id": 2, "id": 9, "message": "b"})
+    vote = parse_command({"type": "vote", "request_id": 3, "message_id": 9, "dir": 1})
+    other_send = parse_command({"type": "send", "request_id": 4, "message": "c"})
+
+    assert ordering_key(send, 5) == ordering_key(other_send, 5)
+    assert ordering_key(edit, 5) == ordering_key(vote, 5) != ordering_key(send, 5)
+    assert ordering_key(send, 5) != ordering_key(send, 6)
+
+
+def test_commands_without_request_id_share_one_lane():
+    legacy = [parse_command({"peer_id": 5, "change_message": {"id": 9, "message": "b"}}),
+              parse_command({"peer_id": 6, "send": {"message": "a"}}),
+              parse_command({"type": "load_more", "peer_id": 5})]
+
+    assert {ordering_key(command, command.peer_id) for command in legacy} == {UNTAGGED}
+
+
+def test_dispatcher_runs_independent_commands_concurrently_and_chains_the_rest():
+    events = []
+
+    def command(name, delay):
+        async def run():
+            events.append(f"start {name}")
+            await asyncio.sleep(delay)
+            events.append(f"end {name}")
+        return run
+
+    async def scenario():
+        dispatcher = CommandDispatcher(limit=2)
+        await dispatcher.submit("edit", command("edit", 0.05))
+        await dispatcher.submit("send", command("send 1", 0.01))
+        # Both slots are taken: submit waits for one to free up
+        await dispatcher.submit("send", command("send 2", 0))
+        events.append("submitted")
+        await dispatcher.close()
+        return dispatcher
+
+    dispatcher = asyncio.run(scenario())
+
+    assert events == ["start edit", "start send 1", "end send 1", "submitted", "start send 2", "end send 2",
+                      "end edit"]
+    assert not dispatcher.tasks and not dispatcher.tails
+
+
+def test_failed_command_does_not_stop_the_ones_behind_it():
+    done = []
+
+    async def failing():
+        raise RuntimeError("socket closed")
+
+    async def following():
+        done.append(True)
+
+    async def scenario():
+        dispatcher = CommandDispatcher(limit=4)
+        await dispatcher.submit("send", failing)
+        await dispatcher.submit("send", following)
+        await dispatcher.close()
+
+    asyncio.run(scenario())
+    assert done == [True]
+
+
+class RecordingConnection:
+    def __init__(self):
+        self.frames = []
+
+    def push(self, text, peer_id, key=None):
+        self.frames.append(json.loads(text))
+
+    async def send_json(self, data, peer_id):
+        self.push(json.dumps(data), peer_id)
+
+
+def test_history_page_is_not_interleaved_with_concurrent_replies():
+    messages = [schemas.SocketModel(created_at="2024-01-01T00:00:00Z", id=message_id, receiver_id=1,
+                                    message=f"m{message_id}", user_name="one", verified=False, avatar="",
+                                    is_read=True, vote=0, edited=False)
+                for message_id in (12, 11, 10)]
+    connection = RecordingConnection()
+
+    async def scenario():
+        await asyncio.gather(private_messages.send_history_page(connection, 2, messages),
+                             connection.send_json({"message": "Vote posted "}, 2))
+
+    asyncio.run(scenario())
+
+    page = [frame.get("id", frame.get("message")) for frame in connection.frames]
+    assert page == ["History page", 10, 11, 12, "Vote posted "]
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, text):
+        self.sent.append(json.loads(text))
+
+    async def send_json(self, data):
+        self.sent.append(data)
+
+
+def test_message_changes_send_only_the_delta_to_both_participants(database, monkeypatch):
+    manager = ConnectionManagerPrivate(InMemoryBroker())
+    monkeypatch.setattr(private_messages, "manager", manager)
+    monkeypatch.setattr(private_messages, "async_session_maker", database)
+
+    async def scenario():
+        async with database() as session:
+            session.add_all([models.User(id=user_id, email=f"{user_id}@test", user_name=f"user{user_id}",
+                                         password="", avatar="") for user_id in (1, 2)])
+            await session.flush()
+            for text in ("first", "second"):
+                await session.execute(insert(models.PrivateMessage).values(
+                    sender_id=1, receiver_id=2, conversation_id=models.conversation_key(1, 2),
+                    message_data=crypto.encrypt(text)))
+            await session.commit()
+
+        author, peer = FakeWebSocket(), FakeWebSocket()
+        connection = await manager.connect(author, 1, 2)
+        await manager.connect(peer, 2, 1)
+        user = schemas.UserProfile(id=1, user_name="user1", avatar="", verified=False)
+        for frame in ({"v": 1, "type": "vote", "request_id": "v", "message_id": 1, "dir": 1},
+                      {"v": 1, "type": "change_message", "request_id": "c", "id": 2, "message": "edited"},
+                      {"v": 1, "type": "delete_message", "request_id": "d", "id": 1}):
+            await private_messages.handle_command(connection, user, 2, parse_command(frame), False)
+        await asyncio.sleep(0.01)
+        return author.sent, peer.sent
+
+    author, peer = asyncio.run(scenario())
+
+    events = [{"type": "vote_changed", "message_id": 1, "vote": 1},
+              {"type": "message_updated", "id": 2, "message": "edited", "edited": True},
+              {"type": "message_deleted", "id": 1}]
+    assert peer == events
+    # The author gets its acks next to the same events, and no history page is sent again
+    assert [frame for frame in author if "type" in frame and "request_id" not in frame] == events
+    assert [frame["request_id"] for frame in author if "request_id" in frame] == ["v", "c", "d"]
+    assert not any(frame.get("message") == "History page" or "messages" in frame for frame in author + peer)
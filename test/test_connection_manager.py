@@ -0,0 +1,253 @@
+import asyncio
+import json
+from unittest.mock import AsyncMock
+
+from app import schemas
+from app.broker import InMemoryBroker, InMemoryHub, conversation_channel
+from app.connection_manager import PROFILER_CHANNEL, ConnectionManagerPrivate
+from app.profiler import profiler
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, text):
+        self.sent.append(json.loads(text))
+
+    async def send_json(self, data):
+        self.sent.append(data)
+
+
+class ExternalBroker(InMemoryBroker):
+    # Behaves like Postgres/Redis: frames with plaintext travel as references only
+    external = True
+
+
+def two_workers(hub, broker_class=InMemoryBroker):
+    workers = []
+    for _ in range(2):
+        manager = ConnectionManagerPrivate(broker_class(hub))
+        manager.mark_read = AsyncMock()
+        manager.add_private_all_to_database = AsyncMock(return_value=7)
+        workers.append(manager)
+    return workers
+
+
+def stored_message(message_id, text, sender_id=1):
+    return schemas.SocketModel(created_at="2024-01-01T00:00:00Z", id=message_id, receiver_id=sender_id,
+                               message=text, user_name="one", verified=False, avatar="",
+                               is_read=True, vote=0, edited=False)
+
+
+async def send_hello(worker):
+    await worker.send_private_all(message="hello", file=None, sender_id=1, receiver_id=2,
+                                  user_name="one", verified=False, avatar="", id_return=None, is_read=True)
+    await flush()
+
+
+async def flush():
+    # Let the outbound writers and the background mark_read task run
+    await asyncio.sleep(0.01)
+
+
+def test_message_reaches_socket_on_other_worker():
+    async def scenario():
+        hub = InMemoryHub()
+        worker_1, worker_2 = two_workers(hub)
+        socket_1, socket_2 = FakeWebSocket(), FakeWebSocket()
+        await worker_1.connect(socket_1, 1, 2)
+        await worker_2.connect(socket_2, 2, 1)
+
+        await send_hello(worker_1)
+        await worker_2.send_private_event(schemas.VoteChangedEvent(message_id=7, vote=1), 2, 1)
+        await flush()
+        return worker_1, worker_2, socket_1, socket_2
+
+    worker_1, worker_2, socket_1, socket_2 = asyncio.run(scenario())
+
+    for socket in (socket_1, socket_2):
+        assert [frame.get("message") for frame in socket.sent[:1]] == ["hello"]
+        assert socket.sent[1] == {"type": "vote_changed", "message_id": 7, "vote": 1}
+    # Only the worker holding the recipient's socket marks the message as read
+    worker_2.mark_read.assert_awaited_once_with(2, 1, 7)
+    worker_1.mark_read.assert_not_awaited()
+
+
+def test_external_broker_resolves_references():
+    async def scenario():
+        hub = InMemoryHub()
+        worker_1, worker_2 = two_workers(hub, ExternalBroker)
+        published = []
+        original_publish = worker_1.broker.publish
+
+        async def publish(channel, payload):
+            published.append(json.loads(payload))
+            await original_publish(channel, payload)
+
+        worker_1.broker.publish = publish
+        worker_2._resolve = AsyncMock(return_value=stored_message(7, "hello").model_dump_json())
+        socket_2 = FakeWebSocket()
+        await worker_2.connect(socket_2, 2, 1)
+
+        await send_hello(worker_1)
+        return published, worker_2, socket_2
+
+    published, worker_2, socket_2 = asyncio.run(scenario())
+
+    assert published[0]["data"] is None
+    assert published[0]["ref"] == ["message", 7]
+    worker_2._resolve.assert_awaited_once_with("message", 7)
+    assert [(frame["id"], frame["message"]) for frame in socket_2.sent] == [(7, "hello")]
+
+
+def test_channel_subscription_is_refcounted():
+    async def scenario():
+        hub = InMemoryHub()
+        manager = ConnectionManagerPrivate(InMemoryBroker(hub))
+        channel = conversation_channel(1, 2)
+        states = []
+
+        first = await manager.connect(FakeWebSocket(), 1, 2)
+        peer = await manager.connect(FakeWebSocket(), 2, 1)
+        # A second device of the same user is a socket of its own
+        second = await manager.connect(FakeWebSocket(), 1, 2)
+        states.append((manager.channel_refs.get(channel), channel in hub.channels))
+
+        await manager.disconnect(first)
+        await manager.disconnect(second)
+        states.append((manager.channel_refs.get(channel), channel in hub.channels))
+
+        await manager.disconnect(peer)
+        await manager.disconnect(peer)
+        states.append((manager.channel_refs.get(channel), channel in hub.channels))
+        return states, manager.connections
+
+    states, connections = asyncio.run(scenario())
+
+    assert states == [(3, True), (1, True), (None, False)]
+    assert connections == {}
+
+
+def test_multiplexed_socket_and_every_device_get_the_message():
+    async def scenario():
+        hub = InMemoryHub()
+        worker_1, worker_2 = two_workers(hub)
+        phone, laptop, peer = FakeWebSocket(), FakeWebSocket(), FakeWebSocket()
+        await worker_1.connect(phone, 1, 2)
+        multiplexed = await worker_2.connect(laptop, 1)
+        await worker_2.subscribe(multiplexed, 3)
+        await worker_2.subscribe(multiplexed, 2)
+        await worker_2.connect(peer, 2, 1)
+
+        await send_hello(worker_1)
+        await worker_2.unsubscribe(multiplexed, 2)
+        await send_hello(worker_1)
+        return phone, laptop, peer
+
+    phone, laptop, peer = asyncio.run(scenario())
+
+    assert [frame["message"] for frame in phone.sent] == ["hello", "hello"]
+    assert [frame["message"] for frame in peer.sent] == ["hello", "hello"]
+    # The multiplexed socket tags frames with the conversation and stops after unsubscribe
+    assert len(laptop.sent) == 1
+    assert laptop.sent[0]["peer_id"] == 2
+    assert laptop.sent[0]["frame"]["message"] == "hello"
+
+
+def test_hot_buffer_follows_deliveries_and_serves_resume():
+    async def scenario():
+        manager = ConnectionManagerPrivate(InMemoryBroker())
+        manager.mark_read = AsyncMock()
+        ids = iter(range(11, 20))
+        manager.add_private_all_to_database = AsyncMock(side_effect=lambda *args: next(ids))
+        connection = await manager.connect(FakeWebSocket(), 1, 2)
+
+        before_seed = manager.recent_messages(1, 2, last_seen_id=5)
+        # The page read from the database after subscribing: the whole (short) conversation
+        manager.remember_page(1, 2, [stored_message(10, "old", 2), stored_message(5, "older", 2)], 50)
+        await send_hello(manager)
+        await send_hello(manager)
+        await manager.send_private_event(schemas.VoteChangedEvent(message_id=11, vote=3), 1, 2)
+        await manager.send_private_event(schemas.MessageDeletedEvent(id=10), 1, 2)
+
+        resumed = manager.recent_messages(1, 2, last_seen_id=5)
+        latest = manager.recent_messages(1, 2)
+        await manager.disconnect(connection)
+        return before_seed, resumed, latest, manager.hot.stats()
+
+    before_seed, resumed, latest, stats = asyncio.run(scenario())
+
+    assert before_seed is None
+    assert [(message.id, message.vote) for message in resumed] == [(12, 0), (11, 3)]
+    assert [message.id for message in latest] == [12, 11, 5]
+    # Unsubscribing drops the buffer
+    assert stats["conversations"] == 0
+
+
+def test_inbox_update_reaches_multiplexed_sockets_of_its_user_on_any_worker():
+    async def scenario():
+        hub = InMemoryHub()
+        worker_1, worker_2 = two_workers(hub)
+        multiplexed, conversation, other_user = FakeWebSocket(), FakeWebSocket(), FakeWebSocket()
+        laptop = await worker_2.connect(multiplexed, 1)
+        await worker_2.connect(conversation, 1, 3)
+        await worker_2.connect(other_user, 2)
+
+        await worker_1.publish_inbox([(1, schemas.InboxUpdatedEvent(peer_id=2, last_message_id=7,
+                                                                    last_sender_id=2, unread_count=4))])
+        await flush()
+        await worker_2.disconnect(laptop)
+        return multiplexed, conversation, other_user, hub
+
+    multiplexed, conversation, other_user, hub = asyncio.run(scenario())
+
+    assert multiplexed.sent == [{"peer_id": 2, "frame": {"type": "inbox_updated", "peer_id": 2, "last_message_id": 7,
+                                                         "last_sender_id": 2, "last_message_at": None,
+                                                         "unread_count": 4}}]
+    # Per-conversation sockets and other users get nothing
+    assert conversation.sent == [] and other_user.sent == []
+    # The inbox channel stays subscribed while the user has a socket on the worker
+    assert "pm_inbox_1" in hub.channels
+
+
+def test_profiler_settings_reach_every_worker(monkeypatch):
+    for name in ("enabled", "threshold_ms", "sample_rate"):
+        monkeypatch.setattr(profiler, name, getattr(profiler, name))
+
+    async def scenario():
+        hub = InMemoryHub()
+        worker_1, worker_2 = two_workers(hub)
+        await worker_2.broker.subscribe(PROFILER_CHANNEL, worker_2._configure_profiler)
+        await worker_1.configure_profiler(schemas.ProfilerConfig(enabled=True, threshold_ms=250))
+        await flush()
+
+    asyncio.run(scenario())
+
+    assert profiler.enabled is True
+    assert profiler.threshold_ms == 250
+
+
+def test_replies_share_the_outbound_queue_with_broadcasts():
+    async def scenario():
+        manager = ConnectionManagerPrivate(InMemoryBroker())
+        socket = FakeWebSocket()
+        connection = await manager.connect(socket, 1)
+        connection.push('{"type":"vote_changed","message_id":7,"vote":1}', 2, ("vote", 7))
+        await connection.send_json({"message": "Vote posted "}, 2)
+        connection.push_raw('{"type":"inbox","entries":[]}')
+        # Queued, not written inline: the socket has a single writer
+        written_inline = list(socket.sent)
+        await flush()
+        return written_inline, socket.sent, connection.outbound.stats()
+
+    written_inline, sent, stats = asyncio.run(scenario())
+
+    assert written_inline == []
+    assert sent == [{"peer_id": 2, "frame": {"type": "vote_changed", "message_id": 7, "vote": 1}},
+                    {"peer_id": 2, "frame": {"message": "Vote posted "}},
+                    {"type": "inbox", "entries": []}]
+    assert stats["sent"] == 3
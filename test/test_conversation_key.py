@@ -0,0 +1,40 @@
+import asyncio
+from sqlalchemy import insert, select
+from app import maintenance, models
+
+PAIRS = [(5, 3), (3, 5), (1, 2 ** 31 - 1), (70000, 1), (7, 7)]
+
+
+def test_key_is_the_same_for_both_directions_and_decodes():
+    for sender, receiver in PAIRS:
+        key = models.conversation_key(sender, receiver)
+        assert key == models.conversation_key(receiver, sender)
+        assert models.conversation_users(key) == tuple(sorted((sender, receiver)))
+    assert len({models.conversation_key(*pair) for pair in PAIRS}) == 4
+
+
+def test_backfill_matches_conversation_key(database, monkeypatch):
+    monkeypatch.setattr(maintenance, "async_session_maker", database)
+    # Rows written before the column existed have no key
+    table = models.PrivateMessage.__table__
+    monkeypatch.setattr(table.c.conversation_id, "nullable", True)
+
+    async def scenario():
+        async with database() as session:
+            connection = await session.connection()
+            await connection.run_sync(table.drop)
+            await connection.run_sync(table.create)
+            await session.execute(insert(table), [dict(sender_id=sender, receiver_id=receiver, message="m")
+                                                  for sender, receiver in PAIRS])
+            await session.commit()
+
+        updated = await maintenance.backfill_conversation_ids(batch_size=2)
+        async with database() as session:
+            rows = (await session.execute(select(table.c.sender_id, table.c.receiver_id, table.c.conversation_id)
+                                          .order_by(table.c.id))).all()
+        return updated, rows
+
+    updated, rows = asyncio.run(scenario())
+
+    assert updated == len(PAIRS)
+    assert [key for _, _, key in rows] == [models.conversation_key(sender, receiver) for sender, receiver, _ in rows]
@@ -0,0 +1,111 @@
+
+import asyncio
+import base64
+
+from cryptography.fernet import Fernet, MultiFernet
+from sqlalchemy import insert, select
+
+from app import crypto, maintenance, models
+
+
+def legacy(text, key=None):
+    # The old text format: standard base64 of the urlsafe Fernet token
+    return base64.b64encode((key or crypto.cipher).encrypt(text.encode())).decode()
+
+
+def test_binary_round_trip_is_compact():
+    stored = crypto.encrypt("Привіт")
+
+    assert stored[:2] == bytes((crypto.FORMAT_VERSION, crypto.key_version))
+    assert crypto.decrypt(stored) == "Привіт"
+    assert crypto.decrypt(memoryview(stored)) == "Привіт"
+    assert len(stored) < len(legacy("Привіт")) * 0.6
+    assert not crypto.needs_reencode(stored)
+
+
+def test_legacy_rows_are_still_readable():
+    stored = legacy("Привіт")
+
+    assert stored.startswith(crypto.ENCRYPTED_PREFIX)
+    assert crypto.decrypt(stored) == "Привіт"
+    # Plaintext rows (even ones that happen to be valid base64) are returned as they are
+    assert crypto.decrypt("test") == "test"
+    assert crypto.decrypt(None) is None
+    assert crypto.stored_message(None, stored) == stored
+    assert crypto.needs_reencode(stored)
+
+
+def test_rows_of_a_retired_key_are_readable_after_rotation(monkeypatch):
+    old_key = Fernet(Fernet.generate_key())
+    monkeypatch.setattr(crypto, "keys", {**crypto.keys, 200: old_key})
+    monkeypatch.setattr(crypto, "legacy_cipher", MultiFernet([crypto.cipher, old_key]))
+    old_row = bytes((crypto.FORMAT_VERSION, 200)) + base64.urlsafe_b64decode(old_key.encrypt(b"old"))
+
+    assert crypto.decrypt(old_row) == "old"
+    assert crypto.decrypt(legacy("older", old_key)) == "older"
+    assert crypto.needs_reencode(old_row)
+    # Unknown key versions are unreadable rather than an error
+    assert crypto.decrypt(bytes((crypto.FORMAT_VERSION, 201)) + old_row[2:]) is None
+
+
+def test_reencode_rotates_messages_and_their_summaries(database, monkeypatch):
+    old_key = Fernet(Fernet.generate_key())
+    monkeypatch.setattr(crypto, "keys", {**crypto.keys, 200: old_key})
+    monkeypatch.setattr(crypto, "legacy_cipher", MultiFernet([crypto.cipher, old_key]))
+    monkeypatch.setattr(maintenance, "async_session_maker", database)
+    old_row = bytes((crypto.FORMAT_VERSION, 200)) + base64.urlsafe_b64decode(old_key.encrypt(b"old"))
+
+    async def scenario():
+        async with database() as session:
+            session.add_all([models.User(id=user_id, email=f"{user_id}@test", user_name=f"user{user_id}",
+                                         password="", avatar="") for user_id in (1, 2)])
+            await session.flush()
+            await session.execute(insert(models.PrivateMessage), [
+                dict(sender_id=1, receiver_id=2, conversation_id=models.conversation_key(1, 2), message_data=old_row),
+                dict(sender_id=2, receiver_id=1, conversation_id=models.conversation_key(1, 2),
+                     message=legacy("older", old_key)),
+            ])
+            # The summary of each side holds its own copy of the last message
+            await session.execute(insert(models.ConversationSummary), [
+                dict(user_id=1, peer_id=2, last_message_id=2, last_sender_id=2, last_message=legacy("older", old_key)),
+                dict(user_id=2, peer_id=1, last_message_id=2, last_sender_id=2, last_message_data=old_row),
+            ])
+            await session.commit()
+
+        reencoded = await maintenance.reencode_messages(batch_size=1)
+        async with database() as session:
+            messages = (await session.execute(select(models.PrivateMessage.message, models.PrivateMessage.message_data)
+                                              .order_by(models.PrivateMessage.id))).all()
+            summaries = (await session.execute(
+                select(models.ConversationSummary.last_message, models.ConversationSummary.last_message_data)
+                .order_by(models.ConversationSummary.user_id))).all()
+        return reencoded, messages, summaries
+
+    reencoded, messages, summaries = asyncio.run(scenario())
+
+    assert reencoded == 2
+    for (text, data), plaintext in zip(messages + summaries, ["old", "older", "older", "old"]):
+        assert text is None
+        assert data[:2] == bytes((crypto.FORMAT_VERSION, crypto.key_version))
+        assert crypto.decrypt(data) == plaintext
+
+
+def test_decrypt_many_uses_the_pool_and_the_cache(monkeypatch):
+    monkeypatch.setattr(crypto.settings, "decrypt_offload_threshold", 4)
+    crypto.decrypt_cache.entries.clear()
+    items = [(i, crypto.encrypt(f"m{i}")) for i in range(10)] + [(10, None), (11, "plain"), (12, legacy("old"))]
+
+    assert asyncio.run(crypto.decrypt_many(items)) == [f"m{i}" for i in range(10)] + [None, "plain", "old"]
+
+    calls = []
+    monkeypatch.setattr(crypto, "decrypt_batch", lambda encoded: calls.append(encoded) or [])
+    assert asyncio.run(crypto.decrypt_many(items[:3])) == ["m0", "m1", "m2"]
+    assert calls == []
+
+
+def test_cache_is_keyed_by_ciphertext():
+    crypto.decrypt_cache.entries.clear()
+    asyncio.run(crypto.decrypt_many([(1, crypto.encrypt("before"))]))
+
+    # An edit made elsewhere changes the stored value, so the old plaintext is not served
+    assert asyncio.run(crypto.decrypt_many([(1, crypto.encrypt("after"))])) == ["after"]
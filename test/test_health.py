@@ -0,0 +1,33 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.routers import health
+
+
+def client():
+    app = FastAPI()
+    app.include_router(health.router)
+    return TestClient(app)
+
+
+def test_live_does_not_touch_database():
+    assert client().get("/health/live").json() == {"status": "ok"}
+
+
+def test_ready_is_503_until_startup_finished(monkeypatch):
+    monkeypatch.setattr(health, "startup", health.StartupState())
+
+    response = client().get("/health/ready")
+
+    assert response.status_code == 503
+    assert response.json()["status"] == "starting"
+    assert response.json()["startup_seconds"] is None
+    assert "size" in response.json()["pool"]
+
+
+def test_startup_seconds_after_mark_ready():
+    state = health.StartupState()
+    state.mark_ready(3)
+
+    assert state.warmed_connections == 3
+    assert state.startup_seconds >= 0
@@ -0,0 +1,160 @@
+import asyncio
+import json
+from unittest.mock import AsyncMock
+from sqlalchemy import insert
+from app import crypto, models, schemas
+from app.broker import InMemoryBroker
+from app.config import settings
+from app.connection_manager import ConnectionManagerPrivate
+from app.routers import private_messages
+from app.routers.func_private import fetch_last_private_messages
+from app.routers.private_messages import history_frame
+
+
+async def seed(session_maker, size):
+    """
+    Users 1 and 2 alternate `size` messages (ids 1..size), user 3 writes to user 1 in between.
+    """
+    async with session_maker() as session:
+        session.add_all([models.User(id=user_id, email=f"{user_id}@test", user_name=f"user{user_id}",
+                                     password="", avatar="") for user_id in (1, 2, 3)])
+        await session.flush()
+        for index in range(size):
+            sender, receiver = (1, 2) if index % 2 == 0 else (2, 1)
+            await session.execute(insert(models.PrivateMessage).values(
+                sender_id=sender, receiver_id=receiver, conversation_id=models.conversation_key(sender, receiver),
+                message_data=crypto.encrypt(f"message {index}")))
+        await session.execute(insert(models.PrivateMessage).values(
+            sender_id=3, receiver_id=1, conversation_id=models.conversation_key(3, 1),
+            message_data=crypto.encrypt("other conversation")))
+        await session.commit()
+
+
+def test_pages_walk_the_thread_without_gaps_or_overlap(database):
+    async def scenario():
+        await seed(database, 10)
+        pages = []
+        before_id = None
+        async with database() as session:
+            while True:
+                page = await fetch_last_private_messages(session, 1, 2, before_id=before_id, limit=4)
+                frame = history_frame(page, page[-1].id if page else None)
+                pages.append([message["id"] for message in frame["messages"]])
+                if frame["next_before_id"] is None:
+                    return pages
+                before_id = frame["next_before_id"]
+
+    pages = asyncio.run(scenario())
+
+    # Oldest first within a page; the last page's cursor leads to an empty page without a cursor
+    assert pages == [[7, 8, 9, 10], [3, 4, 5, 6], [1, 2], []]
+
+
+def test_before_id_is_exclusive_and_limit_exact(database):
+    async def scenario():
+        await seed(database, 10)
+        async with database() as session:
+            page = await fetch_last_private_messages(session, 1, 2, before_id=6, limit=3)
+            first = await fetch_last_private_messages(session, 1, 2, before_id=2, limit=3)
+            none = await fetch_last_private_messages(session, 1, 2, before_id=1, limit=3)
+            return [m.id for m in page], [m.id for m in first], none
+
+    page, first, none = asyncio.run(scenario())
+
+    assert page == [5, 4, 3]
+    assert first == [1]
+    assert none == []
+
+
+def test_limit_is_clamped(database, monkeypatch):
+    monkeypatch.setattr(settings, "history_page_size", 3)
+    monkeypatch.setattr(settings, "history_page_max", 5)
+
+    async def scenario():
+        await seed(database, 10)
+        async with database() as session:
+            return [len(await fetch_last_private_messages(session, 1, 2, limit=limit)) for limit in (None, 0, -4, 100)]
+
+    assert asyncio.run(scenario()) == [3, 1, 1, 5]
+
+
+def test_page_holds_both_directions_and_is_the_same_for_both_users(database):
+    async def scenario():
+        await seed(database, 6)
+        async with database() as session:
+            mine = await fetch_last_private_messages(session, 1, 2, limit=10)
+            theirs = await fetch_last_private_messages(session, 2, 1, limit=10)
+            return mine, theirs
+
+    mine, theirs = asyncio.run(scenario())
+
+    assert [m.id for m in mine] == [m.id for m in theirs] == [6, 5, 4, 3, 2, 1]
+    # `receiver_id` carries the sender; user 3's message to user 1 is not part of the thread
+    assert {m.receiver_id for m in mine} == {1, 2}
+    assert mine[0].message == "message 5"
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, text):
+        self.sent.append(json.loads(text))
+
+
+def test_reconnect_sends_only_the_messages_after_last_seen_id(database, monkeypatch):
+    manager = ConnectionManagerPrivate(InMemoryBroker())
+    manager.mark_read = AsyncMock()
+    monkeypatch.setattr(private_messages, "manager", manager)
+    monkeypatch.setattr(private_messages, "async_session_maker", database)
+    monkeypatch.setattr(settings, "history_page_max", 3)
+    user = schemas.UserProfile(id=1, user_name="user1", avatar="", verified=False)
+
+    async def scenario():
+        await seed(database, 10)
+        socket = FakeWebSocket()
+        connection = await manager.connect(socket, 1, 2)
+        # Missed more than a page: from the database, the newest page above last_seen_id
+        await private_messages.open_conversation(connection, user, 2, batch_history=True, last_seen_id=6)
+        # From the buffer the first reconnect seeded
+        await private_messages.open_conversation(connection, user, 2, batch_history=True, last_seen_id=8)
+        await private_messages.open_conversation(connection, user, 2, batch_history=True, last_seen_id=10)
+        await asyncio.sleep(0.01)
+        return socket.sent
+
+    frames = asyncio.run(scenario())
+
+    assert [([message["id"] for message in frame["messages"]], frame["next_before_id"]) for frame in frames] == [
+        ([8, 9, 10], 8), ([9, 10], 9), ([], None)]
+
+
+def test_reopening_a_read_conversation_does_not_write_the_watermark(database, monkeypatch):
+    manager = ConnectionManagerPrivate(InMemoryBroker())
+    manager.mark_read = AsyncMock()
+    monkeypatch.setattr(private_messages, "manager", manager)
+    monkeypatch.setattr(private_messages, "async_session_maker", database)
+    user = schemas.UserProfile(id=1, user_name="user1", avatar="", verified=False)
+
+    async def scenario():
+        await seed(database, 4)
+        async with database() as session:
+            session.add(models.PrivateReadState(user_id=1, peer_id=2, last_read_id=4))
+            await session.commit()
+        connection = await manager.connect(FakeWebSocket(), 1, 2)
+        calls = []
+        for _ in range(2):
+            await private_messages.open_conversation(connection, user, 2, batch_history=True)
+            calls.append(manager.mark_read.await_count)
+        # A new message from the peer is unread again
+        manager.hot.add(models.conversation_key(1, 2), schemas.SocketModel(
+            created_at="2024-01-01T00:00:00Z", id=6, receiver_id=2, message="new", user_name="user2",
+            verified=False, avatar="", is_read=True, vote=0, edited=False))
+        await private_messages.open_conversation(connection, user, 2, batch_history=True)
+        calls.append(manager.mark_read.await_count)
+        return calls
+
+    # The first open has no buffer to go by, the second finds everything read
+    assert asyncio.run(scenario()) == [1, 1, 2]
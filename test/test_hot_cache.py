@@ -0,0 +1,57 @@
+from app import schemas
+from app.hot_cache import HotConversations, message_size
+
+
+def message(message_id, text="hi", sender_id=1, unread=True):
+    return schemas.SocketModel(created_at="2024-01-01T00:00:00Z", id=message_id, receiver_id=sender_id,
+                               message=text, user_name="one", verified=False, avatar="",
+                               is_read=unread, vote=0, edited=False)
+
+
+def test_ring_buffer_raises_its_floor_when_full():
+    hot = HotConversations(per_conversation=3, budget_bytes=10 ** 6)
+    hot.open(1)
+    hot.seed(1, [message(2), message(1)], floor=0)
+    for message_id in (3, 4, 5):
+        hot.add(1, message(message_id))
+
+    assert [m.id for m in hot.since(1, 2, 10)] == [5, 4, 3]
+    # Messages 1 and 2 were evicted, so a client that has only seen 1 must go to the database
+    assert hot.since(1, 1, 10) is None
+    assert [m.id for m in hot.latest(1, 3)] == [5, 4, 3]
+    assert hot.latest(1, 4) is None
+
+
+def test_budget_empties_least_recently_used_conversation():
+    hot = HotConversations(per_conversation=100, budget_bytes=message_size(message(1)) * 3)
+    for key in (1, 2):
+        hot.open(key)
+        hot.seed(key, [message(key * 10 + 1), message(key * 10)], floor=0)
+
+    # Conversation 1 was used least recently and is emptied, but stays open
+    assert hot.latest(1, 2) is None
+    assert [m.id for m in hot.latest(2, 2)] == [21, 20]
+    assert hot.size <= hot.budget_bytes
+    assert hot.is_open(1)
+
+
+def test_unread_state_is_known_only_when_the_buffer_can_tell():
+    hot = HotConversations(per_conversation=100, budget_bytes=10 ** 6)
+    hot.open(1)
+    assert hot.has_unread(1, reader_id=2) is None
+
+    # Reader 2's newest incoming message (from user 1) is read; its own message does not count
+    hot.seed(1, [message(3, sender_id=2), message(2, unread=False)], floor=1)
+    assert hot.has_unread(1, reader_id=2) is False
+    hot.add(1, message(4))
+    assert hot.has_unread(1, reader_id=2) is True
+    hot.apply(1, {"type": "read_receipt", "user_id": 2, "last_read_id": 4})
+    assert hot.has_unread(1, reader_id=2) is False
+
+    # Only its own messages above the floor: older incoming ones may still be unread
+    hot.open(2)
+    hot.seed(2, [message(8, sender_id=2)], floor=7)
+    assert hot.has_unread(2, reader_id=2) is None
+    hot.open(3)
+    hot.seed(3, [message(8, sender_id=2)], floor=0)
+    assert hot.has_unread(3, reader_id=2) is False
@@ -0,0 +1,43 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+from sqlalchemy.dialects import postgresql
+from app.inbox import record_new_messages, summary_rows
+
+
+def message(sender_id, receiver_id, data=b"x"):
+    return dict(sender_id=sender_id, receiver_id=receiver_id, message_data=data, fileUrl=None)
+
+
+def test_summary_rows_aggregate_a_batch_per_participant():
+    rows = [message(1, 2, b"a"), message(2, 1, b"b"), message(1, 2, b"c"), message(3, 3, b"d")]
+
+    summaries = summary_rows(rows, [10, 11, 12, 13])
+
+    by_key = {(s["user_id"], s["peer_id"]): s for s in summaries}
+    assert list(by_key) == [(1, 2), (2, 1), (3, 3)]
+    # Both sides see the newest message; each side counts what it received
+    assert [(s["last_message_id"], s["last_sender_id"], s["last_message_data"]) for s in summaries[:2]] == [
+        (12, 1, b"c"), (12, 1, b"c")
+    ]
+    assert by_key[(1, 2)]["unread_count"] == 1
+    assert by_key[(2, 1)]["unread_count"] == 2
+    # A note to self is never unread
+    assert by_key[(3, 3)]["unread_count"] == 0
+
+
+def test_record_new_messages_is_one_upsert_that_keeps_the_newest_preview():
+    session = MagicMock()
+    result = MagicMock()
+    result.all.return_value = []
+    session.execute = AsyncMock(return_value=result)
+
+    asyncio.run(record_new_messages(session, [message(1, 2)], [10]))
+
+    session.execute.assert_awaited_once()
+    upsert = str(session.execute.call_args.args[0].compile(dialect=postgresql.dialect()))
+    assert "INSERT INTO conversation_summary" in upsert
+    assert "ON CONFLICT (user_id, peer_id) DO UPDATE" in upsert
+    assert "conversation_summary.unread_count + excluded.unread_count" in upsert
+    assert "WHEN (excluded.last_message_id > conversation_summary.last_message_id)" in upsert
+    assert "private_messages" not in upsert
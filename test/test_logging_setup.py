@@ -0,0 +1,75 @@
+import json
+import logging
+import queue
+
+from app import logging_setup
+from app.logging_setup import JsonFormatter, LogLimiter, NonBlockingQueueHandler, parse_limits
+
+
+def make_record(name="app.routers.private_messages", level=logging.INFO, msg="Sent message", **extra):
+    record = logging.makeLogRecord({"name": name, "levelno": level, "levelname": logging.getLevelName(level),
+                                    "msg": msg})
+    record.__dict__.update(extra)
+    return record
+
+
+def test_json_records_carry_extra_fields_and_redact_message_bodies():
+    record = make_record(user_id=1, message_id=7, body="привіт", reply="secret answer")
+
+    entry = json.loads(JsonFormatter().format(record))
+
+    assert entry["message"] == "Sent message"
+    assert entry["logger"] == "app.routers.private_messages"
+    assert entry["user_id"] == 1 and entry["message_id"] == 7
+    assert entry["body"] == "<redacted 6 chars>"
+    assert entry["reply"] == "<redacted 13 chars>"
+    assert json.loads(JsonFormatter(include_bodies=True).format(record))["body"] == "привіт"
+
+
+def test_limiter_samples_info_records_and_rate_limits_every_level():
+    limiter = LogLimiter(parse_limits("app.routers.private_messages:0.25:1000,app.outbound:1:3"))
+
+    kept = [limiter.filter(make_record()) for _ in range(8)]
+    assert kept == [True, False, False, False, True, False, False, False]
+    # Warnings and errors are never sampled, and other loggers are not limited
+    assert limiter.filter(make_record(level=logging.ERROR))
+    assert all(limiter.filter(make_record(name="app.crypto")) for _ in range(100))
+
+    # Children share the limit of the configured logger; the next record says how many were lost
+    outbound = [limiter.filter(make_record(name="app.outbound.queue", level=logging.WARNING)) for _ in range(5)]
+    assert outbound == [True, True, True, False, False]
+    limiter.state["app.outbound"][1] = 1
+    record = make_record(name="app.outbound")
+    assert limiter.filter(record) and record.suppressed == 2
+
+
+def test_queue_handler_drops_instead_of_blocking_when_the_writer_falls_behind():
+    handler = NonBlockingQueueHandler(queue.Queue(2))
+    for index in range(5):
+        handler.handle(make_record(msg="event %d", args=None))
+    assert handler.queue.qsize() == 2
+    assert handler.dropped == 3
+
+
+def test_records_are_written_as_json_by_the_background_writer(tmp_path):
+    log_file = tmp_path / "logs" / "app.log"
+    level = logging.getLogger().level
+    logging_setup.setup_logging(log_file=str(log_file), level="INFO", limits="", include_bodies=False)
+    try:
+        logger = logging.getLogger("app.test_logging")
+        logger.info("Sent message", extra={"user_id": 3, "body": "hello"})
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            logger.error("Error sending message %s", "now", exc_info=True)
+        assert logging_setup.logging_stats()["dropped"] == 0
+    finally:
+        logging_setup.shutdown_logging()
+        logging.getLogger().setLevel(level)
+
+    entries = [json.loads(line) for line in log_file.read_text(encoding="utf-8").splitlines()]
+    assert [(entry["level"], entry["message"]) for entry in entries] == [
+        ("INFO", "Sent message"), ("ERROR", "Error sending message now")
+    ]
+    assert entries[0]["body"] == "<redacted 5 chars>"
+    assert "ValueError: boom" in entries[1]["exception"]
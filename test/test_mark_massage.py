@@ -1,23 +1,117 @@
 
-from sqlalchemy import update
-from app import models
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+from sqlalchemy import insert, select
+from sqlalchemy.dialects import postgresql
+from app import connection_manager, models
+from app.broker import InMemoryBroker
+from app.connection_manager import ConnectionManagerPrivate
 from app.routers.func_private import mark_messages_as_read
 
 
+def scalar_result(value):
+    result = MagicMock()
+    result.scalar.return_value = value
+    return result
+
+
+def test_mark_messages_as_read_moves_watermark():
+    session = MagicMock()
+    session.execute = AsyncMock(side_effect=[scalar_result(42), scalar_result(42)])
+    session.commit = AsyncMock()
+
+    # Marking the conversation with user 2 as read for user 1
+    last_read_id = asyncio.run(mark_messages_as_read(session, 1, 2))
+
+    assert last_read_id == 42
+    # The caller commits, together with the unread recount
+    session.commit.assert_not_awaited()
+
+    # The watermark is upserted and only ever moves forward
+    upsert = str(session.execute.call_args_list[1].args[0].compile(dialect=postgresql.dialect()))
+    assert "INSERT INTO private_read_state" in upsert
+    assert "ON CONFLICT (user_id, peer_id) DO UPDATE" in upsert
+    assert "private_read_state.last_read_id < excluded.last_read_id" in upsert
+
+
+def test_mark_messages_as_read_without_messages():
+    session = MagicMock()
+    session.execute = AsyncMock(return_value=scalar_result(None))
+    session.commit = AsyncMock()
+
+    assert asyncio.run(mark_messages_as_read(session, 1, 2)) is None
+    session.commit.assert_not_awaited()
+
+
+def upsert_params(session):
+    upsert = session.execute.call_args_list[1].args[0].compile(dialect=postgresql.dialect())
+    return upsert.params
+
+
+def test_mark_messages_as_read_clamps_to_latest_message():
+    session = MagicMock()
+    session.execute = AsyncMock(side_effect=[scalar_result(42), scalar_result(42)])
+    session.commit = AsyncMock()
+
+    # An ack past the newest message of the sender must not move the watermark beyond it
+    assert asyncio.run(mark_messages_as_read(session, 1, 2, message_id=1000)) == 42
+    assert upsert_params(session)["last_read_id"] == 42
+
+
+def test_mark_messages_as_read_keeps_explicit_ack_below_latest():
+    session = MagicMock()
+    session.execute = AsyncMock(side_effect=[scalar_result(42), scalar_result(30)])
+    session.commit = AsyncMock()
+
+    assert asyncio.run(mark_messages_as_read(session, 1, 2, message_id=30)) == 30
+    assert upsert_params(session)["last_read_id"] == 30
+
+
+def test_mark_messages_as_read_does_not_move_backwards():
+    session = MagicMock()
+    # The upsert WHERE rejects an older watermark, so RETURNING yields no row
+    session.execute = AsyncMock(side_effect=[scalar_result(42), scalar_result(None)])
+    session.commit = AsyncMock()
+
+    assert asyncio.run(mark_messages_as_read(session, 1, 2, message_id=10)) is None
+
+
+def test_mark_read_moves_watermark_and_unread_count_together(database, monkeypatch):
+    monkeypatch.setattr(connection_manager, "async_session_maker", database)
+    manager = ConnectionManagerPrivate(InMemoryBroker())
+    manager.send_private_event = AsyncMock()
+    manager.publish_inbox = AsyncMock()
 
+    async def state():
+        async with database() as session:
+            watermark = (await session.execute(select(models.PrivateReadState.last_read_id))).scalar()
+            unread = (await session.execute(select(models.ConversationSummary.unread_count))).scalar()
+            return watermark, unread
 
+    async def scenario():
+        async with database() as session:
+            session.add_all([models.User(id=user_id, email=f"{user_id}@test", user_name=f"user{user_id}",
+                                         password="", avatar="") for user_id in (1, 2)])
+            await session.flush()
+            await session.execute(insert(models.PrivateMessage), [
+                dict(sender_id=2, receiver_id=1, conversation_id=models.conversation_key(1, 2), message=f"m{index}")
+                for index in range(3)])
+            await session.execute(insert(models.ConversationSummary).values(
+                user_id=1, peer_id=2, last_message_id=3, last_sender_id=2, unread_count=3))
+            await session.commit()
 
-async def test_mark_messages_as_read(mocker, session, user):
-    # Mocking the execute method of the session
-    mocker.patch.object(session, 'execute')
+        await manager.mark_read(1, 2, message_id=2)
+        after_ack = await state()
+        # An older ack changes nothing and notifies no one
+        await manager.mark_read(1, 2, message_id=1)
+        after_old_ack = await state()
+        await manager.mark_read(1, 2)
+        return after_ack, after_old_ack, await state()
 
-    # Marking all messages as read for the given user
-    await mark_messages_as_read(session, user.id)
+    after_ack, after_old_ack, after_open = asyncio.run(scenario())
 
-    # Asserting that the execute method was called with the correct query
-    session.execute.assert_called_once_with(
-        update(models.PrivateMessage)
-        .where(models.PrivateMessage.recipient_id == user.id,
-               models.PrivateMessage.is_read == True)
-        .values(is_read=False)
-    )
\ No newline at end of file
+    assert after_ack == after_old_ack == (2, 1)
+    assert after_open == (3, 0)
+    assert manager.publish_inbox.await_count == 2
+    assert manager.publish_inbox.await_args.args[0][0][1].unread_count == 0
@@ -0,0 +1,60 @@
+import asyncio
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app import crypto
+from app.metrics import DECRYPT_FAILURES, Counter, Histogram, Registry
+from app.routers import metrics
+
+
+def test_histogram_and_counter_render_in_prometheus_text_format():
+    registry = Registry()
+    latency = Histogram("test_seconds", "Test latency.", ["operation"], buckets=(0.01, 0.1), registry=registry)
+    calls = Counter("test_calls", "Test calls.", ["result"], registry=registry)
+
+    latency.observe(0.005, "read")
+    latency.observe(0.05, "read")
+    latency.observe(3, "read")
+    calls.inc("ok")
+    calls.inc("ok", amount=2)
+
+    lines = registry.render().splitlines()
+
+    assert "# TYPE test_seconds histogram" in lines
+    assert 'test_seconds_bucket{operation="read",le="0.01"} 1' in lines
+    assert 'test_seconds_bucket{operation="read",le="0.1"} 2' in lines
+    assert 'test_seconds_bucket{operation="read",le="+Inf"} 3' in lines
+    assert 'test_seconds_count{operation="read"} 3' in lines
+    assert 'test_calls_total{result="ok"} 3' in lines
+
+
+def test_timed_coroutines_are_observed_even_when_they_fail():
+    latency = Histogram("test_failing_seconds", "Test latency.", registry=Registry())
+
+    @latency.time()
+    async def failing():
+        raise ValueError("boom")
+
+    try:
+        asyncio.run(failing())
+    except ValueError:
+        pass
+
+    counts, _ = latency.values[()]
+    assert sum(counts) == 1
+
+
+def test_metrics_endpoint_exposes_hot_path_metrics():
+    app = FastAPI()
+    app.include_router(metrics.router)
+    before = DECRYPT_FAILURES.values.get((), 0)
+
+    assert crypto.decrypt(b"\x01\x01not a token") is None
+    response = TestClient(app).get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert f"pm_decrypt_failures_total {int(before + 1)}" in response.text
+    assert 'pm_ws_connections{kind="sockets"} 0' in response.text
+    assert "# TYPE pm_db_operation_seconds histogram" in response.text
@@ -0,0 +1,82 @@
+import asyncio
+
+from app.outbound import OutboundQueue
+
+
+class BlockedWebSocket:
+    """
+    A client that does not read: sends wait until `unblock` is set.
+    """
+
+    def __init__(self):
+        self.sent = []
+        self.unblock = asyncio.Event()
+
+    async def send_text(self, text):
+        await self.unblock.wait()
+        self.sent.append(text)
+
+
+def run_blocked(policy, frames, send_timeout=5.0):
+    async def scenario():
+        websocket = BlockedWebSocket()
+        slow = []
+        queue = OutboundQueue(websocket, 3, policy, send_timeout, slow.append)
+        queue.start()
+        for text, key in frames:
+            queue.put(text, key)
+            # The writer takes the first frame and then hangs on the network
+            await asyncio.sleep(0)
+        websocket.unblock.set()
+        await asyncio.sleep(0.01)
+        queue.close()
+        return websocket.sent, queue, slow
+
+    return asyncio.run(scenario())
+
+
+def test_drop_oldest_keeps_the_newest_frames():
+    frames = [(f"m{i}", None) for i in range(6)]
+    sent, queue, slow = run_blocked("drop_oldest", frames)
+
+    # m0 was in flight, m1 and m2 were dropped
+    assert sent == ["m0", "m3", "m4", "m5"]
+    assert queue.dropped == 2
+    assert queue.max_depth == 3
+    assert slow == []
+
+
+def test_coalesce_replaces_superseded_events():
+    frames = [("m0", None), ("v1", ("vote", 7)), ("m1", None), ("r1", ("read", 2)),
+              ("v2", ("vote", 7)), ("v3", ("vote", 7))]
+    sent, queue, slow = run_blocked("coalesce", frames)
+
+    assert sent == ["m0", "v3", "m1", "r1"]
+    assert queue.coalesced == 2
+    assert slow == []
+
+
+def test_disconnect_policy_reports_slow_consumer():
+    frames = [(f"m{i}", None) for i in range(5)]
+    sent, queue, slow = run_blocked("disconnect", frames)
+
+    assert slow == [queue]
+    assert queue.closed
+    assert sent == []
+
+
+def test_send_timeout_disconnects_half_dead_client():
+    async def scenario():
+        websocket = BlockedWebSocket()
+        slow = []
+        queue = OutboundQueue(websocket, 3, "drop_oldest", 0.01, slow.append)
+        queue.start()
+        queue.put("m0")
+        await asyncio.sleep(0.05)
+        queue.put("m1")
+        return queue, slow
+
+    queue, slow = asyncio.run(scenario())
+
+    assert slow == [queue]
+    assert queue.stats()["sent"] == 0
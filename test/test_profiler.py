@@ -0,0 +1,173 @@
+import asyncio
+import json
+import time
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from app import profiler as profiler_module
+from app.config import settings
+from app.profiler import Profiler
+from app.write_pipeline import MessageWriter
+
+
+def read_profiles(path):
+    if not path.exists():
+        return []
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+def make_profiler(monkeypatch, tmp_path, **config):
+    monkeypatch.setattr(settings, "profiler_file", str(tmp_path / "profiles.log"))
+    profiler = Profiler()
+    profiler.configure(**config)
+    # Each test writes to its own file
+    monkeypatch.setattr(profiler_module.profile_logger, "handlers", [])
+    return profiler, tmp_path / "profiles.log"
+
+
+def test_slow_operation_is_written_with_its_stacks_and_sql(monkeypatch, tmp_path):
+    profiler, path = make_profiler(monkeypatch, tmp_path, enabled=True, threshold_ms=20, interval_ms=1)
+
+    async def busy():
+        deadline = time.perf_counter() + 0.03
+        while time.perf_counter() < deadline:
+            pass
+
+    async def main():
+        engine = create_async_engine("sqlite+aiosqlite://")
+        profiler.instrument(engine)
+        try:
+            async with profiler.profile("command:send", user_id=1, peer_id=2):
+                async with engine.connect() as connection:
+                    await connection.execute(text("SELECT 1"))
+                await busy()
+            async with engine.connect() as connection:
+                # Outside any profiled operation: not recorded
+                await connection.execute(text("SELECT 2"))
+        finally:
+            await engine.dispose()
+
+    asyncio.run(main())
+
+    [profile] = read_profiles(path)
+    assert profile["operation"] == "command:send"
+    assert profile["reason"] == "slow"
+    assert profile["context"] == {"user_id": 1, "peer_id": 2}
+    assert profile["duration_ms"] >= 20
+    assert [statement["statement"] for statement in profile["sql"]] == ["SELECT 1"]
+    assert profile["samples"] > 0
+    assert any(stack.startswith("running;") and ":busy:" in stack for stack in profile["stacks"])
+    assert profiler.stats()["written"] == 1
+
+
+def test_fast_operations_are_discarded_unless_sampled(monkeypatch, tmp_path):
+    profiler, path = make_profiler(monkeypatch, tmp_path, enabled=True, threshold_ms=1000)
+
+    async def main():
+        async with profiler.profile("command:read"):
+            await asyncio.sleep(0)
+        profiler.configure(sample_rate=1.0)
+        async with profiler.profile("command:vote"):
+            async with profiler.profile("send_private_all"):
+                await asyncio.sleep(0)
+
+    asyncio.run(main())
+
+    # The nested operation is part of the outer one
+    assert [(profile["operation"], profile["reason"]) for profile in read_profiles(path)] == [
+        ("command:vote", "sampled")
+    ]
+    assert profiler.stats()["profiled"] == 2
+
+
+def test_disabled_profiler_records_nothing_until_turned_on_at_runtime(monkeypatch, tmp_path):
+    profiler, path = make_profiler(monkeypatch, tmp_path, enabled=False, threshold_ms=0)
+
+    async def main():
+        async with profiler.profile("command:load_more"):
+            await asyncio.sleep(0)
+        profiler.configure(enabled=True)
+        async with profiler.profile("command:load_more"):
+            await asyncio.sleep(0)
+
+    asyncio.run(main())
+
+    assert len(read_profiles(path)) == 1
+    assert profiler.stats()["profiled"] == 1
+
+
+def test_work_left_behind_by_an_operation_is_not_in_its_profile(monkeypatch, tmp_path):
+    profiler, path = make_profiler(monkeypatch, tmp_path, enabled=True, threshold_ms=0)
+
+    async def main():
+        engine = create_async_engine("sqlite+aiosqlite://")
+        profiler.instrument(engine)
+        later = asyncio.Event()
+
+        async def leftover():
+            # A task started by the operation that outlives it, with the operation's context
+            await later.wait()
+            async with engine.connect() as connection:
+                await connection.execute(text("SELECT 2"))
+
+        try:
+            async with profiler.profile("command:send"):
+                task = asyncio.create_task(leftover())
+                async with engine.connect() as connection:
+                    await connection.execute(text("SELECT 1"))
+            later.set()
+            await task
+        finally:
+            await engine.dispose()
+
+    asyncio.run(main())
+
+    [profile] = read_profiles(path)
+    assert [statement["statement"] for statement in profile["sql"]] == ["SELECT 1"]
+
+
+class ProbeSession:
+    """
+    Notes the profile in effect where the writer executes its INSERT.
+    """
+
+    def __init__(self, seen):
+        self.seen = seen
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, statement, rows=None):
+        self.seen.append(profiler_module.current_recording.get())
+
+        class Result:
+            def scalars(self):
+                return self
+
+            def all(self):
+                return list(range(1, len(rows) + 1))
+        return Result()
+
+    async def commit(self):
+        pass
+
+
+def test_message_writer_started_inside_a_profile_runs_outside_it(monkeypatch, tmp_path):
+    profiler, path = make_profiler(monkeypatch, tmp_path, enabled=True, threshold_ms=0)
+    seen = []
+
+    async def main():
+        writer = MessageWriter(lambda: ProbeSession(seen), max_batch=10, flush_interval=0)
+        async with profiler.profile("send_private_all"):
+            # The first submit starts the writer task
+            await writer.submit({"sender_id": 1, "receiver_id": 2})
+        await writer.submit({"sender_id": 1, "receiver_id": 2})
+        await writer.close()
+
+    asyncio.run(main())
+
+    assert seen == [None, None]
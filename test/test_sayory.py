@@ -0,0 +1,118 @@
+import asyncio
+import json
+from unittest.mock import AsyncMock
+
+from app.AI import sayory
+from app.AI.fake import FakeChatClient
+from app.AI.prompt_cache import PromptCache
+from app.broker import InMemoryBroker
+from app.connection_manager import ConnectionManagerPrivate
+from app.routers import private_messages
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, text):
+        self.sent.append(json.loads(text))
+
+
+def test_stream_reply_yields_chunks(monkeypatch):
+    monkeypatch.setattr(sayory.settings, "sayory_cache_enabled", False)
+    fake = FakeChatClient(reply="Привіт, як справи?")
+    monkeypatch.setattr(sayory, "client", fake)
+
+    async def collect():
+        return [part async for part in sayory.stream_reply("hi")]
+
+    assert asyncio.run(collect()) == ["Привіт, ", "як ", "справи?"]
+    assert fake.requests[0]["stream"] is True
+    assert "n" not in fake.requests[0]
+
+
+def test_reply_is_streamed_then_stored_once(monkeypatch):
+    monkeypatch.setattr(sayory.settings, "sayory_cache_enabled", False)
+    monkeypatch.setattr(sayory, "client", FakeChatClient(reply="one two three"))
+    monkeypatch.setattr(private_messages.settings, "sayory_delta_interval_ms", 0)
+    manager = ConnectionManagerPrivate(InMemoryBroker())
+    manager.add_private_all_to_database = AsyncMock(return_value=9)
+    manager.mark_read = AsyncMock()
+    monkeypatch.setattr(private_messages, "manager", manager)
+
+    async def scenario():
+        websocket = FakeWebSocket()
+        await manager.connect(websocket, 1, 2)
+        reply = await private_messages.reply_as_sayory(1, 2, "hi", None, 5)
+        await asyncio.sleep(0.01)
+        return reply, websocket.sent
+
+    reply, sent = asyncio.run(scenario())
+
+    assert reply == "one two three"
+    manager.add_private_all_to_database.assert_awaited_once()
+    deltas = [frame for frame in sent if frame.get("type") == "ai_delta"]
+    assert "".join(frame["delta"] for frame in deltas[:-1]) == "one two three"
+    assert deltas[-1]["done"] is True and deltas[-1]["message_id"] == 9
+    assert deltas[-1]["truncated"] is False
+    assert len({frame["stream_id"] for frame in deltas}) == 1
+    # The stored message arrives between the last chunk and the done marker
+    stored = [frame for frame in sent if frame.get("id") == 9]
+    assert stored[0]["message"] == "one two three"
+    assert sent.index(stored[0]) == len(sent) - 2
+
+
+def test_stream_failing_part_way_is_stored_and_sent_as_truncated(monkeypatch):
+    async def failing_stream(message):
+        yield "one "
+        yield "two "
+        raise ConnectionError("upstream went away")
+
+    monkeypatch.setattr(sayory, "stream_reply", failing_stream)
+    monkeypatch.setattr(private_messages.settings, "sayory_delta_interval_ms", 0)
+    manager = ConnectionManagerPrivate(InMemoryBroker())
+    manager.add_private_all_to_database = AsyncMock(return_value=9)
+    manager.mark_read = AsyncMock()
+    monkeypatch.setattr(private_messages, "manager", manager)
+
+    async def scenario():
+        websocket = FakeWebSocket()
+        await manager.connect(websocket, 1, 2)
+        reply = await private_messages.reply_as_sayory(1, 2, "hi", None, 5)
+        await asyncio.sleep(0.01)
+        return reply, websocket.sent
+
+    reply, sent = asyncio.run(scenario())
+
+    assert reply == f"one two \n\n{sayory.fallback_reply}"
+    assert manager.add_private_all_to_database.await_args.args[2] == reply
+    deltas = [frame for frame in sent if frame.get("type") == "ai_delta"]
+    # The streamed text matches the stored one
+    assert "".join(frame["delta"] for frame in deltas[:-1]) == reply
+    assert deltas[-1]["done"] is True and deltas[-1]["truncated"] is True
+    assert [frame["message"] for frame in sent if frame.get("id") == 9] == [reply]
+
+
+def test_identical_prompts_share_one_call_and_are_cached(monkeypatch):
+    fake = FakeChatClient(reply="Я Sayory, чим допомогти?", delay=0.01)
+    monkeypatch.setattr(sayory, "client", fake)
+    monkeypatch.setattr(sayory, "prompt_cache", PromptCache(10, 60))
+
+    async def ask(prompt):
+        return "".join([part async for part in sayory.stream_reply(prompt)])
+
+    async def scenario():
+        concurrent = await asyncio.gather(ask("Привіт"), ask("  привіт "), ask("Привіт"))
+        again = await ask("ПРИВІТ")
+        return concurrent, again
+
+    concurrent, again = asyncio.run(scenario())
+
+    assert concurrent == [again] * 3
+    assert len(fake.requests) == 1
+    stats = sayory.prompt_cache.stats()
+    assert (stats["misses"], stats["coalesced"], stats["hits"]) == (1, 2, 1)
+    assert stats["saved_seconds"] > 0
@@ -0,0 +1,121 @@
+import asyncio
+import time
+from unittest.mock import AsyncMock, MagicMock
+import pytest
+from fastapi import HTTPException
+from app import oauth2, schemas
+from app.user_cache import UserCache
+
+
+def profile(user_id, name="user", blocked=False):
+    return schemas.UserProfile(id=user_id, user_name=name, avatar="", verified=False, blocked=blocked)
+
+
+def user_result(user):
+    result = MagicMock()
+    result.scalars.return_value.first.return_value = user
+    return result
+
+
+class Clock:
+    def __init__(self, monkeypatch):
+        self.now = 1000.0
+        monkeypatch.setattr(time, "monotonic", lambda: self.now)
+        monkeypatch.setattr(time, "time", lambda: self.now)
+
+
+def test_profile_expires_after_ttl(monkeypatch):
+    clock = Clock(monkeypatch)
+    cache = UserCache(max_size=10, ttl=60)
+    cache.put(profile(1))
+
+    clock.now += 59
+    assert cache.get(1).id == 1
+    clock.now += 2
+    assert cache.get(1) is None
+    assert cache.stats()["size"] == 0
+
+
+def test_token_expires_at_its_exp_before_the_ttl(monkeypatch):
+    clock = Clock(monkeypatch)
+    cache = UserCache(max_size=10, ttl=60)
+    cache.put_token("short", 1, expires_at=clock.now + 10)
+    cache.put_token("long", 2, expires_at=None)
+
+    clock.now += 11
+    assert cache.get_token("short") is None
+    assert cache.get_token("long") == 2
+    clock.now += 50
+    assert cache.get_token("long") is None
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = UserCache(max_size=2, ttl=60)
+    cache.put(profile(1))
+    cache.put(profile(2))
+    cache.get(1)
+    cache.put(profile(3))
+
+    assert cache.get(2) is None
+    assert cache.get(1) is not None and cache.get(3) is not None
+
+    for user_id in (1, 2, 3):
+        cache.put_token(f"token{user_id}", user_id, expires_at=None)
+    assert cache.get_token("token1") is None
+    assert cache.get_token("token3") == 3
+
+
+def test_invalidate_drops_the_profile_and_the_tokens_of_the_user():
+    cache = UserCache(max_size=10, ttl=60)
+    cache.put(profile(1))
+    cache.put(profile(2))
+    cache.put_token("a", 1, expires_at=None)
+    cache.put_token("b", 1, expires_at=None)
+    cache.put_token("c", 2, expires_at=None)
+
+    cache.invalidate(1)
+
+    assert cache.get(1) is None
+    assert cache.get_token("a") is None and cache.get_token("b") is None
+    assert cache.get(2) is not None
+    assert cache.get_token("c") == 2
+
+
+def test_changed_profile_is_reloaded_after_invalidate():
+    cache = UserCache(max_size=10, ttl=60)
+    session = MagicMock()
+    session.execute = AsyncMock(side_effect=[user_result(profile(1, "old")),
+                                             user_result(profile(1, "new", blocked=True))])
+
+    assert asyncio.run(cache.get_user(session, 1)).user_name == "old"
+    assert asyncio.run(cache.get_user(session, 1)).user_name == "old"
+    cache.invalidate(1)
+    reloaded = asyncio.run(cache.get_user(session, 1))
+
+    assert reloaded.user_name == "new" and reloaded.blocked
+    assert session.execute.await_count == 2
+
+
+def test_hit_and_miss_counters():
+    cache = UserCache(max_size=10, ttl=60)
+    cache.get(1)
+    cache.put(profile(1))
+    cache.get(1)
+    cache.get(1)
+
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"]) == (2, 1)
+    assert stats["hit_rate"] == pytest.approx(2 / 3)
+
+
+def test_cached_token_of_a_missing_user_is_rejected(monkeypatch):
+    cache = UserCache(max_size=10, ttl=60)
+    cache.put_token("token", 42, expires_at=None)
+    monkeypatch.setattr(oauth2, "user_cache", cache)
+    session = MagicMock()
+    session.execute = AsyncMock(return_value=user_result(None))
+
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(oauth2.get_current_user("token", session))
+
+    assert error.value.status_code == 401
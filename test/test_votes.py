@@ -0,0 +1,70 @@
+import asyncio
+from sqlalchemy import insert, select, update
+from app import maintenance, models, schemas
+from app.routers.func_private import process_vote
+
+
+async def seed(session_maker, messages):
+    async with session_maker() as session:
+        session.add_all([models.User(id=user_id, email=f"{user_id}@test", user_name=f"user{user_id}",
+                                     password="", avatar="") for user_id in (1, 2, 3)])
+        await session.flush()
+        await session.execute(insert(models.PrivateMessage), [
+            dict(sender_id=1, receiver_id=2, conversation_id=models.conversation_key(1, 2), message=f"m{index}")
+            for index in range(messages)])
+        await session.commit()
+
+
+def user(user_id):
+    return schemas.UserProfile(id=user_id, user_name=f"user{user_id}", avatar="", verified=False)
+
+
+def test_vote_toggles_and_keeps_the_count(database):
+    async def vote(voter, direction):
+        async with database() as session:
+            result = await process_vote(schemas.Vote(message_id=1, dir=direction), session, user(voter), 3 - voter)
+            return result["message"], result["vote"]
+
+    async def scenario():
+        await seed(database, 1)
+        results = [await vote(1, 1), await vote(2, 1), await vote(1, 1), await vote(2, 0), await vote(2, 0)]
+        async with database() as session:
+            stored = (await session.execute(select(models.PrivateMessage.vote_count))).scalar()
+            votes = (await session.execute(select(models.PrivateMessageVote))).scalars().all()
+        return results, stored, votes
+
+    results, stored, votes = asyncio.run(scenario())
+
+    assert results == [("Successfully added vote", 1), ("Successfully added vote", 2),
+                       ("Successfully removed vote", 1), ("Successfully deleted vote", 0),
+                       ("Vote does not exist or has already been removed", 0)]
+    assert stored == 0 and votes == []
+
+
+def test_reconcile_repairs_drifted_counts_across_batches(database, monkeypatch):
+    monkeypatch.setattr(maintenance, "async_session_maker", database)
+
+    async def scenario():
+        await seed(database, 7)
+        async with database() as session:
+            # Votes on the last id of a batch, the first of the next one and the last message
+            session.add_all([models.PrivateMessageVote(message_id=message_id, user_id=voter, dir=1)
+                             for message_id, voter in ((3, 1), (3, 2), (4, 2), (7, 1))])
+            await session.execute(update(models.PrivateMessage).where(models.PrivateMessage.id == 3)
+                                  .values(vote_count=5))
+            await session.execute(update(models.PrivateMessage).where(models.PrivateMessage.id == 6)
+                                  .values(vote_count=-1))
+            await session.commit()
+
+        fixed = await maintenance.reconcile_vote_counts(batch_size=3)
+        again = await maintenance.reconcile_vote_counts(batch_size=3)
+        async with database() as session:
+            counts = (await session.execute(select(models.PrivateMessage.id, models.PrivateMessage.vote_count)
+                                            .order_by(models.PrivateMessage.id))).all()
+        return fixed, again, counts
+
+    fixed, again, counts = asyncio.run(scenario())
+
+    # Messages 3, 4, 6 and 7 drifted; a second run has nothing left to fix
+    assert fixed == 4 and again == 0
+    assert [tuple(row) for row in counts] == [(1, 0), (2, 0), (3, 2), (4, 1), (5, 0), (6, 0), (7, 1)]
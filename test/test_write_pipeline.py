@@ -0,0 +1,144 @@
+
+import asyncio
+
+from app.write_pipeline import MessageWriter
+
+
+class FakeResult:
+    def __init__(self, ids):
+        self.ids = ids
+
+    def scalars(self):
+        return self
+
+    def all(self):
+        return self.ids
+
+
+class FakeSessionMaker:
+    """
+    Hands out sessions that record every INSERT and COMMIT and assign sequential ids.
+    Rows with `receiver_id == 0` fail like an FK violation would.
+    """
+
+    def __init__(self):
+        self.executes = []
+        self.commits = 0
+        self.next_id = 1
+
+    def __call__(self):
+        return FakeSession(self)
+
+
+class FakeSession:
+    def __init__(self, maker):
+        self.maker = maker
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, statement, rows):
+        self.maker.executes.append(rows)
+        if any(row["receiver_id"] == 0 for row in rows):
+            raise ValueError("violates foreign key constraint")
+        ids = list(range(self.maker.next_id, self.maker.next_id + len(rows)))
+        self.maker.next_id += len(rows)
+        return FakeResult(ids)
+
+    async def commit(self):
+        self.maker.commits += 1
+
+
+def row(sender_id, receiver_id=1):
+    return dict(sender_id=sender_id, receiver_id=receiver_id, message=f"m{sender_id}",
+                is_read=True, fileUrl=None, id_return=None)
+
+
+def test_burst_of_max_batch_is_one_insert_without_waiting():
+    async def scenario():
+        maker = FakeSessionMaker()
+        writer = MessageWriter(maker, max_batch=5, flush_interval=10)
+        ids = await asyncio.wait_for(asyncio.gather(*[writer.submit(row(i)) for i in range(5)]), 1)
+        await writer.close()
+        return maker, ids
+
+    maker, ids = asyncio.run(scenario())
+
+    assert ids == [1, 2, 3, 4, 5]
+    assert len(maker.executes) == 1
+    assert [r["sender_id"] for r in maker.executes[0]] == [0, 1, 2, 3, 4]
+    assert maker.commits == 1
+
+
+def test_partial_batch_is_flushed_by_the_timer():
+    async def scenario():
+        maker = FakeSessionMaker()
+        writer = MessageWriter(maker, max_batch=100, flush_interval=0.01)
+        ids = await asyncio.wait_for(asyncio.gather(*[writer.submit(row(i)) for i in range(3)]), 1)
+        await writer.close()
+        return maker, ids
+
+    maker, ids = asyncio.run(scenario())
+
+    assert ids == [1, 2, 3]
+    assert len(maker.executes) == 1
+    assert maker.commits == 1
+
+
+def test_failing_row_does_not_fail_the_rest_of_the_batch():
+    async def scenario():
+        maker = FakeSessionMaker()
+        writer = MessageWriter(maker, max_batch=3, flush_interval=10)
+        results = await asyncio.gather(writer.submit(row(1)), writer.submit(row(2, receiver_id=0)),
+                                       writer.submit(row(3)), return_exceptions=True)
+        await writer.close()
+        return results
+
+    first, failed, third = asyncio.run(scenario())
+
+    assert isinstance(failed, ValueError)
+    assert isinstance(first, int) and isinstance(third, int)
+    assert first < third
+
+
+def test_close_writes_queued_messages():
+    async def scenario():
+        maker = FakeSessionMaker()
+        writer = MessageWriter(maker, max_batch=100, flush_interval=10)
+        pending = [asyncio.create_task(writer.submit(row(i))) for i in range(4)]
+        await asyncio.sleep(0)
+        await asyncio.wait_for(writer.close(), 1)
+        return maker, [task.result() for task in pending]
+
+    maker, ids = asyncio.run(scenario())
+
+    assert ids == [1, 2, 3, 4]
+    assert maker.commits == 1
+
+
+def test_after_insert_runs_before_commit_and_its_result_reaches_on_commit():
+    async def scenario():
+        maker = FakeSessionMaker()
+        seen, notified = [], []
+
+        async def after_insert(session, rows, ids):
+            seen.append((maker.commits, [r["sender_id"] for r in rows], list(ids)))
+            return ["summary"]
+
+        async def on_commit(result):
+            notified.append((maker.commits, result))
+
+        writer = MessageWriter(maker, max_batch=2, flush_interval=10, after_insert=after_insert)
+        writer.on_commit = on_commit
+        await asyncio.wait_for(asyncio.gather(writer.submit(row(1)), writer.submit(row(2))), 1)
+        await writer.close()
+        await asyncio.sleep(0)
+        return seen, notified
+
+    seen, notified = asyncio.run(scenario())
+
+    assert seen == [(0, [1, 2], [1, 2])]
+    assert notified == [(1, ["summary"])]